@@ -11,4 +11,15 @@ app.config.from_pyfile('config.py')
 CAS(app)
 
 # Now, import all of the routes for the app
-import backend.view_handler, backend.messages_handler, backend.admin_handler, backend.misc_handler
+import backend.view_handler, backend.messages_handler, backend.admin_handler, backend.misc_handler, backend.stream_handler
+
+# Compress responses for clients that accept it (see compression.py)
+import backend.compression
+
+# Load the label IDs into memory, so that applying existing labels doesn't need to look them up
+from backend.database_handler import warm_label_ids_cache
+warm_label_ids_cache()
+
+# Render the Flutter app's index.html once, so that page requests are served from memory
+from backend.view_handler import warm_shell_cache
+warm_shell_cache()
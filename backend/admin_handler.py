@@ -2,7 +2,17 @@ import flask
 import mariadb
 from flask import make_response, jsonify, request
 from backend import app
-from backend.database_handler import get_conn_and_cursor
+from backend.database_handler import get_conn_and_cursor, forget_known_user, get_roles_version
+from backend.route_wrappers import conditional_get, user_has_role
+from backend.event_bus import event_bus
+from backend.job_queue import enqueue_job, get_job
+
+def job_accepted_response(message, job_id):
+    '''Respond with 202 to a promotion whose follow-up work (granting the user access to every conversation) was queued as a background job, pointing to the job's status.'''
+
+    resp = make_response(jsonify({"message": message, "jobId": job_id}), 202)
+    resp.headers.set('Location', f"/api/jobs/{job_id}")
+    return resp
 
 @app.route("/api/admins/create", methods=["POST"])
 def add_admin():
@@ -42,10 +52,22 @@ def add_admin():
         if proc_result == -403:
             return make_response(jsonify({"message": "User is not an admin, so this request is not allowed."}), 403)
         
+        # Queue a job to update the user's access to conversations according to their new roles (committed along with the role change itself)
+        job_id = None
+        if proc_result == -201:
+            job_id = enqueue_job(cur, "sync_conversation_access", {"username": new_admin}, flask.session.get('CAS_USERNAME'))
+
         # Commit database changes
         conn.commit()
+
+        # The procedure changed this user's Users entry, so stop treating them as already confirmed
+        forget_known_user(new_admin)
+
+        # Let the user's open streams know that their roles (and so maybe their access) changed
+        event_bus.publish('roles_changed', {}, username=new_admin)
     except mariadb.Error as e:
         print(f"Error when adding admin: {e}")
+        return make_response(jsonify({"message": "Error when adding admin"}), 500)
     finally:
         # Close the database connection
         conn.close()
@@ -54,8 +76,8 @@ def add_admin():
     if proc_result == -200:
         return make_response(jsonify({"message": f"'{new_admin}' is already an admin."}), 200)
     
-    # proc_result == -201, so respond appropriately for successful admin creation
-    return make_response(jsonify({"message": f"Suuccess: '{new_admin}' is now an admin."}), 201)
+    # proc_result == -201, so respond appropriately for successful admin creation (the new admin's access to conversations is updated by the queued job)
+    return job_accepted_response(f"Suuccess: '{new_admin}' is now an admin.", job_id)
 
 @app.route("/api/ccsga_reps/create", methods=["POST"])
 def add_ccsga_rep():
@@ -95,10 +117,22 @@ def add_ccsga_rep():
         if proc_result == -403:
             return make_response(jsonify({"message": "User is not an admin, so this request is not allowed."}), 403)
         
+        # Queue a job to update the user's access to conversations according to their new roles (committed along with the role change itself)
+        job_id = None
+        if proc_result == -201:
+            job_id = enqueue_job(cur, "sync_conversation_access", {"username": new_ccsga}, flask.session.get('CAS_USERNAME'))
+
         # Commit database changes
         conn.commit()
+
+        # The procedure changed this user's Users entry, so stop treating them as already confirmed
+        forget_known_user(new_ccsga)
+
+        # Let the user's open streams know that their roles (and so maybe their access) changed
+        event_bus.publish('roles_changed', {}, username=new_ccsga)
     except mariadb.Error as e:
         print(f"Error when adding rep: {e}")
+        return make_response(jsonify({"message": "Error when adding rep"}), 500)
     finally:
         # Close the database connection
         conn.close()
@@ -107,8 +141,8 @@ def add_ccsga_rep():
     if proc_result == -200:
         return make_response(jsonify({"message": f"'{new_ccsga}' is already a CCSGA rep."}), 200)
     
-    # proc_result == -201, so respond appropriately for successful rep creation
-    return make_response(jsonify({"message": f"Suuccess: '{new_ccsga}' is now a CCSGA rep."}), 201)
+    # proc_result == -201, so respond appropriately for successful rep creation (the new rep's access to conversations is updated by the queued job)
+    return job_accepted_response(f"Suuccess: '{new_ccsga}' is now a CCSGA rep.", job_id)
 
 @app.route("/api/banned_users/create", methods=["POST"])
 def create_banned_user():
@@ -148,10 +182,17 @@ def create_banned_user():
         if proc_result == -403:
             return make_response(jsonify({"message": "User is not an admin, so this request is not allowed."}), 403)
         
-        # Commit database changes
+        # Commit database changes (add_ban has already revoked the user's access to every conversation)
         conn.commit()
+
+        # The procedure changed this user's Users entry, so stop treating them as already confirmed
+        forget_known_user(user_to_ban)
+
+        # Let the user's open streams know that their roles (and so maybe their access) changed
+        event_bus.publish('roles_changed', {}, username=user_to_ban)
     except mariadb.Error as e:
         print(f"Error when banning user: {e}")
+        return make_response(jsonify({"message": "Error when banning user"}), 500)
     finally:
         # Close the database connection
         conn.close()
@@ -164,6 +205,7 @@ def create_banned_user():
     return make_response(jsonify({"message": f"Suuccess: '{user_to_ban}' is now banned."}), 201)
 
 @app.route("/api/admins")
+@conditional_get(lambda: get_roles_version(), lambda: user_has_role('isAdmin'))
 def get_admins():
     '''Get the list of admins.'''
 
@@ -201,6 +243,7 @@ def get_admins():
     return make_response(jsonify({"admins": admins}), 200)
 
 @app.route("/api/ccsga_reps")
+@conditional_get(lambda: get_roles_version(), lambda: user_has_role('isAdmin'))
 def get_ccsga_reps():
     '''Get the list of CCSGA representatives.'''
 
@@ -238,6 +281,7 @@ def get_ccsga_reps():
     return make_response(jsonify({"ccsgaReps": reps}), 200)
 
 @app.route("/api/banned_users")
+@conditional_get(lambda: get_roles_version(), lambda: user_has_role('isAdmin'))
 def get_banned_users():
     '''Get the list of banned users.'''
 
@@ -306,10 +350,17 @@ def remove_admin(admin_to_remove):
         if proc_result == -404:
             return make_response(jsonify({"message": f"'{admin_to_remove}' is already not an admin."}), 404)
         
-        # Commit database changes
+        # Commit database changes (remove_admin has already revoked whatever access the user's remaining roles don't grant)
         conn.commit()
+
+        # The procedure changed this user's Users entry, so stop treating them as already confirmed
+        forget_known_user(admin_to_remove)
+
+        # Let the user's open streams know that their roles (and so maybe their access) changed
+        event_bus.publish('roles_changed', {}, username=admin_to_remove)
     except mariadb.Error as e:
         print(f"Error when removing admin: {e}")
+        return make_response(jsonify({"message": "Error when removing admin"}), 500)
     finally:
         # Close the database connection
         conn.close()
@@ -345,10 +396,17 @@ def remove_ccsga_rep(rep_to_remove):
         if proc_result == -404:
             return make_response(jsonify({"message": f"'{rep_to_remove}' is already not a CCSGA rep."}), 404)
         
-        # Commit database changes
+        # Commit database changes (remove_ccsga has already revoked whatever access the user's remaining roles don't grant)
         conn.commit()
+
+        # The procedure changed this user's Users entry, so stop treating them as already confirmed
+        forget_known_user(rep_to_remove)
+
+        # Let the user's open streams know that their roles (and so maybe their access) changed
+        event_bus.publish('roles_changed', {}, username=rep_to_remove)
     except mariadb.Error as e:
         print(f"Error when removing rep: {e}")
+        return make_response(jsonify({"message": "Error when removing rep"}), 500)
     finally:
         # Close the database connection
         conn.close()
@@ -385,10 +443,17 @@ def unban_user(user_to_unban):
         if proc_result == -404:
             return make_response(jsonify({"message": f"'{user_to_unban}' is already not banned."}), 404)
 
-        # Commit database changes
+        # Commit database changes (remove_ban has already restored the user's access to the conversations they initiated)
         conn.commit()
+
+        # The procedure changed this user's Users entry, so stop treating them as already confirmed
+        forget_known_user(user_to_unban)
+
+        # Let the user's open streams know that their roles (and so maybe their access) changed
+        event_bus.publish('roles_changed', {}, username=user_to_unban)
     except mariadb.Error as e:
         print(f"Error when removing ban: {e}")
+        return make_response(jsonify({"message": "Error when removing ban"}), 500)
     finally:
         # Close the database connection
         conn.close()
@@ -398,3 +463,36 @@ def unban_user(user_to_unban):
 
 
 
+
+@app.route("/api/jobs/<job_id>")
+def get_job_status(job_id):
+    '''Get the status of a background job (e.g., one queued by a role change). Only admins may check on jobs.'''
+
+    # prevent non-signed in users from accessing
+    if flask.session.get('CAS_USERNAME') == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Only admins queue jobs, so only admins may see them
+    if not user_has_role('isAdmin'):
+        return make_response(jsonify({"message": "User is not an admin, so this request is not allowed."}), 403)
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    job = None
+    try:
+        job = get_job(cur, job_id)
+    except mariadb.Error as e:
+        print(f"Error when getting job status: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+
+    # Respond appropriately if there is no such job
+    if job == None:
+        return make_response(jsonify({"message": f"Job #{job_id} not found"}), 404)
+
+    # Respond with the job's status
+    return make_response(jsonify(job), 200)
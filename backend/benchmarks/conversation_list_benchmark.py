@@ -0,0 +1,109 @@
+# NOTE: In order to run this benchmark, make sure you've provided the necessary values in backend/.env
+# It seeds synthetic users and conversations directly into the configured database (and removes them afterward),
+# so point it at a development database, not the production one.
+
+import sys
+import time
+sys.path.append('..')
+try:
+    from database_handler import get_conn_and_cursor
+except ModuleNotFoundError:
+    print("Make sure you're actually in the benchmarks directory when you run this program.")
+    exit(1)
+
+BENCH_STUDENT_USERNAME = 'bench_student'
+BENCH_REP_USERNAME = 'bench_rep'
+MESSAGES_PER_CONVERSATION = 5
+LABELS_PER_CONVERSATION = 2
+CONVERSATION_COUNTS = [10, 100, 1000]
+REPETITIONS = 5
+
+def seed_users(conn, cur):
+    '''Create the benchmark student and the benchmark rep, if they don't already exist.'''
+
+    cur.executemany("INSERT IGNORE INTO Users (username, displayName, isBanned, isCCSGA, isAdmin, rolesLastUpdated) VALUES (?, ?, 0, ?, 0, UTC_TIMESTAMP());", [(BENCH_STUDENT_USERNAME, "Benchmark Student", 0), (BENCH_REP_USERNAME, "Benchmark Rep", 1)])
+    conn.commit()
+
+def seed_conversations(conn, cur, num_conversations):
+    '''Create num_conversations conversations between the benchmark student and the benchmark rep, and return their IDs.'''
+
+    conv_ids = []
+    for i in range(num_conversations):
+        cur.execute("INSERT INTO Conversations (status) VALUES ('Delivered');")
+        conv_id = cur.lastrowid
+        conv_ids.append(conv_id)
+        cur.executemany("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, ?, ?, 1);", [(conv_id, BENCH_STUDENT_USERNAME, i % 2, 1), (conv_id, BENCH_REP_USERNAME, 1, 0)])
+        for j in range(MESSAGES_PER_CONVERSATION):
+            sender = BENCH_STUDENT_USERNAME if j % 2 == 0 else BENCH_REP_USERNAME
+            cur.execute("INSERT INTO Messages (conversationId, sender, body, dateandtime) VALUES (?, ?, ?, UTC_TIMESTAMP());", (conv_id, sender, f"Benchmark message {j} in conversation {i}"))
+            cur.execute("UPDATE ConversationSettings SET lastReadMessageId = ? WHERE conversationId = ? AND username = ?;", (cur.lastrowid, conv_id, sender))
+        for k in range(LABELS_PER_CONVERSATION):
+            cur.execute("INSERT IGNORE INTO Labels (body) VALUES (?);", (f"bench label {k}",))
+            cur.execute("INSERT INTO AppliedLabels (conversationId, labelId) SELECT ?, id FROM Labels WHERE body = ?;", (conv_id, f"bench label {k}"))
+    conn.commit()
+    return conv_ids
+
+def fetch_with_per_conversation_loop(cur, username):
+    '''The previous retrieval path: one get_conversation call (seven result sets) per accessible conversation. Return the number of procedure calls made.'''
+
+    cur.callproc("get_conversation_ids", (username,))
+    conv_ids = [row[0] for row in cur.fetchall()]
+    cur.nextset()
+    for conv_id in conv_ids:
+        cur.callproc("get_conversation", (conv_id, username, 0, None, None))
+        cur.fetchall()
+        while cur.nextset():
+            cur.fetchall()
+    return len(conv_ids) + 1
+
+def fetch_with_batched_procedure(cur, username):
+    '''The set-based retrieval path: a single get_conversations call. Return the number of procedure calls made.'''
+
+    cur.callproc("get_conversations", (username, 0, None, None))
+    cur.fetchall()
+    while cur.nextset():
+        cur.fetchall()
+    return 1
+
+def time_fetch(fetch_function, cur, username):
+    '''Return the best wall-clock time (in milliseconds) over several repetitions, along with the number of procedure calls made.'''
+
+    best = None
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        num_calls = fetch_function(cur, username)
+        elapsed = 1000 * (time.perf_counter() - start)
+        best = elapsed if best == None else min(best, elapsed)
+    return best, num_calls
+
+def clean_up(conn, cur, conv_ids):
+    '''Remove everything created by the benchmark.'''
+
+    for conv_id in conv_ids:
+        cur.execute("DELETE FROM Messages WHERE conversationId = ?;", (conv_id,))
+        cur.execute("DELETE FROM AppliedLabels WHERE conversationId = ?;", (conv_id,))
+        cur.execute("DELETE FROM ConversationSettings WHERE conversationId = ?;", (conv_id,))
+        cur.execute("DELETE FROM Conversations WHERE id = ?;", (conv_id,))
+    cur.execute("DELETE FROM Users WHERE username IN (?, ?);", (BENCH_STUDENT_USERNAME, BENCH_REP_USERNAME))
+    conn.commit()
+
+if __name__ == "__main__":
+
+    conn, cur = get_conn_and_cursor()
+    conv_ids = []
+
+    try:
+        seed_users(conn, cur)
+
+        print(f"{'conversations':>14} | {'loop (ms)':>10} | {'loop calls':>10} | {'batched (ms)':>12} | {'batched calls':>13} | {'batched ms/conv':>15}")
+        for num_conversations in CONVERSATION_COUNTS:
+            
+            # Top the seeded data up to the desired number of conversations
+            conv_ids += seed_conversations(conn, cur, num_conversations - len(conv_ids))
+
+            loop_ms, loop_calls = time_fetch(fetch_with_per_conversation_loop, cur, BENCH_REP_USERNAME)
+            batched_ms, batched_calls = time_fetch(fetch_with_batched_procedure, cur, BENCH_REP_USERNAME)
+            print(f"{num_conversations:>14} | {loop_ms:>10.1f} | {loop_calls:>10} | {batched_ms:>12.1f} | {batched_calls:>13} | {batched_ms / num_conversations:>15.3f}")
+    finally:
+        clean_up(conn, cur, conv_ids)
+        conn.close()
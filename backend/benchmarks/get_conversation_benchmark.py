@@ -0,0 +1,111 @@
+# NOTE: In order to run this benchmark, make sure you've provided the necessary values in backend/.env and brought the database up to date (python3 migrations.py).
+# It seeds synthetic users and conversations directly into the configured database (and removes them afterward),
+# so point it at a development database, not the production one.
+#
+# It compares the current get_conversation procedure, which reads a thread's messages in a single pass and the conversation's flags in a single query,
+# with the previous version, which read the messages twice (once for senders who had revealed their identities and once for those who hadn't) and merged them with a UNION,
+# followed by one query per flag. The previous version is temporarily created as bench_get_conversation_with_union.
+
+import sys
+import time
+from conversation_list_benchmark import seed_users, clean_up, BENCH_STUDENT_USERNAME, BENCH_REP_USERNAME
+sys.path.append('..')
+try:
+    from database_handler import get_conn_and_cursor
+except ModuleNotFoundError:
+    print("Make sure you're actually in the benchmarks directory when you run this program.")
+    exit(1)
+
+THREAD_LENGTHS = [10, 1000, 100000]
+PAGE_SIZE = 50
+REPETITIONS = 5
+INSERT_BATCH_SIZE = 10000
+
+# The UNION version of get_conversation, as it was before the single-pass rewrite
+OLD_GET_CONVERSATION = '''CREATE OR REPLACE PROCEDURE bench_get_conversation_with_union (IN requestedConversationId INT, IN requester VARCHAR(40), IN anonymityOverrideRequested BOOL, IN afterMessageId INT, IN messageLimit INT)
+    BEGIN
+        DECLARE pageSize BIGINT UNSIGNED DEFAULT COALESCE(messageLimit + 1, 18446744073709551615);
+        DECLARE readUpTo INT DEFAULT 0;
+        IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+            SELECT -403;
+        ELSEIF NOT EXISTS (SELECT id FROM Conversations WHERE id = requestedConversationId) THEN
+            SELECT -404;
+        ELSEIF EXISTS (SELECT username FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId AND isAccessible) OR EXISTS (SELECT username FROM Users WHERE username = requester AND (isCCSGA OR isAdmin)) THEN
+            SELECT COALESCE(
+                    (SELECT lastReadMessageId FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId),
+                    (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = requestedConversationId AND Messages.dateandtime <= (SELECT rolesLastUpdated FROM Users WHERE username = requester)),
+                    0) INTO readUpTo;
+            IF anonymityOverrideRequested AND EXISTS (SELECT username FROM Users WHERE username=requester AND isAdmin) THEN
+                SELECT Messages.id, Users.username, Users.displayName, Messages.body, Messages.dateandtime, Messages.id <= readUpTo FROM Messages JOIN Users ON Messages.sender = Users.username WHERE Messages.conversationId = requestedConversationId AND Messages.id > COALESCE(afterMessageId, 0) ORDER BY Messages.id LIMIT pageSize;
+            ELSE
+                (SELECT Messages.id, Users.username, Users.displayName, Messages.body, Messages.dateandtime, Messages.id <= readUpTo FROM ((Messages JOIN Users ON Messages.sender = Users.username) JOIN ConversationSettings ON ConversationSettings.username = Messages.sender AND ConversationSettings.conversationId = requestedConversationId) WHERE Messages.conversationId = requestedConversationId AND Messages.id > COALESCE(afterMessageId, 0) AND (ConversationSettings.identityRevealed OR Messages.sender = requester) ORDER BY Messages.id LIMIT pageSize)
+                UNION (SELECT Messages.id, "anonymous", "Anonymous", Messages.body, Messages.dateandtime, Messages.id <= readUpTo FROM (Messages JOIN ConversationSettings ON ConversationSettings.username = Messages.sender AND ConversationSettings.conversationId = requestedConversationId) WHERE Messages.conversationId = requestedConversationId AND Messages.id > COALESCE(afterMessageId, 0) AND NOT (ConversationSettings.identityRevealed OR Messages.sender = requester) ORDER BY Messages.id LIMIT pageSize)
+                ORDER BY 1 LIMIT pageSize;
+            END IF;
+        
+            SELECT status FROM Conversations WHERE id = requestedConversationId;
+            SELECT body FROM Labels JOIN AppliedLabels ON Labels.id = AppliedLabels.labelId WHERE AppliedLabels.conversationId = requestedConversationId;
+            SELECT COALESCE((SELECT isArchived FROM ConversationSettings WHERE ConversationSettings.conversationId = requestedConversationId AND ConversationSettings.username = requester), 0);
+            SELECT NOT EXISTS (SELECT ConversationSettings.id from ConversationSettings WHERE ConversationSettings.conversationId = requestedConversationId AND NOT identityRevealed);
+            SELECT COALESCE((SELECT identityRevealed FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId), 1);
+            SELECT NOT EXISTS (SELECT Messages.id FROM Messages WHERE Messages.conversationId = requestedConversationId AND Messages.id > readUpTo);
+        ELSE
+            SELECT -403;
+        END IF;
+    END ;
+'''
+
+def seed_thread(conn, cur, num_messages):
+    '''Create a conversation between the benchmark student (anonymous) and the benchmark rep with num_messages messages alternating between them, and return its ID.'''
+
+    cur.execute("INSERT INTO Conversations (status) VALUES ('Delivered');")
+    conv_id = cur.lastrowid
+    cur.executemany("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, ?, ?, 1);", [(conv_id, BENCH_STUDENT_USERNAME, 0, 1), (conv_id, BENCH_REP_USERNAME, 1, 0)])
+    for batch_start in range(0, num_messages, INSERT_BATCH_SIZE):
+        batch = range(batch_start, min(batch_start + INSERT_BATCH_SIZE, num_messages))
+        cur.executemany("INSERT INTO Messages (conversationId, sender, body, dateandtime) VALUES (?, ?, ?, UTC_TIMESTAMP());", [(conv_id, BENCH_STUDENT_USERNAME if j % 2 == 0 else BENCH_REP_USERNAME, f"Benchmark message {j}") for j in batch])
+        conn.commit()
+
+    # The rep has read the first half of the thread
+    cur.execute("UPDATE ConversationSettings SET lastReadMessageId = (SELECT Messages.id FROM Messages WHERE conversationId = ? ORDER BY id LIMIT 1 OFFSET ?) WHERE conversationId = ? AND username = ?;", (conv_id, num_messages // 2, conv_id, BENCH_REP_USERNAME))
+    conn.commit()
+    return conv_id
+
+def time_procedure(cur, procedure, conv_id, limit):
+    '''Return the best wall-clock time (in milliseconds) over several repetitions of calling the procedure as the benchmark rep and reading every result set, along with the number of result sets.'''
+
+    best = None
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        cur.callproc(procedure, (conv_id, BENCH_REP_USERNAME, 0, None, limit))
+        cur.fetchall()
+        num_result_sets = 1
+        while cur.nextset():
+            cur.fetchall()
+            num_result_sets += 1
+        elapsed = 1000 * (time.perf_counter() - start)
+        best = elapsed if best == None else min(best, elapsed)
+    return best, num_result_sets
+
+if __name__ == "__main__":
+
+    conn, cur = get_conn_and_cursor()
+    conv_ids = []
+
+    try:
+        seed_users(conn, cur)
+        cur.execute(OLD_GET_CONVERSATION)
+
+        print(f"{'messages':>9} | {'page':>6} | {'union (ms)':>10} | {'union sets':>10} | {'single pass (ms)':>16} | {'single pass sets':>16} | {'speedup':>7}")
+        for num_messages in THREAD_LENGTHS:
+            conv_ids.append(seed_thread(conn, cur, num_messages))
+            cur.execute("ANALYZE TABLE Messages, ConversationSettings;")
+            cur.fetchall()
+            for limit in (None, PAGE_SIZE):
+                old_ms, old_sets = time_procedure(cur, "bench_get_conversation_with_union", conv_ids[-1], limit)
+                new_ms, new_sets = time_procedure(cur, "get_conversation", conv_ids[-1], limit)
+                print(f"{num_messages:>9} | {'all' if limit == None else limit:>6} | {old_ms:>10.1f} | {old_sets:>10} | {new_ms:>16.1f} | {new_sets:>16} | {old_ms / new_ms:>6.1f}x")
+    finally:
+        cur.execute("DROP PROCEDURE IF EXISTS bench_get_conversation_with_union;")
+        clean_up(conn, cur, conv_ids)
+        conn.close()
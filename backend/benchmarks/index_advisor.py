@@ -0,0 +1,228 @@
+# NOTE: In order to run the index advisor, make sure you've provided the necessary values in backend/.env and brought the database up to date (python3 migrations.py).
+# It seeds synthetic users and conversations directly into the configured database (and removes them afterward),
+# so point it at a development database, not the production one.
+#
+# Usage: python3 index_advisor.py [number of conversations to seed]
+#
+# For every stored procedure in the database, it runs EXPLAIN on each of the procedure's queries (including the ones in IF/ELSEIF conditions),
+# once as the benchmark rep and once as the benchmark student, and reports every full table scan and full index scan on a real table.
+# Parameters and local variables are replaced with sample values (see sample_value), and statements that populate temporary tables are actually run so that later queries can use them.
+# The optimizer may reasonably choose to scan a table with only a handful of rows (e.g., Users or Labels in a development database), so check the row estimates before adding an index in a new migration (see migrations.py).
+# Exits with status 1 if any unexpected scans were found.
+
+import re
+import sys
+from conversation_list_benchmark import seed_users, seed_conversations, clean_up, BENCH_STUDENT_USERNAME, BENCH_REP_USERNAME
+sys.path.append('..')
+try:
+    import mariadb
+    from database_handler import get_conn_and_cursor
+except ModuleNotFoundError:
+    print("Make sure you're actually in the benchmarks directory when you run this program.")
+    exit(1)
+
+DEFAULT_NUM_CONVERSATIONS = 500
+
+# Scans that are intentional, as (procedure, table): reps and admins can see every conversation, so their branches of these procedures read all of Conversations
+EXPECTED_SCANS = {
+    ("get_conversation_ids", "Conversations"),
+    ("get_conversations", "Conversations"),
+    ("get_conversation_changes", "Conversations"),
+    ("get_conversation_summaries", "Conversations"),
+    ("get_conversation_facets", "Conversations"),
+    ("get_conversations_version", "Conversations")
+}
+
+# Statements that neither read tables nor can be explained on their own
+SKIPPED_KEYWORDS = ("SET", "DECLARE", "CALL", "SIGNAL", "RESIGNAL", "LEAVE", "ITERATE", "RETURN", "START", "COMMIT", "ROLLBACK")
+
+def split_statements(body):
+    '''Split a procedure body into its statements at the semicolons that aren't inside quotes, after removing comments (all three kinds, since an apostrophe in a comment would otherwise look like the start of a string).'''
+
+    body = re.sub(r"--[^\n]*|#[^\n]*|/\*.*?\*/", " ", body, flags=re.DOTALL)
+    statements = []
+    current = ""
+    quote = None
+    for char in body:
+        if quote != None:
+            if char == quote:
+                quote = None
+        elif char in ("'", '"', '`'):
+            quote = char
+        elif char == ";":
+            statements.append(" ".join(current.split()))
+            current = ""
+            continue
+        current += char
+    statements.append(" ".join(current.split()))
+    return [statement for statement in statements if statement]
+
+def extract_queries(statement):
+    '''Strip the control flow keywords from the start of a statement, and return a list of the queries it contains (a condition becomes a SELECT of that condition).'''
+
+    queries = []
+    while True:
+        control = re.match(r"(BEGIN|END(\s+(IF|WHILE|LOOP|REPEAT))?|ELSE)(\s+|$)", statement, re.IGNORECASE)
+        condition = re.match(r"(IF|ELSEIF|WHILE)\s+(.+?)\s+(THEN|DO)(\s+|$)", statement, re.IGNORECASE | re.DOTALL)
+        if condition != None:
+            queries.append(f"SELECT {condition.group(2)}")
+            statement = statement[condition.end():]
+        elif control != None:
+            statement = statement[control.end():]
+        else:
+            break
+    if statement:
+        queries.append(statement)
+    return queries
+
+def sample_value(name, data_type, username, conversation_id):
+    '''Return a plausible value for a procedure parameter or local variable, based on its name and type.'''
+
+    lowered = name.lower()
+    data_type = data_type.lower()
+    if "conversationid" in lowered and "after" not in lowered:
+        return conversation_id
+    if data_type in ("varchar", "char", "text"):
+        if "label" in lowered:
+            return "bench label 0"
+        if "status" in lowered:
+            return "Delivered"
+        if "body" in lowered:
+            return "Index advisor message"
+        return username
+    if data_type == "decimal":
+        return 1 # e.g., a changedSince timestamp long in the past
+    if data_type in ("datetime", "timestamp"):
+        return "1970-01-02 00:00:00"
+    if "limit" in lowered:
+        return 20
+    return 0
+
+def get_procedures(cur):
+    '''Return a list of (name, body, [(parameter name, data type)]) for every stored procedure in the database.'''
+
+    cur.execute("SELECT ROUTINE_NAME, ROUTINE_DEFINITION FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = DATABASE() AND ROUTINE_TYPE = 'PROCEDURE' ORDER BY ROUTINE_NAME;")
+    routines = cur.fetchall()
+    procedures = []
+    for name, body in routines:
+        cur.execute("SELECT PARAMETER_NAME, DATA_TYPE FROM information_schema.PARAMETERS WHERE SPECIFIC_SCHEMA = DATABASE() AND SPECIFIC_NAME = ? AND PARAMETER_NAME IS NOT NULL ORDER BY ORDINAL_POSITION;", (name,))
+        procedures.append((name, body, cur.fetchall()))
+    return procedures
+
+def explain_procedure(conn, cur, name, body, parameters, username, conversation_id):
+    '''EXPLAIN every query in the procedure with sample values, and return a tuple of (list of (query, table, scan type, estimated rows), list of (query, error) for the queries that couldn't be explained).'''
+
+    scans = []
+    skipped = []
+    values = {} # The sample value of each parameter and local variable, which is also stored in a user variable of the same name
+    temporary_tables = set()
+
+    def set_value(variable_name, expression, arguments=()):
+        cur.execute(f"SET @{variable_name} = {expression};", arguments)
+        cur.execute(f"SELECT @{variable_name};")
+        values[variable_name] = cur.fetchone()[0]
+
+    def substitute(query):
+        '''Replace the procedure's parameters and local variables with the corresponding user variables (but not columns of the same name qualified by a table name).
+        LIMIT doesn't accept user variables, so variables in LIMIT clauses are replaced with their values instead.'''
+        for variable_name, value in values.items():
+            query = re.sub(rf"\bLIMIT\s+{variable_name}(?!\w)", f"LIMIT {int(value or 0)}", query, flags=re.IGNORECASE)
+            query = re.sub(rf"(?<![.@\w]){variable_name}(?!\w)", f"@{variable_name}", query)
+        return query
+
+    # Give the parameters sample values
+    for parameter_name, data_type in parameters:
+        set_value(parameter_name, "?", (sample_value(parameter_name, data_type, username, conversation_id),))
+
+    for statement in split_statements(body):
+        for query in extract_queries(statement):
+            keyword = query.split()[0].upper()
+
+            # Give local variables their default values (or sample values, if they don't have defaults)
+            if keyword == "DECLARE":
+                declaration = re.match(r"DECLARE\s+(\w+(?:\s*,\s*\w+)*)\s+(\w+)(?:\s*\([^)]*\))?(?:\s+UNSIGNED)?(?:\s+DEFAULT\s+(.+))?$", query, re.IGNORECASE | re.DOTALL)
+                if declaration == None:
+                    continue
+                for variable_name in re.split(r"\s*,\s*", declaration.group(1)):
+                    try:
+                        if declaration.group(3) != None:
+                            set_value(variable_name, substitute(declaration.group(3)))
+                        else:
+                            set_value(variable_name, "?", (sample_value(variable_name, declaration.group(2), username, conversation_id),))
+                    except mariadb.Error as e:
+                        skipped.append((query, str(e)))
+                        values[variable_name] = None
+                continue
+            if keyword in SKIPPED_KEYWORDS:
+                continue
+            query = substitute(query)
+
+            # Create, populate and drop temporary tables for real, so that the queries that use them can be explained
+            temporary_table = re.match(r"(?:CREATE(?:\s+OR\s+REPLACE)?|DROP)\s+TEMPORARY\s+TABLE\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", query, re.IGNORECASE)
+            if temporary_table != None:
+                temporary_tables.add(temporary_table.group(1))
+                try:
+                    cur.execute(query)
+                except mariadb.Error as e:
+                    skipped.append((query, str(e)))
+                continue
+            insert_target = re.match(r"INSERT\s+(?:IGNORE\s+)?INTO\s+(\w+)", query, re.IGNORECASE)
+            if insert_target != None and "SELECT" not in query.upper():
+                continue # INSERT ... VALUES doesn't read any tables
+            if insert_target != None and insert_target.group(1) in temporary_tables:
+                try:
+                    cur.execute(query)
+                except mariadb.Error as e:
+                    skipped.append((query, str(e)))
+
+            # Explain the query (without SELECT ... INTO, which EXPLAIN doesn't accept)
+            if keyword == "SELECT":
+                query = re.sub(r"\s+INTO\s+@\w+(\s*,\s*@\w+)*", "", query, flags=re.IGNORECASE)
+            try:
+                cur.execute(f"EXPLAIN {query}")
+                columns = [column[0] for column in cur.description]
+                rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+            except mariadb.Error as e:
+                skipped.append((query, str(e)))
+                continue
+            for row in rows:
+                table = row["table"]
+                if row["type"] in ("ALL", "index") and table != None and not table.startswith("<") and table not in temporary_tables:
+                    scans.append((query, table, row["type"], row["rows"]))
+
+    # Don't leave any temporary tables behind for the next procedure
+    for temporary_table in temporary_tables:
+        cur.execute(f"DROP TEMPORARY TABLE IF EXISTS {temporary_table};")
+    conn.rollback()
+    return scans, skipped
+
+if __name__ == "__main__":
+
+    num_conversations = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUM_CONVERSATIONS
+    conn, cur = get_conn_and_cursor()
+    conv_ids = []
+    num_unexpected = 0
+
+    try:
+        seed_users(conn, cur)
+        conv_ids = seed_conversations(conn, cur, num_conversations)
+        cur.execute("ANALYZE TABLE Users, Conversations, ConversationSettings, Messages, Labels, AppliedLabels;")
+        cur.fetchall()
+
+        for name, body, parameters in get_procedures(cur):
+            for username in (BENCH_REP_USERNAME, BENCH_STUDENT_USERNAME):
+                scans, skipped = explain_procedure(conn, cur, name, body, parameters, username, conv_ids[0])
+                for query, table, scan_type, estimated_rows in scans:
+                    expected = (name, table) in EXPECTED_SCANS
+                    if not expected:
+                        num_unexpected += 1
+                    print(f"{'expected' if expected else 'SCAN':>8} | {name} as {username} | {table} ({'full table' if scan_type == 'ALL' else 'full index'} scan, ~{estimated_rows} rows) | {query[:120]}")
+                for query, error in skipped:
+                    print(f"{'skipped':>8} | {name} as {username} | {error} | {query[:120]}")
+
+        print(f"{num_unexpected} unexpected scan(s) found with {num_conversations} seeded conversations")
+    finally:
+        clean_up(conn, cur, conv_ids)
+        conn.close()
+
+    exit(1 if num_unexpected > 0 else 0)
@@ -0,0 +1,119 @@
+# NOTE: In order to run this benchmark, make sure you've provided the necessary values in backend/.env and brought the database up to date (python3 migrations.py).
+# It seeds synthetic users and conversations directly into the configured database (and removes them afterward),
+# so point it at a development database, not the production one. Seeding the default corpus of a million messages takes a few minutes.
+#
+# Usage: python3 search_benchmark.py [number of messages to seed]
+#
+# It times a page of results from the search_conversations procedure (which uses the full-text indexes) as the benchmark rep, who can search every conversation,
+# and as the benchmark student, who can only search their own, for words of different frequencies.
+# For comparison, it also times finding the matching conversations with a LIKE scan of every message, which is roughly what searching without the index costs.
+
+import random
+import sys
+import time
+from conversation_list_benchmark import seed_users, clean_up, BENCH_STUDENT_USERNAME, BENCH_REP_USERNAME
+sys.path.append('..')
+try:
+    from database_handler import get_conn_and_cursor
+except ModuleNotFoundError:
+    print("Make sure you're actually in the benchmarks directory when you run this program.")
+    exit(1)
+
+DEFAULT_NUM_MESSAGES = 1000000
+MESSAGES_PER_CONVERSATION = 100
+STUDENT_CONVERSATION_EVERY = 10 # The benchmark student initiated every 10th conversation
+WORDS_PER_MESSAGE = (8, 20)
+LABELS = ["bench label 0", "bench label 1"]
+PAGE_SIZE = 20
+REPETITIONS = 5
+INSERT_BATCH_SIZE = 10000
+
+# Words for the synthetic message bodies; earlier words are used far more often than later ones (roughly following Zipf's law, like real text)
+VOCABULARY = ["housing", "dining", "parking", "tuition", "library", "laundry", "shuttle", "heating", "elevator", "printer",
+    "roommate", "schedule", "advising", "registrar", "counseling", "gymnasium", "tickets", "budget", "election", "senate",
+    "committee", "funding", "club", "event", "policy", "complaint", "noise", "mold", "security", "lighting",
+    "sidewalk", "bicycle", "recycling", "compost", "vending", "mailroom", "orientation", "transcript", "internship", "scholarship"]
+WORD_WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+# Queries to time: the most common word, a word in the middle, the rarest word, and two words at once
+QUERIES = [VOCABULARY[0], VOCABULARY[len(VOCABULARY) // 2], VOCABULARY[-1], f"{VOCABULARY[5]} {VOCABULARY[-2]}"]
+
+def seed_corpus(conn, cur, num_messages):
+    '''Create conversations of MESSAGES_PER_CONVERSATION synthetic messages each (num_messages in total), and return their IDs.
+    The benchmark student initiated every STUDENT_CONVERSATION_EVERY-th conversation; the benchmark rep can access all of them because of their role.'''
+
+    rng = random.Random(0)
+    conv_ids = []
+    num_conversations = max(num_messages // MESSAGES_PER_CONVERSATION, 1)
+    messages = []
+    for i in range(num_conversations):
+        cur.execute("INSERT INTO Conversations (status) VALUES ('Delivered');")
+        conv_id = cur.lastrowid
+        conv_ids.append(conv_id)
+        if i % STUDENT_CONVERSATION_EVERY == 0:
+            cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 0, 1, 1);", (conv_id, BENCH_STUDENT_USERNAME))
+        cur.execute("INSERT INTO AppliedLabels (conversationId, labelId) SELECT ?, id FROM Labels WHERE body = ?;", (conv_id, LABELS[i % len(LABELS)]))
+        for j in range(MESSAGES_PER_CONVERSATION):
+            body = " ".join(rng.choices(VOCABULARY, weights=WORD_WEIGHTS, k=rng.randint(*WORDS_PER_MESSAGE)))
+            messages.append((conv_id, BENCH_STUDENT_USERNAME if j % 2 == 0 else BENCH_REP_USERNAME, body))
+
+        # Insert the messages in large batches, committing after each one
+        if len(messages) >= INSERT_BATCH_SIZE or i == num_conversations - 1:
+            cur.executemany("INSERT INTO Messages (conversationId, sender, body, dateandtime) VALUES (?, ?, ?, UTC_TIMESTAMP());", messages)
+            conn.commit()
+            messages = []
+    return conv_ids
+
+def time_search(cur, username, query):
+    '''Return the best wall-clock time (in milliseconds) over several repetitions of getting the first page of search results as the specified user, along with the number of results on that page.'''
+
+    best = None
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        cur.callproc("search_conversations", (username, query, 0, None, None, PAGE_SIZE))
+        num_results = len(cur.fetchall())
+        while cur.nextset():
+            cur.fetchall()
+        elapsed = 1000 * (time.perf_counter() - start)
+        best = elapsed if best == None else min(best, elapsed)
+    return best, min(num_results, PAGE_SIZE)
+
+def time_like_scan(cur, query):
+    '''Return the best wall-clock time (in milliseconds) over several repetitions of finding the conversations with a message containing any word of the query (as natural language full-text search does) with LIKE, along with the number of conversations found.'''
+
+    conditions = " OR ".join("body LIKE ?" for _ in query.split())
+    best = None
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        cur.execute(f"SELECT DISTINCT conversationId FROM Messages WHERE {conditions};", tuple(f"%{word}%" for word in query.split()))
+        num_conversations = len(cur.fetchall())
+        elapsed = 1000 * (time.perf_counter() - start)
+        best = elapsed if best == None else min(best, elapsed)
+    return best, num_conversations
+
+if __name__ == "__main__":
+
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUM_MESSAGES
+    conn, cur = get_conn_and_cursor()
+    conv_ids = []
+
+    try:
+        seed_users(conn, cur)
+        cur.executemany("INSERT IGNORE INTO Labels (body) VALUES (?);", [(label,) for label in LABELS])
+        conn.commit()
+
+        start = time.perf_counter()
+        conv_ids = seed_corpus(conn, cur, num_messages)
+        cur.execute("ANALYZE TABLE Messages, ConversationSettings, AppliedLabels;")
+        cur.fetchall()
+        print(f"Seeded {num_messages} messages in {len(conv_ids)} conversations in {time.perf_counter() - start:.0f} s")
+
+        print(f"{'query':>22} | {'rep (ms)':>8} | {'rep results':>11} | {'student (ms)':>12} | {'student results':>15} | {'LIKE scan (ms)':>14} | {'LIKE conversations':>18}")
+        for query in QUERIES:
+            rep_ms, rep_results = time_search(cur, BENCH_REP_USERNAME, query)
+            student_ms, student_results = time_search(cur, BENCH_STUDENT_USERNAME, query)
+            like_ms, like_conversations = time_like_scan(cur, query)
+            print(f"{query:>22} | {rep_ms:>8.1f} | {rep_results:>11} | {student_ms:>12.1f} | {student_results:>15} | {like_ms:>14.1f} | {like_conversations:>18}")
+    finally:
+        clean_up(conn, cur, conv_ids)
+        conn.close()
@@ -0,0 +1,100 @@
+# NOTE: This load test opens many idle connections to /api/conversations/stream on a running instance of the app (e.g., the gunicorn service or the flask dev server),
+# then posts one reply and measures how long it takes to reach every subscriber. Point it at a development instance, not the production one.
+#
+# Usage: python3 sse_load_test.py <base URL, e.g. https://localhost:8000> <value of a signed-in user's "session" cookie> <ID of a conversation that user can reply to> [number of subscribers]
+#
+# Each subscriber needs its own socket (and, under gunicorn's gthread worker, its own server thread), so you may need to raise the open file limit (ulimit -n) on both ends first.
+
+import asyncio
+import json
+import ssl
+import sys
+import time
+from urllib.parse import urlparse
+
+DEFAULT_NUM_SUBSCRIBERS = 2000
+CONNECT_CONCURRENCY = 200
+DELIVERY_TIMEOUT_SECONDS = 30
+
+async def open_stream(url, cookie):
+    '''Open an SSE connection to the stream route, and return its (reader, writer) once the response headers have been read.'''
+
+    ssl_context = None
+    if url.scheme == 'https':
+        # The development certificate is usually self-signed
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or (443 if url.scheme == 'https' else 80), ssl=ssl_context)
+    writer.write((f"GET /api/conversations/stream HTTP/1.1\r\nHost: {url.netloc}\r\nAccept: text/event-stream\r\nCookie: session={cookie}\r\n\r\n").encode())
+    await writer.drain()
+    status_line = await reader.readline()
+    if b" 200 " not in status_line:
+        raise RuntimeError(f"Unexpected response: {status_line.decode().strip()}")
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    return reader, writer
+
+async def wait_for_event(reader, event_type, message_id):
+    '''Read the stream until an event of the given type about the given message arrives, and return the time at which it did.'''
+
+    current_type = None
+    while True:
+        line = await reader.readline()
+        if line == b"":
+            raise RuntimeError("Stream closed")
+        line = line.decode().strip()
+        if line.startswith("event:"):
+            current_type = line[len("event:"):].strip()
+        elif line.startswith("data:") and current_type == event_type:
+            if json.loads(line[len("data:"):]).get("messageId") == message_id:
+                return time.perf_counter()
+
+def post_reply(url, cookie, conversation_id):
+    '''Post a reply to the conversation (blocking), and return the new message's ID.'''
+
+    import http.client
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    kwargs = {"context": ssl._create_unverified_context()} if url.scheme == 'https' else {}
+    connection = connection_class(url.hostname, url.port, **kwargs)
+    connection.request("POST", f"/api/conversations/{conversation_id}/messages/create", json.dumps({"messageBody": "SSE load test message"}), {"Content-Type": "application/json", "Cookie": f"session={cookie}"})
+    response = connection.getresponse()
+    body = json.loads(response.read())
+    connection.close()
+    return body["messageId"]
+
+async def main(base_url, cookie, conversation_id, num_subscribers):
+    url = urlparse(base_url)
+
+    # Open the subscribers' connections, a limited number at a time
+    semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    async def limited_open():
+        async with semaphore:
+            return await open_stream(url, cookie)
+    start = time.perf_counter()
+    results = await asyncio.gather(*[limited_open() for i in range(num_subscribers)], return_exceptions=True)
+    streams = [result for result in results if not isinstance(result, Exception)]
+    print(f"Opened {len(streams)} of {num_subscribers} streams in {time.perf_counter() - start:.2f}s ({num_subscribers - len(streams)} failed)")
+    if not streams:
+        return
+
+    # Post a reply, and time its delivery to every subscriber
+    loop = asyncio.get_running_loop()
+    sent_at = time.perf_counter()
+    message_id = await loop.run_in_executor(None, post_reply, url, cookie, conversation_id)
+    waits = [asyncio.wait_for(wait_for_event(reader, 'message_created', message_id), DELIVERY_TIMEOUT_SECONDS) for reader, writer in streams]
+    delivered = await asyncio.gather(*waits, return_exceptions=True)
+    latencies = sorted(received_at - sent_at for received_at in delivered if not isinstance(received_at, Exception))
+    print(f"Delivered message #{message_id} to {len(latencies)} of {len(streams)} subscribers")
+    if latencies:
+        print(f"Delivery latency: median {latencies[len(latencies) // 2] * 1000:.1f}ms, p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms")
+
+    # Close every stream
+    for reader, writer in streams:
+        writer.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python3 sse_load_test.py <base URL> <session cookie> <conversation ID> [number of subscribers]")
+        exit(1)
+    asyncio.run(main(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_NUM_SUBSCRIBERS))
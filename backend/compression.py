@@ -0,0 +1,84 @@
+import gzip
+import os
+import zlib
+from flask import request
+from backend import app
+
+# Compresses the app's responses with gzip or brotli, whichever the client prefers (according to its Accept-Encoding header).
+# Brotli is optional: if the brotli package isn't installed, responses are only ever compressed with gzip.
+# Static files from the Flutter build aren't compressed here; view_handler.static_proxy serves the copies that prepare_static.py compresses ahead of time instead.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this many bytes aren't worth compressing (optional; see .env_sample)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+
+# Compression levels for responses built on the fly, chosen for speed over size (prepare_static.py uses the highest levels for static files, since it only runs once per build)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/javascript", "text/html", "text/css", "text/plain"}
+
+def get_accepted_encodings():
+    '''Return the encodings this app can compress with, most preferred first.'''
+    return ["br", "gzip"] if brotli != None else ["gzip"]
+
+def compress(data, encoding):
+    '''Compress a complete response body with the specified encoding.'''
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+def compress_stream(chunks, encoding):
+    '''Compress a streamed response body chunk by chunk, flushing after each chunk so that the client receives each one as soon as it would have uncompressed.'''
+
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress_chunk = lambda chunk: compressor.process(chunk) + compressor.flush()
+        finish = compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # 16 + MAX_WBITS means gzip format
+        compress_chunk = lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+
+    try:
+        for chunk in chunks:
+            yield compress_chunk(chunk.encode() if isinstance(chunk, str) else chunk)
+        yield finish()
+    finally:
+        # Let the original generator clean up (e.g., close its database connection), even if the client disconnected partway through
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+@app.after_request
+def compress_response(resp):
+    '''Compress the response if the client accepts a supported encoding and the response is a large enough, compressible, successful response that isn't already encoded.'''
+
+    # Leave alone responses that can't or shouldn't be compressed (files sent with send_file, which include precompressed static files, are passed through directly)
+    if resp.status_code != 200 or resp.direct_passthrough or "Content-Encoding" in resp.headers or resp.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return resp
+
+    # The response depends on the client's Accept-Encoding header from here on, even if this one isn't compressed
+    resp.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(get_accepted_encodings())
+    if encoding == None:
+        return resp
+
+    # Compress streamed responses as they're generated, and other responses all at once (if they're large enough)
+    if resp.is_streamed:
+        resp.response = compress_stream(resp.response, encoding)
+        resp.headers.remove("Content-Length")
+    else:
+        data = resp.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return resp
+        resp.set_data(compress(data, encoding))
+    resp.headers.set("Content-Encoding", encoding)
+
+    # The compressed body is no longer byte-for-byte what a strong ETag (e.g., from conditional_get) promised, so weaken it (If-None-Match still matches weak ETags)
+    etag, is_weak = resp.get_etag()
+    if etag != None and not is_weak:
+        resp.set_etag(etag, weak=True)
+    return resp
@@ -1,63 +1,291 @@
 import mariadb
 import os
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 from datetime import datetime
-import re
 
 load_dotenv()
 
+def open_db_connection():
+    '''Connect to the database using the values specified in the environment, raising a mariadb.Error if the connection fails.
+    Used by the connection pool to open new physical connections.'''
+
+    return mariadb.connect(
+        user=os.getenv("DB_USERNAME"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_IP"),
+        database=os.getenv("DB_DBNAME"),
+        autocommit=False
+    )
+
 def get_new_db_connection():
     '''Connect to the database using the values specified in the environment. 
     Implemented as a function so that it can be called easily in other places that need a fresh connection to the database.
-    However, outside of this file, it is preferrable to call get_conn_and_cursor() instead.'''
+    However, outside of this file, it is preferrable to call get_conn_and_cursor() instead, which draws from the connection pool.'''
     
     try:
-        return mariadb.connect(
-            user=os.getenv("DB_USERNAME"),
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_IP"),
-            database=os.getenv("DB_DBNAME"),
-            autocommit=False
-        )
+        return open_db_connection()
     except mariadb.Error as e:
         print(f"Error connecting to MariaDB Platform: {e}")
 
+class PooledConnection:
+    '''Wrapper around a pooled MariaDB connection. Everything is passed through to the underlying connection,
+    except close(), which hands the connection back to the pool instead of closing it.'''
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = time.monotonic()
+        self._checked_out = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        '''Return this connection to the pool (any uncommitted changes are rolled back).'''
+        if self._checked_out:
+            self._pool.release(self)
+
+class ConnectionPool:
+    '''Thread-safe pool of MariaDB connections.
+    Keeps up to `size` idle connections open, allows up to `max_overflow` extra connections under load, 
+    and makes callers wait up to `timeout` seconds for a connection when all of them are in use.
+    Connections older than `recycle` seconds are replaced, and idle connections are pinged before being handed out if `pre_ping` is set.'''
+
+    def __init__(self, connect, size=5, max_overflow=10, timeout=30, recycle=3600, pre_ping=True):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+
+        self._idle = [] # Connections not currently checked out, most recently returned last
+        self._num_open = 0
+        self._num_in_use = 0
+        self._num_waiting = 0
+        self._lock = threading.Condition()
+
+        # Counters for pool stats
+        self._peak_in_use = 0
+        self._num_checkouts = 0
+        self._num_timeouts = 0
+        self._num_discarded = 0
+        self._total_checkout_latency = 0.0
+        self._max_checkout_latency = 0.0
+
+    def get_connection(self):
+        '''Check out a connection, opening a new one if none are idle and the pool isn't at capacity.
+        Raises mariadb.PoolError if no connection becomes available within the timeout.'''
+
+        start = time.monotonic()
+        deadline = start + self.timeout
+        pooled = None
+        
+        with self._lock:
+            while True:
+                
+                # Reuse an idle connection if there is one
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+
+                # Otherwise, open a new connection if the pool isn't at capacity (reserve the slot before connecting)
+                if self._num_open < self.size + self.max_overflow:
+                    self._num_open += 1
+                    break
+
+                # Otherwise, wait for another thread to release a connection
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._num_timeouts += 1
+                    raise mariadb.PoolError(f"Timed out after {self.timeout} seconds waiting for a database connection")
+                self._num_waiting += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._num_waiting -= 1
+
+        # Check the connection's health (outside of the lock, since this involves network round trips)
+        # If it isn't healthy, close it but keep its slot in the pool for the replacement opened below
+        if pooled is not None and not self._is_usable(pooled):
+            self._close_quietly(pooled)
+            with self._lock:
+                self._num_discarded += 1
+            pooled = None
+        if pooled is None:
+            try:
+                pooled = PooledConnection(self, self._connect())
+            except:
+                with self._lock:
+                    self._num_open -= 1
+                    self._lock.notify()
+                raise
+
+        # Record the checkout
+        latency = time.monotonic() - start
+        with self._lock:
+            pooled._checked_out = True
+            self._num_in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._num_in_use)
+            self._num_checkouts += 1
+            self._total_checkout_latency += latency
+            self._max_checkout_latency = max(self._max_checkout_latency, latency)
+        return pooled
+
+    def release(self, pooled):
+        '''Return a checked-out connection to the pool. Uncommitted changes are rolled back, 
+        and the connection is closed instead if it is broken or if the pool already has enough idle connections.'''
+
+        try:
+            pooled._conn.rollback()
+            healthy = True
+        except mariadb.Error: # e.g., unread results left on the connection, or the connection was lost
+            healthy = False
+
+        with self._lock:
+            pooled._checked_out = False
+            self._num_in_use -= 1
+            keep = healthy and len(self._idle) < self.size and not self._is_expired(pooled)
+            if keep:
+                self._idle.append(pooled)
+            self._lock.notify()
+        if not keep:
+            self._discard(pooled)
+
+    def stats(self):
+        '''Return a dictionary of statistics about the pool, for use in sizing it.'''
+
+        with self._lock:
+            return {
+                "size": self.size,
+                "maxOverflow": self.max_overflow,
+                "open": self._num_open,
+                "idle": len(self._idle),
+                "inUse": self._num_in_use,
+                "waiting": self._num_waiting,
+                "peakInUse": self._peak_in_use,
+                "checkouts": self._num_checkouts,
+                "timeouts": self._num_timeouts,
+                "discarded": self._num_discarded,
+                "avgCheckoutLatencyMs": 1000 * self._total_checkout_latency / self._num_checkouts if self._num_checkouts else 0.0,
+                "maxCheckoutLatencyMs": 1000 * self._max_checkout_latency
+            }
+
+    def _is_expired(self, pooled):
+        return self.recycle is not None and time.monotonic() - pooled._created_at > self.recycle
+
+    def _is_usable(self, pooled):
+        if self._is_expired(pooled):
+            return False
+        if self.pre_ping:
+            try:
+                pooled._conn.ping()
+            except mariadb.Error:
+                return False
+        return True
+
+    def _close_quietly(self, pooled):
+        try:
+            pooled._conn.close()
+        except mariadb.Error:
+            pass
+
+    def _discard(self, pooled):
+        self._close_quietly(pooled)
+        with self._lock:
+            self._num_open -= 1
+            self._num_discarded += 1
+            self._lock.notify()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    '''Get this process's connection pool, creating it (according to the DB_POOL_* values in the environment) if necessary.
+    Each process gets its own pool, so that gunicorn workers forked from the same parent never share connections.'''
+
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                open_db_connection,
+                size=int(os.getenv("DB_POOL_SIZE", 5)),
+                max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", 10)),
+                timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+                recycle=float(os.getenv("DB_POOL_RECYCLE", 3600)),
+                pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+def get_pool_stats():
+    '''Return statistics about this process's connection pool.'''
+
+    stats = get_pool().stats()
+    stats["pid"] = os.getpid()
+    return stats
+
 def get_conn_and_cursor():
-    '''Get a fresh MariaDB connection and a cursor from it.
+    '''Get a MariaDB connection from the connection pool and a cursor from it. Closing the connection returns it to the pool.
     This is the function that should generally be imported and called in other files.'''
     
     try:
-        conn = get_new_db_connection()
+        conn = get_pool().get_connection()
         cur = conn.cursor()
         return conn, cur
     except mariadb.Error as e:
         print(f"Error when getting new connection and cursor: {e}")
 
-def create_tables():
-    '''Create all the tables for the database that don't already exist, but don't update their structures if the details below have changed.'''
+class TTLCache:
+    '''Small thread-safe in-process cache whose entries expire `ttl` seconds after being set.
+    Once it holds `max_size` entries, the least recently used entry is evicted to make room for each new one.'''
 
-    conn, cur = get_conn_and_cursor()
-    try:
-        cur.execute("CREATE TABLE IF NOT EXISTS Users (username VARCHAR(40), displayName VARCHAR(100), isBanned BOOL, isCCSGA BOOL, isAdmin BOOL, rolesLastUpdated DATETIME, updatedBy VARCHAR(40), PRIMARY KEY (username), FOREIGN KEY (updatedBy) REFERENCES Users(username));")
-        cur.execute("CREATE TABLE IF NOT EXISTS Conversations (id INT AUTO_INCREMENT, status VARCHAR(40), PRIMARY KEY (id));")
-        cur.execute("CREATE TABLE IF NOT EXISTS Messages (id INT AUTO_INCREMENT, conversationId INT, sender VARCHAR(40), body TEXT, dateandtime DATETIME, PRIMARY KEY (id), FOREIGN KEY (conversationId) REFERENCES Conversations(id), FOREIGN KEY (sender) REFERENCES Users(username));")
-        cur.execute("CREATE TABLE IF NOT EXISTS Labels (id INT AUTO_INCREMENT, body VARCHAR(40), PRIMARY KEY (id), UNIQUE (body));")
-        cur.execute("CREATE TABLE IF NOT EXISTS ConversationSettings (id INT AUTO_INCREMENT, conversationId INT, username VARCHAR(40), isArchived BOOL, identityRevealed BOOL, isInitiator BOOL, isAccessible BOOL DEFAULT 1, PRIMARY KEY (id), FOREIGN KEY (conversationId) REFERENCES Conversations(id), FOREIGN KEY (username) REFERENCES Users(username), UNIQUE KEY convIdAndUsername (conversationId, username));")
-        cur.execute("CREATE TABLE IF NOT EXISTS MessageSettings (id INT AUTO_INCREMENT, messageId INT, username VARCHAR(40), isRead BOOL, PRIMARY KEY (id), FOREIGN KEY (messageId) REFERENCES Messages(id), FOREIGN KEY (username) REFERENCES Users(username), UNIQUE KEY messageIdAndUsername (messageId, username));")
-        cur.execute("CREATE TABLE IF NOT EXISTS AppliedLabels (id INT AUTO_INCREMENT, conversationId INT, labelId INT, PRIMARY KEY (id), FOREIGN KEY (conversationId) REFERENCES Conversations(id), FOREIGN KEY (labelId) REFERENCES Labels(id));")
-        cur.execute("CREATE TABLE IF NOT EXISTS Links (id INT AUTO_INCREMENT, icon TEXT, body TEXT, url TEXT, dateandtime DATETIME, PRIMARY KEY (id));")
-        cur.execute("CREATE TABLE IF NOT EXISTS Announcements (id INT AUTO_INCREMENT, icon TEXT, body TEXT, dateandtime DATETIME, PRIMARY KEY (id));")
-    except mariadb.Error as e: 
-        print(f"Error when creating database tables: {e}")
-    finally:
-        conn.close()
+    def __init__(self, ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict() # Maps key to (expiry time, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Return the value cached for the key, or the default if there is no unexpired entry for it.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None:
+                return default
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value=True):
+        '''Cache a value for the key, evicting the least recently used entries if the cache is full.'''
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard_where(self, predicate):
+        '''Remove every entry whose key satisfies the predicate.'''
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
 
-def create_stored_procedures():
-    '''Create all the stored procedures for the database, but don't modify those that currently exist.'''
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def get_stored_procedures():
+    '''Return the CREATE OR REPLACE statements for all the stored procedures for the database (migrations.py deploys the ones that have changed).'''
 
     # Create stored procedures concering create/read/update for the messaging service
     messages_commands = [
-        '''CREATE PROCEDURE create_conversation (IN revealIdentity BOOL, IN sender VARCHAR(40), OUT conversationId INT)
+        '''CREATE OR REPLACE PROCEDURE create_conversation (IN revealIdentity BOOL, IN sender VARCHAR(40), OUT conversationId INT)
             BEGIN
                 IF EXISTS (SELECT username FROM Users WHERE isBanned AND username=sender) THEN
                     SET conversationId = -403;
@@ -65,74 +293,504 @@ def create_stored_procedures():
                     INSERT INTO Conversations (status) VALUES ('Delivered');
                     SELECT LAST_INSERT_ID() INTO conversationId;
                     INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (conversationId, sender, 0, revealIdentity, 1, 1);
-                    INSERT IGNORE INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) SELECT conversationId, Users.username, 0, 1, 0, 1 FROM Users WHERE isCCSGA OR isAdmin;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE create_message (IN conversationIdInput INT, IN sender VARCHAR(40), IN messageBody TEXT, OUT newMessageId INT)
+        '''CREATE OR REPLACE PROCEDURE create_message (IN conversationIdInput INT, IN sender VARCHAR(40), IN messageBody TEXT, OUT newMessageId INT)
             BEGIN
                 IF EXISTS (SELECT username FROM Users WHERE username=sender AND isBanned) THEN
                     SET newMessageId = -403;
                 ELSEIF NOT EXISTS (SELECT id FROM Conversations WHERE id = conversationIdInput) THEN
                     SET newMessageId = -404;
-                ELSEIF EXISTS (SELECT username FROM ConversationSettings WHERE username = sender AND conversationId = conversationIdInput AND isAccessible) THEN
+                ELSEIF EXISTS (SELECT username FROM ConversationSettings WHERE username = sender AND conversationId = conversationIdInput AND isAccessible) OR EXISTS (SELECT username FROM Users WHERE username = sender AND (isCCSGA OR isAdmin)) THEN
+                    CALL create_staff_conversation_settings(conversationIdInput, sender);
                     INSERT INTO Messages (conversationId, sender, body, dateandtime) VALUES (conversationIdInput, sender, messageBody, UTC_TIMESTAMP());
                     SELECT LAST_INSERT_ID() INTO newMessageId;
-                    INSERT INTO MessageSettings (messageId, username, isRead) SELECT newMessageId, ConversationSettings.username, 0 FROM ConversationSettings WHERE ConversationSettings.conversationId = conversationIdInput AND isAccessible;
-                    UPDATE MessageSettings SET isRead = 1 WHERE username = sender AND messageId = newMessageId;
+                    UPDATE ConversationSettings SET lastReadMessageId = newMessageId, unreadCount = 0 WHERE conversationId = conversationIdInput AND username = sender;
+                    # Everyone else's count goes up, even for entries without access right now, so that it stays the number of messages above their watermark if their access is restored
+                    UPDATE ConversationSettings SET unreadCount = unreadCount + 1 WHERE conversationId = conversationIdInput AND username <> sender;
+                    UPDATE Conversations SET updatedAt = CURRENT_TIMESTAMP(6) WHERE id = conversationIdInput;
                 ELSE
                     SET newMessageId = -403;
                 END IF;
                 
             END ;
         ''',
-        '''CREATE PROCEDURE apply_label (IN conversationId INT, IN labelBody VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE create_staff_conversation_settings (IN conversationIdInput INT, IN staffUsername VARCHAR(40))
             BEGIN
-                DECLARE labelId INT;
-                IF EXISTS (SELECT id FROM Labels WHERE body = labelBody) THEN
-                    SELECT id INTO labelId FROM Labels WHERE body = labelBody;
-                ELSE
-                    INSERT INTO Labels (body) VALUES (labelBody);
-                    SELECT LAST_INSERT_ID() INTO labelId;
+                DECLARE staffReadCutoff DATETIME;
+                # Reps and admins can access every conversation without a ConversationSettings entry, so create theirs only when they first need one (e.g., to archive the conversation)
+                # Until then, they are treated as having read every message sent before their roles last changed, so the new entry starts from there (and counts the messages sent since as unread)
+                # A user whose roles were never timestamped (rolesLastUpdated is NULL) is treated as having read nothing, here and in every other procedure that uses the cutoff
+                IF EXISTS (SELECT username FROM Users WHERE username = staffUsername AND (isCCSGA OR isAdmin)) THEN
+                    SELECT COALESCE(rolesLastUpdated, '1970-01-01') INTO staffReadCutoff FROM Users WHERE username = staffUsername;
+                    INSERT IGNORE INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible, lastReadMessageId, unreadCount)
+                        SELECT conversationIdInput, staffUsername, 0, 1, 0, 1,
+                            COALESCE((SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = conversationIdInput AND Messages.dateandtime <= staffReadCutoff), 0),
+                            (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = conversationIdInput AND Messages.dateandtime > staffReadCutoff);
                 END IF;
-                INSERT INTO AppliedLabels (conversationId, labelId) VALUES (conversationId, labelId);
             END ;
         ''',
-        '''CREATE PROCEDURE get_conversation_ids (IN requester VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE get_conversation_ids (IN requester VARCHAR(40))
             BEGIN
                 IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
                     SELECT -403;
+                ELSEIF EXISTS (SELECT username FROM Users WHERE username = requester AND (isCCSGA OR isAdmin)) THEN
+                    SELECT id FROM Conversations;
                 ELSE
                     SELECT conversationId FROM ConversationSettings WHERE username = requester AND isAccessible;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE get_conversation (IN requestedConversationId INT, IN requester VARCHAR(40), IN anonymityOverrideRequested BOOL)
+        '''CREATE OR REPLACE PROCEDURE get_conversation (IN requestedConversationId INT, IN requester VARCHAR(40), IN anonymityOverrideRequested BOOL, IN afterMessageId INT, IN messageLimit INT)
             BEGIN
+                DECLARE pageSize BIGINT UNSIGNED DEFAULT COALESCE(messageLimit + 1, 18446744073709551615);
+                DECLARE readUpTo INT DEFAULT 0;
+                DECLARE overrideAllowed BOOL DEFAULT 0;
                 IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
                     SELECT -403;
                 ELSEIF NOT EXISTS (SELECT id FROM Conversations WHERE id = requestedConversationId) THEN
                     SELECT -404;
-                ELSEIF EXISTS (SELECT username FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId AND isAccessible) THEN
+                ELSEIF EXISTS (SELECT username FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId AND isAccessible) OR EXISTS (SELECT username FROM Users WHERE username = requester AND (isCCSGA OR isAdmin)) THEN
+                    SELECT COALESCE(
+                            (SELECT lastReadMessageId FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId),
+                            (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = requestedConversationId AND Messages.dateandtime <= (SELECT COALESCE(rolesLastUpdated, '1970-01-01') FROM Users WHERE username = requester)),
+                            0) INTO readUpTo;
                     IF anonymityOverrideRequested AND EXISTS (SELECT username FROM Users WHERE username=requester AND isAdmin) THEN
-                        SELECT Messages.id, Users.username, Users.displayName, Messages.body, Messages.dateandtime, MessageSettings.isRead FROM ((Messages JOIN Users ON Messages.sender = Users.username) JOIN MessageSettings ON requester = MessageSettings.username AND Messages.id = MessageSettings.messageId) WHERE Messages.conversationId = requestedConversationId;
-                    ELSE
-                        SELECT Messages.id, Users.username, Users.displayName, Messages.body, Messages.dateandtime, MessageSettings.isRead FROM (((Messages JOIN Users ON Messages.sender = Users.username) JOIN MessageSettings ON requester = MessageSettings.username AND Messages.id = MessageSettings.messageId) JOIN ConversationSettings ON ConversationSettings.username = Messages.sender AND ConversationSettings.conversationId = requestedConversationId) WHERE Messages.conversationId = requestedConversationId AND (ConversationSettings.identityRevealed OR Messages.sender = requester)
-                        UNION SELECT Messages.id, "anonymous", "Anonymous", Messages.body, Messages.dateandtime, MessageSettings.isRead FROM ((Messages JOIN MessageSettings ON requester = MessageSettings.username AND Messages.id = MessageSettings.messageId) JOIN ConversationSettings ON ConversationSettings.username = Messages.sender AND ConversationSettings.conversationId = requestedConversationId) WHERE Messages.conversationId = requestedConversationId AND NOT (ConversationSettings.identityRevealed OR Messages.sender = requester);
+                        SET overrideAllowed = 1;
                     END IF;
-                
-                    SELECT status FROM Conversations WHERE id = requestedConversationId;
+
+                    SELECT Messages.id,
+                            CASE WHEN overrideAllowed OR Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.username ELSE "anonymous" END,
+                            CASE WHEN overrideAllowed OR Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.displayName ELSE "Anonymous" END,
+                            Messages.body, Messages.dateandtime, Messages.id <= readUpTo
+                        FROM Messages
+                        JOIN Users ON Users.username = Messages.sender
+                        LEFT JOIN ConversationSettings AS SenderSettings ON SenderSettings.conversationId = Messages.conversationId AND SenderSettings.username = Messages.sender
+                        WHERE Messages.conversationId = requestedConversationId AND Messages.id > COALESCE(afterMessageId, 0)
+                        ORDER BY Messages.id LIMIT pageSize;
+
+                    SELECT Conversations.status,
+                            COALESCE(Own.isArchived, 0),
+                            NOT EXISTS (SELECT ConversationSettings.id FROM ConversationSettings WHERE ConversationSettings.conversationId = requestedConversationId AND NOT ConversationSettings.identityRevealed),
+                            COALESCE(Own.identityRevealed, 1),
+                            NOT EXISTS (SELECT Messages.id FROM Messages WHERE Messages.conversationId = requestedConversationId AND Messages.id > readUpTo)
+                        FROM Conversations
+                        LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester
+                        WHERE Conversations.id = requestedConversationId;
+
                     SELECT body FROM Labels JOIN AppliedLabels ON Labels.id = AppliedLabels.labelId WHERE AppliedLabels.conversationId = requestedConversationId;
-                    SELECT isArchived FROM ConversationSettings WHERE ConversationSettings.conversationId = requestedConversationId AND ConversationSettings.username = requester;
-                    SELECT NOT EXISTS (SELECT ConversationSettings.id from ConversationSettings WHERE ConversationSettings.conversationId = requestedConversationId AND NOT identityRevealed);
-                    SELECT identityRevealed FROM ConversationSettings WHERE username = requester AND conversationId = requestedConversationId;
-                    SELECT NOT EXISTS (SELECT Messages.id FROM Messages JOIN MessageSettings ON requester = MessageSettings.username AND Messages.id = MessageSettings.messageId WHERE Messages.conversationId = requestedConversationId AND NOT isRead);
                 ELSE
                     SELECT -403;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE set_status (IN conversationIdToUpdate INT, IN requester VARCHAR(40), IN newStatus VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE get_conversations (IN requester VARCHAR(40), IN anonymityOverrideRequested BOOL, IN afterConversationId INT, IN conversationLimit INT)
+            BEGIN
+                DECLARE overrideAllowed BOOL DEFAULT 0;
+                DECLARE pageSize BIGINT UNSIGNED DEFAULT COALESCE(conversationLimit + 1, 18446744073709551615);
+                DECLARE hasMore BOOL DEFAULT 0;
+                DECLARE isStaff BOOL DEFAULT 0;
+                DECLARE staffReadCutoff DATETIME;
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    SELECT isCCSGA OR isAdmin, COALESCE(rolesLastUpdated, '1970-01-01') INTO isStaff, staffReadCutoff FROM Users WHERE username = requester;
+                    IF anonymityOverrideRequested AND EXISTS (SELECT username FROM Users WHERE username=requester AND isAdmin) THEN
+                        SET overrideAllowed = 1;
+                    END IF;
+
+                    # Determine the page of conversations (fetching one extra to find out whether there are more), along with the requester's read watermark and unread count in each
+                    # Reps and admins can access every conversation, with or without a ConversationSettings entry; without one, they've read every message sent before their roles last changed
+                    CREATE OR REPLACE TEMPORARY TABLE PageConversations (id INT PRIMARY KEY, readUpTo INT, unreadCount INT);
+                    IF isStaff THEN
+                        INSERT INTO PageConversations (id, readUpTo, unreadCount)
+                            SELECT Conversations.id, COALESCE(Own.lastReadMessageId, (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime <= staffReadCutoff), 0),
+                                COALESCE(Own.unreadCount, (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime > staffReadCutoff))
+                            FROM Conversations
+                            LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester
+                            WHERE Conversations.id > COALESCE(afterConversationId, 0)
+                            ORDER BY Conversations.id LIMIT pageSize;
+                    ELSE
+                        INSERT INTO PageConversations (id, readUpTo, unreadCount)
+                            SELECT conversationId, lastReadMessageId, unreadCount FROM ConversationSettings
+                            WHERE username = requester AND isAccessible AND conversationId > COALESCE(afterConversationId, 0)
+                            ORDER BY conversationId LIMIT pageSize;
+                    END IF;
+                    IF conversationLimit IS NOT NULL AND (SELECT COUNT(*) FROM PageConversations) > conversationLimit THEN
+                        SET hasMore = 1;
+                        DELETE FROM PageConversations ORDER BY id DESC LIMIT 1;
+                    END IF;
+
+                    SELECT Conversations.id, Conversations.status, COALESCE(Own.isArchived, 0), COALESCE(Own.identityRevealed, 1),
+                            NOT EXISTS (SELECT Others.id FROM ConversationSettings AS Others WHERE Others.conversationId = PageConversations.id AND NOT Others.identityRevealed),
+                            PageConversations.unreadCount
+                        FROM PageConversations
+                        JOIN Conversations ON Conversations.id = PageConversations.id
+                        LEFT JOIN ConversationSettings AS Own ON Own.conversationId = PageConversations.id AND Own.username = requester
+                        ORDER BY Conversations.id;
+                    SELECT Messages.conversationId, Messages.id,
+                            CASE WHEN overrideAllowed OR Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.username ELSE "anonymous" END,
+                            CASE WHEN overrideAllowed OR Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.displayName ELSE "Anonymous" END,
+                            Messages.body, Messages.dateandtime, Messages.id <= PageConversations.readUpTo
+                        FROM PageConversations
+                        JOIN Messages ON Messages.conversationId = PageConversations.id
+                        JOIN Users ON Users.username = Messages.sender
+                        LEFT JOIN ConversationSettings AS SenderSettings ON SenderSettings.conversationId = Messages.conversationId AND SenderSettings.username = Messages.sender
+                        ORDER BY Messages.conversationId, Messages.id;
+                    SELECT AppliedLabels.conversationId, Labels.body
+                        FROM PageConversations
+                        JOIN AppliedLabels ON AppliedLabels.conversationId = PageConversations.id
+                        JOIN Labels ON Labels.id = AppliedLabels.labelId;
+                    SELECT hasMore;
+
+                    DROP TEMPORARY TABLE PageConversations;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE stream_conversations (IN requester VARCHAR(40), IN anonymityOverrideRequested BOOL, IN afterConversationId INT, IN conversationLimit INT)
+            BEGIN
+                DECLARE overrideAllowed BOOL DEFAULT 0;
+                DECLARE pageSize BIGINT UNSIGNED DEFAULT COALESCE(conversationLimit + 1, 18446744073709551615);
+                DECLARE hasMore BOOL DEFAULT 0;
+                DECLARE isStaff BOOL DEFAULT 0;
+                DECLARE staffReadCutoff DATETIME;
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    SELECT isCCSGA OR isAdmin, COALESCE(rolesLastUpdated, '1970-01-01') INTO isStaff, staffReadCutoff FROM Users WHERE username = requester;
+                    IF anonymityOverrideRequested AND EXISTS (SELECT username FROM Users WHERE username=requester AND isAdmin) THEN
+                        SET overrideAllowed = 1;
+                    END IF;
+
+                    # Determine the page of conversations exactly as get_conversations does
+                    CREATE OR REPLACE TEMPORARY TABLE PageConversations (id INT PRIMARY KEY, readUpTo INT, unreadCount INT);
+                    IF isStaff THEN
+                        INSERT INTO PageConversations (id, readUpTo, unreadCount)
+                            SELECT Conversations.id, COALESCE(Own.lastReadMessageId, (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime <= staffReadCutoff), 0),
+                                COALESCE(Own.unreadCount, (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime > staffReadCutoff))
+                            FROM Conversations
+                            LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester
+                            WHERE Conversations.id > COALESCE(afterConversationId, 0)
+                            ORDER BY Conversations.id LIMIT pageSize;
+                    ELSE
+                        INSERT INTO PageConversations (id, readUpTo, unreadCount)
+                            SELECT conversationId, lastReadMessageId, unreadCount FROM ConversationSettings
+                            WHERE username = requester AND isAccessible AND conversationId > COALESCE(afterConversationId, 0)
+                            ORDER BY conversationId LIMIT pageSize;
+                    END IF;
+                    IF conversationLimit IS NOT NULL AND (SELECT COUNT(*) FROM PageConversations) > conversationLimit THEN
+                        SET hasMore = 1;
+                        DELETE FROM PageConversations ORDER BY id DESC LIMIT 1;
+                    END IF;
+
+                    # Each conversation's own row and label rows, collected in a second temporary table (a temporary table can't be opened twice in one query)
+                    CREATE OR REPLACE TEMPORARY TABLE StreamConversationRows (conversationId INT, rowType INT, status VARCHAR(40), isArchived BOOL, ownIdentityRevealed BOOL, allIdentitiesRevealed BOOL, unreadCount INT, labelBody VARCHAR(40));
+                    INSERT INTO StreamConversationRows (conversationId, rowType, status, isArchived, ownIdentityRevealed, allIdentitiesRevealed, unreadCount)
+                        SELECT Conversations.id, 0, Conversations.status, COALESCE(Own.isArchived, 0), COALESCE(Own.identityRevealed, 1),
+                            NOT EXISTS (SELECT Others.id FROM ConversationSettings AS Others WHERE Others.conversationId = PageConversations.id AND NOT Others.identityRevealed),
+                            PageConversations.unreadCount
+                        FROM PageConversations
+                        JOIN Conversations ON Conversations.id = PageConversations.id
+                        LEFT JOIN ConversationSettings AS Own ON Own.conversationId = PageConversations.id AND Own.username = requester;
+                    INSERT INTO StreamConversationRows (conversationId, rowType, labelBody)
+                        SELECT AppliedLabels.conversationId, 1, Labels.body
+                        FROM PageConversations
+                        JOIN AppliedLabels ON AppliedLabels.conversationId = PageConversations.id
+                        JOIN Labels ON Labels.id = AppliedLabels.labelId;
+
+                    # A single result set, in which every conversation's row is followed by its label rows and then its message rows, so that the caller can write the response as it reads it
+                    SELECT StreamConversationRows.conversationId, StreamConversationRows.rowType, NULL AS messageId,
+                            StreamConversationRows.status, StreamConversationRows.isArchived, StreamConversationRows.ownIdentityRevealed, StreamConversationRows.allIdentitiesRevealed, StreamConversationRows.unreadCount,
+                            StreamConversationRows.labelBody,
+                            NULL, NULL, NULL, NULL, NULL
+                        FROM StreamConversationRows
+                    UNION ALL
+                    SELECT Messages.conversationId, 2, Messages.id,
+                            NULL, NULL, NULL, NULL, NULL,
+                            NULL,
+                            CASE WHEN overrideAllowed OR Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.username ELSE "anonymous" END,
+                            CASE WHEN overrideAllowed OR Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.displayName ELSE "Anonymous" END,
+                            Messages.body, Messages.dateandtime, Messages.id <= PageConversations.readUpTo
+                        FROM PageConversations
+                        JOIN Messages ON Messages.conversationId = PageConversations.id
+                        JOIN Users ON Users.username = Messages.sender
+                        LEFT JOIN ConversationSettings AS SenderSettings ON SenderSettings.conversationId = Messages.conversationId AND SenderSettings.username = Messages.sender
+                    ORDER BY conversationId, rowType, messageId;
+                    SELECT hasMore;
+
+                    DROP TEMPORARY TABLE PageConversations;
+                    DROP TEMPORARY TABLE StreamConversationRows;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE get_conversation_changes (IN requester VARCHAR(40), IN changedSince DECIMAL(20,6))
+            BEGIN
+                DECLARE changedSinceTimestamp TIMESTAMP(6) DEFAULT FROM_UNIXTIME(GREATEST(changedSince, 1));
+                DECLARE changedSinceUtc DATETIME DEFAULT TIMESTAMPADD(SECOND, FLOOR(changedSince), '1970-01-01 00:00:00');
+                DECLARE isStaff BOOL DEFAULT 0;
+                DECLARE staffReadCutoff DATETIME;
+                DECLARE rolesChanged BOOL DEFAULT 0;
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    # Note whether the requester is a rep or an admin (who can access every conversation), and whether their roles changed since the watermark (in which case their access may have changed wholesale)
+                    SELECT isCCSGA OR isAdmin, COALESCE(rolesLastUpdated, '1970-01-01'), changedSince > 0 AND rolesLastUpdated >= changedSinceUtc INTO isStaff, staffReadCutoff, rolesChanged FROM Users WHERE username = requester;
+
+                    # Take the new watermark before reading anything, so that changes made during this call are picked up next time
+                    SELECT UNIX_TIMESTAMP(CURRENT_TIMESTAMP(6));
+
+                    # Find the accessible conversations that changed, note whether any identities were revealed in them or the requester just gained access (in which case all of their messages are resent), and note the requester's read watermark and unread count in each
+                    CREATE OR REPLACE TEMPORARY TABLE ChangedConversations (id INT PRIMARY KEY, resendAllMessages BOOL, readUpTo INT, unreadCount INT);
+                    IF isStaff THEN
+                        INSERT INTO ChangedConversations (id, resendAllMessages, readUpTo, unreadCount)
+                            SELECT Conversations.id, rolesChanged OR COALESCE(Conversations.identitiesRevealedAt > changedSinceTimestamp, 0),
+                                COALESCE(Own.lastReadMessageId, (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime <= staffReadCutoff), 0),
+                                COALESCE(Own.unreadCount, (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime > staffReadCutoff))
+                            FROM Conversations
+                            LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester
+                            WHERE rolesChanged OR Conversations.updatedAt > changedSinceTimestamp OR Own.updatedAt > changedSinceTimestamp;
+                    ELSE
+                        INSERT INTO ChangedConversations (id, resendAllMessages, readUpTo, unreadCount)
+                            SELECT Conversations.id, COALESCE(Conversations.identitiesRevealedAt > changedSinceTimestamp, 0), Own.lastReadMessageId, Own.unreadCount
+                            FROM ConversationSettings AS Own
+                            JOIN Conversations ON Conversations.id = Own.conversationId
+                            WHERE Own.username = requester AND Own.isAccessible AND (Conversations.updatedAt > changedSinceTimestamp OR Own.updatedAt > changedSinceTimestamp);
+                    END IF;
+
+                    SELECT Conversations.id, Conversations.status, COALESCE(Own.isArchived, 0), COALESCE(Own.identityRevealed, 1),
+                            NOT EXISTS (SELECT Others.id FROM ConversationSettings AS Others WHERE Others.conversationId = ChangedConversations.id AND NOT Others.identityRevealed),
+                            ChangedConversations.unreadCount,
+                            ChangedConversations.resendAllMessages
+                        FROM ChangedConversations
+                        JOIN Conversations ON Conversations.id = ChangedConversations.id
+                        LEFT JOIN ConversationSettings AS Own ON Own.conversationId = ChangedConversations.id AND Own.username = requester
+                        ORDER BY Conversations.id;
+                    SELECT Messages.conversationId, Messages.id,
+                            CASE WHEN Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.username ELSE "anonymous" END,
+                            CASE WHEN Messages.sender = requester OR SenderSettings.identityRevealed THEN Users.displayName ELSE "Anonymous" END,
+                            Messages.body, Messages.dateandtime, Messages.id <= ChangedConversations.readUpTo
+                        FROM ChangedConversations
+                        JOIN Messages ON Messages.conversationId = ChangedConversations.id
+                        JOIN Users ON Users.username = Messages.sender
+                        LEFT JOIN ConversationSettings AS SenderSettings ON SenderSettings.conversationId = Messages.conversationId AND SenderSettings.username = Messages.sender
+                        WHERE ChangedConversations.resendAllMessages OR Messages.dateandtime >= changedSinceUtc
+                        ORDER BY Messages.conversationId, Messages.id;
+                    SELECT AppliedLabels.conversationId, Labels.body
+                        FROM ChangedConversations
+                        JOIN AppliedLabels ON AppliedLabels.conversationId = ChangedConversations.id
+                        JOIN Labels ON Labels.id = AppliedLabels.labelId;
+
+                    # Conversations to which the requester has lost access since the watermark (after a demotion, that's every conversation they can no longer access, since reps and admins don't necessarily have ConversationSettings entries)
+                    IF rolesChanged AND NOT isStaff THEN
+                        SELECT Conversations.id FROM Conversations LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester WHERE NOT COALESCE(Own.isAccessible, 0);
+                    ELSE
+                        SELECT conversationId FROM ConversationSettings WHERE username = requester AND NOT isAccessible AND updatedAt > changedSinceTimestamp;
+                    END IF;
+
+                    DROP TEMPORARY TABLE ChangedConversations;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE get_conversation_summaries (IN requester VARCHAR(40), IN statusFilter VARCHAR(40), IN labelFilter VARCHAR(40), IN archivedFilter BOOL)
+            BEGIN
+                DECLARE isStaff BOOL DEFAULT 0;
+                DECLARE staffReadCutoff DATETIME;
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    SELECT isCCSGA OR isAdmin, COALESCE(rolesLastUpdated, '1970-01-01') INTO isStaff, staffReadCutoff FROM Users WHERE username = requester;
+                    CREATE OR REPLACE TEMPORARY TABLE SummaryConversations (id INT PRIMARY KEY, isArchived BOOL, unreadCount INT, lastMessageId INT);
+                    IF isStaff THEN
+                        INSERT INTO SummaryConversations (id, isArchived, unreadCount, lastMessageId)
+                            SELECT Conversations.id, COALESCE(Own.isArchived, 0),
+                                COALESCE(Own.unreadCount, (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime > staffReadCutoff)),
+                                (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = Conversations.id)
+                            FROM Conversations
+                            LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester
+                            WHERE (statusFilter IS NULL OR Conversations.status = statusFilter)
+                                AND (archivedFilter IS NULL OR COALESCE(Own.isArchived, 0) = archivedFilter)
+                                AND (labelFilter IS NULL OR EXISTS (SELECT AppliedLabels.id FROM AppliedLabels JOIN Labels ON Labels.id = AppliedLabels.labelId WHERE AppliedLabels.conversationId = Conversations.id AND Labels.body = labelFilter));
+                    ELSE
+                        INSERT INTO SummaryConversations (id, isArchived, unreadCount, lastMessageId)
+                            SELECT Own.conversationId, Own.isArchived, Own.unreadCount, (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = Own.conversationId)
+                            FROM ConversationSettings AS Own
+                            JOIN Conversations ON Conversations.id = Own.conversationId
+                            WHERE Own.username = requester AND Own.isAccessible
+                                AND (statusFilter IS NULL OR Conversations.status = statusFilter)
+                                AND (archivedFilter IS NULL OR Own.isArchived = archivedFilter)
+                                AND (labelFilter IS NULL OR EXISTS (SELECT AppliedLabels.id FROM AppliedLabels JOIN Labels ON Labels.id = AppliedLabels.labelId WHERE AppliedLabels.conversationId = Own.conversationId AND Labels.body = labelFilter));
+                    END IF;
+
+                    SELECT SummaryConversations.id, Conversations.status, SummaryConversations.isArchived,
+                            SummaryConversations.unreadCount,
+                            LastMessage.id,
+                            CASE WHEN LastMessage.sender = requester OR SenderSettings.identityRevealed THEN Users.username ELSE "anonymous" END,
+                            CASE WHEN LastMessage.sender = requester OR SenderSettings.identityRevealed THEN Users.displayName ELSE "Anonymous" END,
+                            LEFT(LastMessage.body, 140), LastMessage.dateandtime
+                        FROM SummaryConversations
+                        JOIN Conversations ON Conversations.id = SummaryConversations.id
+                        LEFT JOIN Messages AS LastMessage ON LastMessage.id = SummaryConversations.lastMessageId
+                        LEFT JOIN Users ON Users.username = LastMessage.sender
+                        LEFT JOIN ConversationSettings AS SenderSettings ON SenderSettings.conversationId = SummaryConversations.id AND SenderSettings.username = LastMessage.sender
+                        ORDER BY LastMessage.dateandtime DESC, SummaryConversations.id DESC;
+                    SELECT AppliedLabels.conversationId, Labels.body
+                        FROM SummaryConversations
+                        JOIN AppliedLabels ON AppliedLabels.conversationId = SummaryConversations.id
+                        JOIN Labels ON Labels.id = AppliedLabels.labelId;
+
+                    DROP TEMPORARY TABLE SummaryConversations;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE get_conversation_facets (IN requester VARCHAR(40))
+            BEGIN
+                DECLARE isStaff BOOL DEFAULT 0;
+                DECLARE staffReadCutoff DATETIME;
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    SELECT isCCSGA OR isAdmin, COALESCE(rolesLastUpdated, '1970-01-01') INTO isStaff, staffReadCutoff FROM Users WHERE username = requester;
+
+                    # The requester's own archived/unread state in each conversation they can access (reps and admins can access all of them; see get_conversation_summaries)
+                    CREATE OR REPLACE TEMPORARY TABLE FacetConversations (id INT PRIMARY KEY, isArchived BOOL, unreadCount INT);
+                    IF isStaff THEN
+                        INSERT INTO FacetConversations (id, isArchived, unreadCount)
+                            SELECT Conversations.id, COALESCE(Own.isArchived, 0),
+                                COALESCE(Own.unreadCount, (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = Conversations.id AND Messages.dateandtime > staffReadCutoff))
+                            FROM Conversations
+                            LEFT JOIN ConversationSettings AS Own ON Own.conversationId = Conversations.id AND Own.username = requester;
+                    ELSE
+                        INSERT INTO FacetConversations (id, isArchived, unreadCount)
+                            SELECT Own.conversationId, Own.isArchived, Own.unreadCount
+                            FROM ConversationSettings AS Own
+                            WHERE Own.username = requester AND Own.isAccessible;
+                    END IF;
+
+                    # Counts per status
+                    SELECT Conversations.status, COUNT(*)
+                        FROM FacetConversations
+                        JOIN Conversations ON Conversations.id = FacetConversations.id
+                        GROUP BY Conversations.status;
+
+                    # Counts per label (a conversation counts once per label, even if the label was applied to it more than once)
+                    SELECT Labels.body, COUNT(DISTINCT AppliedLabels.conversationId)
+                        FROM FacetConversations
+                        JOIN AppliedLabels ON AppliedLabels.conversationId = FacetConversations.id
+                        JOIN Labels ON Labels.id = AppliedLabels.labelId
+                        GROUP BY Labels.id, Labels.body;
+
+                    # Totals: all, archived, unread conversations, and unread messages
+                    SELECT COUNT(*), COALESCE(SUM(isArchived), 0), COALESCE(SUM(unreadCount > 0), 0), COALESCE(SUM(unreadCount), 0)
+                        FROM FacetConversations;
+
+                    DROP TEMPORARY TABLE FacetConversations;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE search_conversations (IN requester VARCHAR(40), IN searchQuery VARCHAR(200), IN anonymityOverrideRequested BOOL, IN afterScore DOUBLE, IN afterConversationId INT, IN resultLimit INT)
+            BEGIN
+                DECLARE pageSize BIGINT UNSIGNED DEFAULT COALESCE(resultLimit + 1, 18446744073709551615);
+                DECLARE isStaff BOOL DEFAULT 0;
+                DECLARE overrideAllowed BOOL DEFAULT 0;
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    SELECT isCCSGA OR isAdmin, isAdmin AND anonymityOverrideRequested INTO isStaff, overrideAllowed FROM Users WHERE username = requester;
+
+                    # Matching messages in conversations the requester can access (reps and admins can access all of them), found through the messagesBodyFulltext index
+                    CREATE OR REPLACE TEMPORARY TABLE SearchMessageMatches (id INT PRIMARY KEY, conversationId INT, score DOUBLE, KEY (conversationId, score));
+                    INSERT INTO SearchMessageMatches (id, conversationId, score)
+                        SELECT Messages.id, Messages.conversationId, MATCH (Messages.body) AGAINST (searchQuery IN NATURAL LANGUAGE MODE)
+                        FROM Messages
+                        WHERE MATCH (Messages.body) AGAINST (searchQuery IN NATURAL LANGUAGE MODE)
+                            AND (isStaff OR EXISTS (SELECT Own.id FROM ConversationSettings AS Own WHERE Own.conversationId = Messages.conversationId AND Own.username = requester AND Own.isAccessible));
+
+                    # A conversation's score is that of its best matching message, plus that of each matching label applied to it
+                    CREATE OR REPLACE TEMPORARY TABLE SearchConversations (id INT PRIMARY KEY, score DOUBLE);
+                    INSERT INTO SearchConversations (id, score)
+                        SELECT conversationId, MAX(score) FROM SearchMessageMatches GROUP BY conversationId;
+                    INSERT INTO SearchConversations (id, score)
+                        SELECT LabelMatches.conversationId, SUM(LabelMatches.score)
+                        FROM (SELECT DISTINCT AppliedLabels.conversationId, Labels.id, MATCH (Labels.body) AGAINST (searchQuery IN NATURAL LANGUAGE MODE) AS score
+                            FROM Labels
+                            JOIN AppliedLabels ON AppliedLabels.labelId = Labels.id
+                            WHERE MATCH (Labels.body) AGAINST (searchQuery IN NATURAL LANGUAGE MODE)
+                                AND (isStaff OR EXISTS (SELECT Own.id FROM ConversationSettings AS Own WHERE Own.conversationId = AppliedLabels.conversationId AND Own.username = requester AND Own.isAccessible))) AS LabelMatches
+                        GROUP BY LabelMatches.conversationId
+                        ON DUPLICATE KEY UPDATE score = SearchConversations.score + VALUES(score);
+
+                    # The requested page, best match first (ties broken by conversation ID, newest first), along with each conversation's best matching message (if any)
+                    CREATE OR REPLACE TEMPORARY TABLE SearchPage (position INT AUTO_INCREMENT PRIMARY KEY, id INT, score DOUBLE, bestMessageId INT);
+                    INSERT INTO SearchPage (id, score, bestMessageId)
+                        SELECT SearchConversations.id, SearchConversations.score,
+                            (SELECT SearchMessageMatches.id FROM SearchMessageMatches WHERE SearchMessageMatches.conversationId = SearchConversations.id ORDER BY SearchMessageMatches.score DESC, SearchMessageMatches.id LIMIT 1)
+                        FROM SearchConversations
+                        WHERE afterScore IS NULL OR SearchConversations.score < afterScore OR (SearchConversations.score = afterScore AND SearchConversations.id < afterConversationId)
+                        ORDER BY SearchConversations.score DESC, SearchConversations.id DESC
+                        LIMIT pageSize;
+
+                    # Senders are shown under the same anonymity rules as in get_conversation
+                    SELECT SearchPage.id, SearchPage.score, Conversations.status,
+                            BestMessage.id,
+                            CASE WHEN overrideAllowed OR BestMessage.sender = requester OR SenderSettings.identityRevealed THEN Users.username ELSE "anonymous" END,
+                            CASE WHEN overrideAllowed OR BestMessage.sender = requester OR SenderSettings.identityRevealed THEN Users.displayName ELSE "Anonymous" END,
+                            LEFT(BestMessage.body, 140), BestMessage.dateandtime
+                        FROM SearchPage
+                        JOIN Conversations ON Conversations.id = SearchPage.id
+                        LEFT JOIN Messages AS BestMessage ON BestMessage.id = SearchPage.bestMessageId
+                        LEFT JOIN Users ON Users.username = BestMessage.sender
+                        LEFT JOIN ConversationSettings AS SenderSettings ON SenderSettings.conversationId = SearchPage.id AND SenderSettings.username = BestMessage.sender
+                        ORDER BY SearchPage.position;
+
+                    # The extra result only tells the caller that there is another page, so leave it out of the labels
+                    DELETE FROM SearchPage WHERE position > resultLimit;
+                    SELECT AppliedLabels.conversationId, Labels.body
+                        FROM SearchPage
+                        JOIN AppliedLabels ON AppliedLabels.conversationId = SearchPage.id
+                        JOIN Labels ON Labels.id = AppliedLabels.labelId;
+
+                    DROP TEMPORARY TABLE SearchMessageMatches;
+                    DROP TEMPORARY TABLE SearchConversations;
+                    DROP TEMPORARY TABLE SearchPage;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE mark_conversations_read (IN requester VARCHAR(40))
+            BEGIN
+                DECLARE staffReadCutoff DATETIME;
+                # The caller fills the ReadUpdates temporary table (conversationId, upToMessageId) with the messages to mark as read, one row per conversation
+                IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
+                    SELECT -403;
+                ELSE
+                    # A watermark must never pass the end of its conversation, or messages sent later would start out read
+                    UPDATE ReadUpdates SET upToMessageId = LEAST(upToMessageId, COALESCE((SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = ReadUpdates.conversationId), 0));
+
+                    # Reps and admins can read any conversation, but need ConversationSettings entries to record that in (see create_staff_conversation_settings)
+                    IF EXISTS (SELECT username FROM Users WHERE username = requester AND (isCCSGA OR isAdmin)) THEN
+                        SELECT COALESCE(rolesLastUpdated, '1970-01-01') INTO staffReadCutoff FROM Users WHERE username = requester;
+                        INSERT IGNORE INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible, lastReadMessageId)
+                            SELECT ReadUpdates.conversationId, requester, 0, 1, 0, 1,
+                                COALESCE((SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = ReadUpdates.conversationId AND Messages.dateandtime <= staffReadCutoff), 0)
+                            FROM ReadUpdates
+                            JOIN Conversations ON Conversations.id = ReadUpdates.conversationId;
+                    END IF;
+
+                    # Move the watermarks forward (never back) and recount the unread messages, all in one statement
+                    UPDATE ConversationSettings AS Own
+                        JOIN ReadUpdates ON ReadUpdates.conversationId = Own.conversationId
+                        SET Own.lastReadMessageId = GREATEST(Own.lastReadMessageId, ReadUpdates.upToMessageId),
+                            Own.unreadCount = (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = Own.conversationId AND Messages.id > GREATEST(Own.lastReadMessageId, ReadUpdates.upToMessageId))
+                        WHERE Own.username = requester AND Own.isAccessible AND ReadUpdates.upToMessageId > Own.lastReadMessageId;
+
+                    # The requester's resulting read state in every requested conversation they can access
+                    SELECT Own.conversationId, Own.lastReadMessageId, Own.unreadCount
+                        FROM ReadUpdates
+                        JOIN ConversationSettings AS Own ON Own.conversationId = ReadUpdates.conversationId AND Own.username = requester AND Own.isAccessible;
+                END IF;
+            END ;
+        ''',
+        '''CREATE OR REPLACE PROCEDURE set_status (IN conversationIdToUpdate INT, IN requester VARCHAR(40), IN newStatus VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE username=requester AND (isCCSGA OR isAdmin) AND NOT isBanned) THEN
                     SELECT -403;
@@ -144,29 +802,34 @@ def create_stored_procedures():
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE set_archived (IN conversationIdToUpdate INT, IN requester VARCHAR(40), IN newIsArchived BOOL)
+        '''CREATE OR REPLACE PROCEDURE set_archived (IN conversationIdToUpdate INT, IN requester VARCHAR(40), IN newIsArchived BOOL)
             BEGIN
                 IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
                     SELECT -403;
                 ELSEIF NOT EXISTS (SELECT id FROM Conversations WHERE id = conversationIdToUpdate) THEN
                     SELECT -404;
-                ELSEIF NOT EXISTS (SELECT id FROM ConversationSettings WHERE conversationId = conversationIdToUpdate AND username = requester AND isAccessible) THEN
+                ELSEIF NOT EXISTS (SELECT id FROM ConversationSettings WHERE conversationId = conversationIdToUpdate AND username = requester AND isAccessible) AND NOT EXISTS (SELECT username FROM Users WHERE username = requester AND (isCCSGA OR isAdmin)) THEN
                     SELECT -403;
                 ELSE
+                    CALL create_staff_conversation_settings(conversationIdToUpdate, requester);
                     UPDATE ConversationSettings SET isArchived = newIsArchived WHERE conversationId = conversationIdToUpdate AND username = requester;
                     SELECT -200;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE reveal_identity (IN conversationIdToUpdate INT, IN requester VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE reveal_identity (IN conversationIdToUpdate INT, IN requester VARCHAR(40))
             BEGIN
                 IF EXISTS (SELECT username FROM Users WHERE username=requester AND isBanned) THEN
                     SELECT -403;
                 ELSEIF NOT EXISTS (SELECT id FROM Conversations WHERE id = conversationIdToUpdate) THEN
                     SELECT -404;
-                ELSEIF NOT EXISTS (SELECT id FROM ConversationSettings WHERE username=requester AND conversationId=conversationIdToUpdate AND isAccessible) THEN
+                ELSEIF NOT EXISTS (SELECT id FROM ConversationSettings WHERE username=requester AND conversationId=conversationIdToUpdate AND isAccessible) AND NOT EXISTS (SELECT username FROM Users WHERE username = requester AND (isCCSGA OR isAdmin)) THEN
                     SELECT -403;
                 ELSE
+                    CALL create_staff_conversation_settings(conversationIdToUpdate, requester);
+                    IF EXISTS (SELECT id FROM ConversationSettings WHERE username=requester AND conversationId=conversationIdToUpdate AND NOT identityRevealed) THEN
+                        UPDATE Conversations SET identitiesRevealedAt = CURRENT_TIMESTAMP(6) WHERE id = conversationIdToUpdate;
+                    END IF;
                     UPDATE ConversationSettings SET identityRevealed = 1 WHERE username=requester AND conversationId = conversationIdToUpdate;
                     SELECT -200;
                 END IF;
@@ -175,8 +838,10 @@ def create_stored_procedures():
     ]
 
     # Create stored procedures concerning create/read/delete for administrative features
+    # (Access that a role change takes away is revoked right here, in the same transaction, as is the access that unbanning restores, which is limited to the user's own conversations;
+    # the access to every conversation that promoting someone to rep or admin grants is restored afterward by a sync_conversation_access job, see job_queue.py)
     admin_commands = [
-        '''CREATE PROCEDURE add_ccsga (IN newCCSGA VARCHAR(40), IN adder VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE add_ccsga (IN newCCSGA VARCHAR(40), IN adder VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = adder) THEN
                     SELECT -403;
@@ -188,14 +853,12 @@ def create_stored_procedures():
                     ELSE
                         INSERT INTO Users (username, displayName, isBanned, isCCSGA, isAdmin, rolesLastUpdated, updatedBy) VALUES (newCCSGA, CONCAT(newCCSGA, " (display name not set)"), 0, 1, 0, UTC_TIMESTAMP(), adder);
                     END IF;
-                    INSERT IGNORE INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator) SELECT Conversations.id, newCCSGA, 0, 1, 0 FROM Conversations;
-                    UPDATE ConversationSettings SET isAccessible = 1 WHERE username = newCCSGA;
-                    INSERT IGNORE INTO MessageSettings (messageId, username, isRead) SELECT Messages.id, newCCSGA, 1 FROM Messages;
+                    UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';
                     SELECT -201;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE add_admin (IN newAdmin VARCHAR(40), IN adder VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE add_admin (IN newAdmin VARCHAR(40), IN adder VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = adder) THEN
                     SELECT -403;
@@ -207,14 +870,12 @@ def create_stored_procedures():
                     ELSE
                         INSERT INTO Users (username, displayName, isBanned, isCCSGA, isAdmin, rolesLastUpdated, updatedBy) VALUES (newAdmin, CONCAT(newAdmin, " (display name not set)"), 0, 0, 1, UTC_TIMESTAMP(), adder);
                     END IF;
-                    INSERT IGNORE INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator) SELECT Conversations.id, newAdmin, 0, 1, 0 FROM Conversations;
-                    UPDATE ConversationSettings SET isAccessible = 1 WHERE username = newAdmin;
-                    INSERT IGNORE INTO MessageSettings (messageId, username, isRead) SELECT Messages.id, newAdmin, 1 FROM Messages;
+                    UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';
                     SELECT -201;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE remove_ccsga (IN ccsgaToRemove VARCHAR(40), IN remover VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE remove_ccsga (IN ccsgaToRemove VARCHAR(40), IN remover VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = remover) THEN
                     SELECT -403;
@@ -222,14 +883,16 @@ def create_stored_procedures():
                     SELECT -404;
                 ELSE
                     UPDATE Users SET isCCSGA = 0, rolesLastUpdated = UTC_TIMESTAMP(), updatedBy = remover WHERE username = ccsgaToRemove;
+                    # Unless they're still an admin, they keep access only to the conversations they initiated
                     IF NOT EXISTS (SELECT username FROM Users WHERE username = ccsgaToRemove AND isAdmin) THEN
-                        UPDATE ConversationSettings SET isAccessible = 0 WHERE username = ccsgaToRemove AND NOT isInitiator;
+                        UPDATE ConversationSettings SET isAccessible = 0 WHERE username = ccsgaToRemove AND isAccessible AND NOT isInitiator;
                     END IF;
+                    UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';
                     SELECT -200;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE remove_admin (IN adminToRemove VARCHAR(40), IN remover VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE remove_admin (IN adminToRemove VARCHAR(40), IN remover VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = remover) THEN
                     SELECT -403;
@@ -240,15 +903,17 @@ def create_stored_procedures():
                         SELECT -400;
                     ELSE 
                         UPDATE Users SET isAdmin = 0, rolesLastUpdated = UTC_TIMESTAMP(), updatedBy = remover WHERE username = adminToRemove;
+                        # Unless they're still a rep, they keep access only to the conversations they initiated
                         IF NOT EXISTS (SELECT username FROM Users WHERE username = adminToRemove AND isCCSGA) THEN
-                            UPDATE ConversationSettings SET isAccessible = 0 WHERE username = adminToRemove AND NOT isInitiator;
+                            UPDATE ConversationSettings SET isAccessible = 0 WHERE username = adminToRemove AND isAccessible AND NOT isInitiator;
                         END IF;
+                        UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';
                         SELECT -200;
                     END IF;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE add_ban (IN userToBan VARCHAR(40), IN adder VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE add_ban (IN userToBan VARCHAR(40), IN adder VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = adder) THEN
                     SELECT -403;
@@ -257,15 +922,17 @@ def create_stored_procedures():
                 ELSE
                     IF EXISTS (SELECT username FROM Users WHERE username = userToBan) THEN
                         UPDATE Users SET isBanned = 1, isCCSGA = 0, isAdmin = 0, rolesLastUpdated = UTC_TIMESTAMP(), updatedBy = adder WHERE username = userToBan;
+                        # Banned users lose access to everything
+                        UPDATE ConversationSettings SET isAccessible = 0 WHERE username = userToBan AND isAccessible;
                     ELSE
                         INSERT INTO Users (username, displayName, isBanned, isCCSGA, isAdmin, rolesLastUpdated, updatedBy) VALUES (userToBan, CONCAT(userToBan, " (display name not set)"), 1, 0, 0, UTC_TIMESTAMP(), adder);
                     END IF;
-                    UPDATE ConversationSettings SET isAccessible = 0 WHERE username = userToBan;
+                    UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';
                     SELECT -201;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE remove_ban (IN userToUnban VARCHAR(40), IN remover VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE remove_ban (IN userToUnban VARCHAR(40), IN remover VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = remover) THEN
                     SELECT -403;
@@ -273,12 +940,14 @@ def create_stored_procedures():
                     SELECT -404;
                 ELSE
                     UPDATE Users SET isBanned = 0, rolesLastUpdated = UTC_TIMESTAMP(), updatedBy = remover WHERE username = userToUnban;
-                    UPDATE ConversationSettings SET isAccessible = 1 WHERE username = userToUnban AND isInitiator;
+                    # Unbanned users regain access to the conversations they initiated (and, having no staff role, only those)
+                    UPDATE ConversationSettings SET isAccessible = 1 WHERE username = userToUnban AND isInitiator AND NOT isAccessible;
+                    UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';
                     SELECT -200;
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE get_admins (IN requester VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE get_admins (IN requester VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = requester) THEN
                     SELECT -403;
@@ -287,7 +956,7 @@ def create_stored_procedures():
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE get_ccsga_reps (IN requester VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE get_ccsga_reps (IN requester VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = requester) THEN
                     SELECT -403;
@@ -296,7 +965,7 @@ def create_stored_procedures():
                 END IF;
             END ;
         ''',
-        '''CREATE PROCEDURE get_banned_users (IN requester VARCHAR(40))
+        '''CREATE OR REPLACE PROCEDURE get_banned_users (IN requester VARCHAR(40))
             BEGIN
                 IF NOT EXISTS (SELECT username FROM Users WHERE isAdmin AND username = requester) THEN
                     SELECT -403;
@@ -307,49 +976,235 @@ def create_stored_procedures():
         '''
     ]
 
-    # Get connection and cursor
-    conn, cur = get_conn_and_cursor()
-
-    # Execute all of the commands in all of the lists above
-    all_commands = [messages_commands, admin_commands]
-    for command_list in all_commands:
-        for command in command_list:
-            try:
-                cur.execute(command)
-            except mariadb.Error as e: # Procedure already exists, hopefully
-                # Still raise the execption if it wasn't due to the procedure already existing
-                if re.match(r"PROCEDURE \S+ already exists", str(e)) == None:
-                    print(f"Error when creating database stored procedures: {e}")
-    
-    # Close the connection
-    conn.close()
+    return messages_commands + admin_commands
 
 # Helper functions for other files to import
 
+# Users known to be in the database with their current display name, keyed by (username, display name)
+known_users_cache = TTLCache(ttl=float(os.getenv("KNOWN_USERS_CACHE_TTL", 300)), max_size=int(os.getenv("KNOWN_USERS_CACHE_SIZE", 10000)))
+
 def confirm_user_in_db(username, display_name):
     '''Insert a record for this user (as a student) into the DB if their username is not yet in the database.
-    This function also updates the user's display name if it has changed since the last time it was checked.'''
+    This function also updates the user's display name if it has changed since the last time it was checked.
+    Users confirmed recently (with the same display name) are remembered in known_users_cache, in which case the database is not touched at all; other users who are already in the database with the same display name cost a single read.'''
+
+    # Skip the database entirely if this user was recently confirmed with this display name
+    if known_users_cache.get((username, display_name)):
+        return
 
     # Get connection and cursor
     conn, cur = get_conn_and_cursor()
 
     try:
 
-        # Make sure user is in database
-        cur.execute("INSERT IGNORE INTO Users (username, isBanned, isCCSGA, isAdmin, displayName, rolesLastUpdated) VALUES (?, 0, 0, 0, ?, UTC_TIMESTAMP());", (username, display_name))
-        
-        # Update display name
-        cur.execute("UPDATE Users SET displayName = ? WHERE username = ?;", (display_name, username))
-        
-        # Commit database changes
-        conn.commit()
+        # Look the user up first, so that a returning user whose display name hasn't changed costs one read and no writes
+        cur.execute("SELECT displayName FROM Users WHERE username = ?;", (username,))
+        row = cur.fetchone()
+        if row == None or row[0] != display_name:
+
+            # Make sure user is in database, and update their display name only if it has changed
+            cur.execute("INSERT INTO Users (username, isBanned, isCCSGA, isAdmin, displayName, rolesLastUpdated) VALUES (?, 0, 0, 0, ?, UTC_TIMESTAMP()) ON DUPLICATE KEY UPDATE displayName = VALUES(displayName);", (username, display_name))
+            
+            # If the display name changed (2 affected rows), bump the roles version, since the role lists include display names
+            if cur.rowcount == 2:
+                cur.execute("UPDATE ResourceVersions SET version = version + 1 WHERE name = 'roles';")
+
+            # Commit database changes
+            conn.commit()
+
+        # Remember this user (dropping any entry for an outdated display name)
+        forget_known_user(username)
+        known_users_cache.set((username, display_name))
     except mariadb.Error as e:
         print(f"Error when confirming user in DB: {e}")
     finally:
         conn.close()
 
+def forget_known_user(username):
+    '''Remove a user from known_users_cache, so that the next confirm_user_in_db call for them goes to the database.
+    Should be called whenever a user's Users entry is changed elsewhere (e.g., by the admin procedures).'''
+
+    known_users_cache.discard_where(lambda key: key[0] == username)
+
+# Label IDs keyed by label body. Labels are never renamed, so an entry can only go stale if its label is deleted directly in the database (hence the TTL)
+label_ids_cache = TTLCache(ttl=float(os.getenv("LABEL_IDS_CACHE_TTL", 3600)), max_size=int(os.getenv("LABEL_IDS_CACHE_SIZE", 10000)))
+
+def warm_label_ids_cache():
+    '''Load the IDs of all of the labels into label_ids_cache (called once at startup).
+    If the database can't be reached, the cache just starts out empty and fills up as labels are applied.'''
+
+    conn_and_cursor = get_conn_and_cursor()
+    if conn_and_cursor == None:
+        print("Could not load label IDs at startup; they will be looked up as labels are applied")
+        return
+    conn, cur = conn_and_cursor
+    try:
+        cur.execute("SELECT id, body FROM Labels;")
+        for label_id, body in cur.fetchall():
+            label_ids_cache.set(body, label_id)
+    except mariadb.Error as e:
+        print(f"Error when loading label IDs: {e}")
+    finally:
+        conn.close()
+
+def get_label_ids(cur, label_bodies):
+    '''Return a dictionary mapping each of the label bodies to its label ID, creating the labels that don't exist yet (using the caller's cursor, so in the caller's transaction).
+    Labels found in label_ids_cache cost nothing; the rest cost one INSERT in total plus one SELECT each.
+    Raises ValueError if a label can't be found even after being created (e.g., because its body is longer than the column allows).'''
+
+    label_ids = {body: label_ids_cache.get(body) for body in label_bodies}
+    missing = [body for body, label_id in label_ids.items() if label_id == None]
+    if missing:
+        placeholders = ", ".join(["(?)"] * len(missing))
+        cur.execute(f"INSERT IGNORE INTO Labels (body) VALUES {placeholders};", missing)
+        # Look each label up with the database's own comparison (its collation ignores case, trailing spaces and, e.g., accents), so that a body matches whichever existing label the INSERT IGNORE matched
+        for body in missing:
+            cur.execute("SELECT id FROM Labels WHERE body = ?;", (body,))
+            row = cur.fetchone()
+            if row == None:
+                raise ValueError(f"Label '{body}' could not be found or created")
+            label_ids[body] = row[0]
+            label_ids_cache.set(body, label_ids[body])
+    return label_ids
+
+def apply_labels(cur, conversation_id, label_bodies):
+    '''Apply the labels (creating any that don't exist yet) to the conversation, using the caller's cursor, in a constant number of statements however many labels are cached.
+    Raises ValueError if a label can't be found or created (see get_label_ids).'''
+
+    label_bodies = list(dict.fromkeys(label_bodies)) # Remove duplicates, keeping the order
+    if not label_bodies:
+        return
+
+    # Mark this point in the caller's transaction, so that a failed insert can be undone before trying again
+    cur.execute("SAVEPOINT apply_labels;")
+    try:
+        label_ids = get_label_ids(cur, label_bodies)
+        cur.executemany("INSERT INTO AppliedLabels (conversationId, labelId) VALUES (?, ?);", [(conversation_id, label_ids[body]) for body in label_bodies])
+    except mariadb.IntegrityError as e:
+        # Only a cached label ID pointing to a label that has since been deleted is worth retrying; any other constraint failure is a real error
+        if "labelId" not in str(e):
+            raise
+        # Undo whatever part of the insert succeeded, forget these labels' cached IDs, and try again from the database
+        cur.execute("ROLLBACK TO SAVEPOINT apply_labels;")
+        label_ids_cache.discard_where(lambda key: key in label_bodies)
+        label_ids = get_label_ids(cur, label_bodies)
+        cur.executemany("INSERT INTO AppliedLabels (conversationId, labelId) VALUES (?, ?);", [(conversation_id, label_ids[body]) for body in label_bodies])
+    cur.execute("RELEASE SAVEPOINT apply_labels;")
+    cur.execute("UPDATE Conversations SET updatedAt = CURRENT_TIMESTAMP(6) WHERE id = ?;", (conversation_id,))
+
+def get_accessible_conversation_ids(username):
+    '''Return the set of IDs of the conversations to which the specified user currently has access, or None if the user is banned.'''
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    conversation_ids = set()
+    try:
+        cur.callproc("get_conversation_ids", (username,))
+        conversation_ids = {row[0] for row in cur.fetchall()}
+        cur.nextset()
+    except mariadb.Error as e:
+        print(f"Error when getting accessible conversation IDs: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+
+    return None if conversation_ids == {-403} else conversation_ids
+
+def can_access_conversation(username, conversation_id):
+    '''Return True iff the specified user currently has access to the specified conversation (i.e., isn't banned, and is a rep or an admin or has an accessible ConversationSettings entry for it).'''
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    accessible = False
+    try:
+        cur.execute("SELECT NOT isBanned AND ((isCCSGA OR isAdmin) OR EXISTS (SELECT id FROM ConversationSettings WHERE username = Users.username AND conversationId = ? AND isAccessible)) FROM Users WHERE username = ?;", (conversation_id, username))
+        row = cur.fetchone()
+        accessible = row != None and bool(row[0])
+    except mariadb.Error as e:
+        print(f"Error when checking access to conversation: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+
+    return accessible
+
+# Helper functions for getting cheap versions of resources, for conditional (ETag) responses (other files can import these)
+
+def get_roles_version():
+    '''Return the current version of the users' roles, which the admin procedures increment whenever they change anyone's roles.'''
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    version = None
+    try:
+        cur.execute("SELECT version FROM ResourceVersions WHERE name = 'roles';")
+        version = cur.fetchone()[0]
+    except mariadb.Error as e:
+        print(f"Error when getting roles version: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+
+    return version
+
+def get_conversations_version(username, conversation_id=None):
+    '''Return a string that changes whenever anything the specified user can see in their conversations changes (or in the specified conversation, if a conversation_id is given).
+    It is built from the conversations' updatedAt columns, the user's ConversationSettings, and the roles version, without touching the Messages table.
+    Reps and admins can access every conversation (whether or not they have ConversationSettings for it), so their list version covers all conversations.'''
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    version = None
+    try:
+        if conversation_id == None:
+            cur.execute("SELECT isCCSGA OR isAdmin FROM Users WHERE username = ?;", (username,))
+            row = cur.fetchone()
+            if row != None and row[0]:
+                cur.execute("SELECT (SELECT MAX(id) FROM Conversations), (SELECT MAX(updatedAt) FROM Conversations), (SELECT MAX(updatedAt) FROM ConversationSettings WHERE username = ?), (SELECT version FROM ResourceVersions WHERE name = 'roles');", (username,))
+            else:
+                cur.execute("SELECT COUNT(CASE WHEN Own.isAccessible THEN 1 END), MAX(GREATEST(Conversations.updatedAt, Own.updatedAt)), (SELECT version FROM ResourceVersions WHERE name = 'roles') FROM ConversationSettings AS Own JOIN Conversations ON Conversations.id = Own.conversationId WHERE Own.username = ?;", (username,))
+        else:
+            cur.execute("SELECT Conversations.id, Conversations.updatedAt, (SELECT MAX(updatedAt) FROM ConversationSettings WHERE conversationId = Conversations.id), (SELECT version FROM ResourceVersions WHERE name = 'roles') FROM Conversations WHERE id = ?;", (conversation_id,))
+        row = cur.fetchone()
+        version = None if row == None else "|".join(str(value) for value in row)
+    except mariadb.Error as e:
+        print(f"Error when getting conversations version: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+
+    return version
+
 # Helper functions for checking user role (other files can import these)
 
+def get_user_roles(username):
+    '''Return a dictionary with the specified user's role flags (isBanned, isCCSGA, isAdmin), all fetched in a single query.
+    Return None if the user is not in the database.'''
+
+    if not username: return None # Non-signed in user has no roles
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    roles = None
+    try:
+        cur.execute("SELECT isBanned, isCCSGA, isAdmin FROM Users WHERE username = ?;", (username,))
+        row = cur.fetchone()
+        if row != None:
+            is_banned, is_ccsga, is_admin = row
+            roles = {"isBanned": bool(is_banned), "isCCSGA": bool(is_ccsga), "isAdmin": bool(is_admin)}
+    except mariadb.Error as e:
+        print(f"Error when getting roles of signed-in user: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+    
+    return roles
+
 def is_student(username):
     '''Return True iff specified user is student (i.e., neither CCSGA rep nor admin).'''
     
@@ -410,8 +1265,7 @@ def is_admin(username):
 
 if __name__ == '__main__':
     
-    # When this file is run as a python program, create tables and stored procedures that are not currently in the database
-    print("Creating database tables (doesn't modify any that already exist)")
-    create_tables()
-    print("Creating stored procedures (doesn't modify any that already exist)")
-    create_stored_procedures()
+    # When this file is run as a python program, bring the database's tables and stored procedures up to date (see migrations.py)
+    import sys
+    from migrations import main
+    main(sys.argv[1:])
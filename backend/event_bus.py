@@ -0,0 +1,114 @@
+import threading
+import uuid
+from collections import deque, namedtuple
+
+# An event published on the bus.
+# If conversation_id is set, only subscribers with access to that conversation should receive the event;
+# if username is set, only that user's subscribers should receive it.
+# initiator is only set for conversation_created events: the user who initiated the new conversation, whose other streams should hear about it too.
+Event = namedtuple('Event', ['id', 'type', 'data', 'conversation_id', 'username', 'initiator'])
+
+class Subscription:
+    '''A single subscriber's queue of events. Events are offered by publishing threads and taken by the subscriber's own thread with get().'''
+
+    def __init__(self, bus, accepts, max_queued):
+        self._bus = bus
+        self._accepts = accepts
+        self._queue = deque()
+        self._max_queued = max_queued
+        self._condition = threading.Condition()
+        self.overflowed = False # Set if events had to be dropped because the subscriber fell too far behind
+        self.closed = False
+
+    def offer(self, event):
+        '''Queue the event for this subscriber if it passes the subscriber's filter.'''
+        if not self._accepts(event):
+            return
+        with self._condition:
+            if len(self._queue) >= self._max_queued:
+                self.overflowed = True
+                self._queue.clear()
+            self._queue.append(event)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        '''Wait up to timeout seconds for events, then return (and remove) all of the queued ones; the list is empty if the timeout expired first.'''
+        with self._condition:
+            if not self._queue and not self.closed:
+                self._condition.wait(timeout)
+            events = list(self._queue)
+            self._queue.clear()
+            return events
+
+    def close(self):
+        '''Stop receiving events, and wake up any thread waiting in get().'''
+        self._bus.unsubscribe(self)
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+class EventBus:
+    '''In-process publish/subscribe bus for conversation events, with a bounded history so that subscribers can resume after reconnecting.
+    Since it lives in the memory of a single process, publishers and subscribers must run in the same process (e.g., one gunicorn worker with many threads or greenlets).'''
+
+    def __init__(self, history_size=1000, max_queued_per_subscriber=1000):
+        self._lock = threading.Lock()
+        self._history = deque(maxlen=history_size)
+        self._next_sequence_number = 1
+        self._subscriptions = set()
+        self._max_queued_per_subscriber = max_queued_per_subscriber
+        self.boot_id = uuid.uuid4().hex[:8] # Distinguishes this process's event IDs from those of previous processes
+
+    def publish(self, event_type, data, conversation_id=None, username=None, initiator=None):
+        '''Publish an event to every subscriber whose filter accepts it, and return the event.'''
+
+        with self._lock:
+            event = Event(f"{self.boot_id}-{self._next_sequence_number}", event_type, data, conversation_id, username, initiator)
+            self._next_sequence_number += 1
+            self._history.append(event)
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.offer(event)
+        return event
+
+    def subscribe(self, accepts, last_event_id=None):
+        '''Register a subscriber whose filter is the accepts function (which takes an Event and returns a boolean).
+        If last_event_id is given, the events published since then are queued for the subscriber right away.
+        Return a tuple of (subscription, complete), in which complete is False if the events since last_event_id are no longer (or were never) in the history, so the subscriber must resynchronize.'''
+
+        subscription = Subscription(self, accepts, self._max_queued_per_subscriber)
+        complete = True
+        with self._lock:
+            self._subscriptions.add(subscription)
+            if last_event_id != None:
+                backlog, complete = self._events_after(last_event_id)
+                for event in backlog:
+                    subscription.offer(event)
+        return subscription, complete
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def last_event_id(self):
+        '''Return the ID of the most recently published event (or of the point before the first event, if none have been published yet).'''
+        with self._lock:
+            return f"{self.boot_id}-{self._next_sequence_number - 1}"
+
+    def num_subscribers(self):
+        with self._lock:
+            return len(self._subscriptions)
+
+    def _events_after(self, last_event_id):
+        '''Return a tuple of (the events in the history after the one with the given ID, whether the history covers everything since that event).'''
+
+        boot_id, _, sequence_number = last_event_id.partition('-')
+        if boot_id != self.boot_id or not sequence_number.isdigit():
+            return [], False
+        sequence_number = int(sequence_number)
+        events = [event for event in self._history if int(event.id.partition('-')[2]) > sequence_number]
+        oldest = int(self._history[0].id.partition('-')[2]) if self._history else self._next_sequence_number
+        return events, oldest <= sequence_number + 1
+
+# The bus shared by all of this process's routes
+event_bus = EventBus()
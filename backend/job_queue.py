@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+import uuid
+import mariadb
+
+# A durable queue of background jobs, stored in the Jobs table.
+# Routes enqueue jobs with enqueue_job (in the same transaction as the change that needs them), and a separate worker process runs them:
+# from the backend directory, run `python3 job_queue.py` (see the README for running it as a service).
+# Each job runs in chunks, committing after every chunk, so that no single transaction holds locks on many rows for long; job handlers must therefore be safe to rerun from the start.
+
+def enqueue_job(cur, job_type, payload, created_by=None):
+    '''Add a job to the queue using the caller's cursor (so the job is only queued if the caller's transaction commits), and return the new job's ID.'''
+
+    cur.execute("INSERT INTO Jobs (type, payload, createdBy) VALUES (?, ?, ?);", (job_type, json.dumps(payload), created_by))
+    return cur.lastrowid
+
+def get_job(cur, job_id):
+    '''Return a dictionary describing the specified job (suitable for a JSON response), or None if there is no such job.'''
+
+    cur.execute("SELECT id, type, payload, status, attempts, maxAttempts, progress, lastError, createdBy, createdAt, updatedAt FROM Jobs WHERE id = ?;", (job_id,))
+    row = cur.fetchone()
+    if row == None:
+        return None
+    job_id, job_type, payload, status, attempts, max_attempts, progress, last_error, created_by, created_at, updated_at = row
+    return {"id": job_id, "type": job_type, "payload": json.loads(payload), "status": status, "attempts": attempts, "maxAttempts": max_attempts, "progress": progress, "lastError": last_error, "createdBy": created_by, "createdAt": str(created_at), "updatedAt": str(updated_at)}
+
+# Job handlers, keyed by job type. Each one takes (conn, cur, payload, chunk_size, report_progress) and must be safe to rerun.
+
+def sync_conversation_access(conn, cur, payload, chunk_size, report_progress):
+    '''Restore the access (the isAccessible flags of the ConversationSettings) that a user's *current* roles grant: reps and admins regain access to everything,
+    and other users who aren't banned regain access to the conversations they initiated.
+    Access is only ever granted here; the role-changing procedures revoke access themselves, right away (see admin_commands in database_handler.py).
+    Each chunk checks the user's roles again, so a role change made while the job runs (or after it was queued) is never undone.'''
+
+    username = payload["username"]
+    grants = [
+        # Reps and admins can access every conversation
+        "EXISTS (SELECT username FROM Users WHERE username = ? AND (isCCSGA OR isAdmin))",
+        # Everyone who isn't banned can access the conversations they initiated
+        "isInitiator AND EXISTS (SELECT username FROM Users WHERE username = ? AND NOT isBanned)"
+    ]
+    for condition in grants:
+        while True:
+            cur.execute(f"UPDATE ConversationSettings SET isAccessible = 1 WHERE username = ? AND NOT isAccessible AND {condition} LIMIT ?;", (username, username, chunk_size))
+            num_updated = cur.rowcount
+            conn.commit()
+            report_progress(num_updated)
+            if num_updated < chunk_size:
+                break
+
+JOB_HANDLERS = {
+    "sync_conversation_access": sync_conversation_access
+}
+
+def claim_next_job(conn, cur, lock_timeout):
+    '''Claim the next job that is due (first returning any job whose worker seems to have died to the queue), and return (id, type, payload, attempts, maxAttempts), or None if no job is due.'''
+
+    # Requeue jobs that have been running for longer than the lock timeout (their worker presumably died)
+    cur.execute("UPDATE Jobs SET status = 'queued', lockedBy = NULL WHERE status = 'running' AND lockedAt < NOW(6) - INTERVAL ? SECOND;", (lock_timeout,))
+
+    # Claim a job with a single UPDATE, so that two workers can never claim the same job
+    claim_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    cur.execute("UPDATE Jobs SET status = 'running', lockedBy = ?, lockedAt = NOW(6), attempts = attempts + 1 WHERE status = 'queued' AND runAfter <= NOW(6) ORDER BY id LIMIT 1;", (claim_id,))
+    conn.commit()
+    if cur.rowcount == 0:
+        return None
+    cur.execute("SELECT id, type, payload, attempts, maxAttempts FROM Jobs WHERE lockedBy = ? AND status = 'running';", (claim_id,))
+    job_id, job_type, payload, attempts, max_attempts = cur.fetchone()
+    return job_id, job_type, json.loads(payload), attempts, max_attempts
+
+def run_job(conn, cur, job, chunk_size):
+    '''Run a claimed job, then mark it as succeeded, or requeue it with exponential backoff (or mark it as failed once it has used up its attempts) if it raises an exception.'''
+
+    job_id, job_type, payload, attempts, max_attempts = job
+
+    def report_progress(num_rows):
+        cur.execute("UPDATE Jobs SET progress = progress + ?, lockedAt = NOW(6) WHERE id = ?;", (num_rows, job_id))
+        conn.commit()
+
+    try:
+        if job_type not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job type '{job_type}'")
+        JOB_HANDLERS[job_type](conn, cur, payload, chunk_size, report_progress)
+        cur.execute("UPDATE Jobs SET status = 'succeeded', lockedBy = NULL, lastError = NULL WHERE id = ?;", (job_id,))
+        conn.commit()
+    except Exception as e:
+        print(f"Error when running job #{job_id} ({job_type}, attempt {attempts} of {max_attempts}): {e}")
+        traceback.print_exc()
+        conn.rollback()
+        if attempts >= max_attempts:
+            cur.execute("UPDATE Jobs SET status = 'failed', lockedBy = NULL, lastError = ? WHERE id = ?;", (str(e), job_id))
+        else:
+            cur.execute("UPDATE Jobs SET status = 'queued', lockedBy = NULL, lastError = ?, runAfter = NOW(6) + INTERVAL ? SECOND WHERE id = ?;", (str(e), 2 ** attempts, job_id))
+        conn.commit()
+
+def run_worker(get_conn_and_cursor):
+    '''Run jobs from the queue forever, polling for new ones when the queue is empty. Settings come from the JOB_* values in the environment.'''
+
+    chunk_size = int(os.getenv("JOB_CHUNK_SIZE", 500))
+    poll_seconds = float(os.getenv("JOB_POLL_SECONDS", 2))
+    lock_timeout = int(os.getenv("JOB_LOCK_TIMEOUT", 600))
+
+    while True:
+        conn, cur = get_conn_and_cursor()
+        try:
+            # Keep running jobs until none are due
+            job = claim_next_job(conn, cur, lock_timeout)
+            while job != None:
+                run_job(conn, cur, job, chunk_size)
+                job = claim_next_job(conn, cur, lock_timeout)
+        except mariadb.Error as e:
+            print(f"Error when running job queue: {e}")
+        finally:
+            conn.close()
+        time.sleep(poll_seconds)
+
+if __name__ == "__main__":
+    try:
+        from database_handler import get_conn_and_cursor
+    except ModuleNotFoundError:
+        print("Make sure you're actually in the backend directory when you run this program.")
+        sys.exit(1)
+    print("Job worker started")
+    run_worker(get_conn_and_cursor)
@@ -1,8 +1,19 @@
+import base64
+import binascii
 import flask
+import json
 import mariadb
+import math
+import os
+from decimal import Decimal, InvalidOperation
 from flask import request, make_response, jsonify, abort
 from backend import app
-from backend.database_handler import get_conn_and_cursor, confirm_user_in_db
+from backend.database_handler import get_pool, get_conn_and_cursor, confirm_user_in_db, get_conversations_version, can_access_conversation, apply_labels, TTLCache
+from backend.route_wrappers import get_session_display_name, conditional_get, user_is_not_banned
+from backend.event_bus import event_bus
+
+# Maximum length of a label's body (the length of Labels.body)
+MAX_LABEL_LENGTH = 40
 
 @app.route("/api/conversations/create", methods=["POST"])
 def create_conversation():
@@ -25,15 +36,14 @@ def create_conversation():
         if key not in request_dict:
             return make_response(jsonify(message="The required property '" + key + "' was not included in the request"), 400)
 
+    # Confirm that the labels are a list of strings that fit in the Labels table
+    if not isinstance(request_dict["labels"], list) or not all(isinstance(label, str) for label in request_dict["labels"]):
+        return make_response(jsonify(message="The property 'labels' must be a list of strings"), 400)
+    if any(len(label) > MAX_LABEL_LENGTH for label in request_dict["labels"]):
+        return make_response(jsonify(message=f"Labels can be at most {MAX_LABEL_LENGTH} characters long"), 400)
+
     # Confirm that user is in DB
-    username = flask.session.get('CAS_USERNAME')
-    try:
-        displayName = flask.session.get('CAS_ATTRIBUTES')['cas:displayName']
-    except KeyError:
-        print("Missing key 'cas:displayName' (to be used as full name) for user '%s'." % username)
-        print("Using username for full name instead (if needed)")
-        displayName = username
-    confirm_user_in_db(username, displayName)
+    confirm_user_in_db(flask.session.get('CAS_USERNAME'), get_session_display_name())
 
     # Get database connection and cursor
     conn, cur = get_conn_and_cursor()
@@ -49,17 +59,24 @@ def create_conversation():
         if conversation_id == -403:
             return make_response(jsonify({"message": "User is banned and therefore is not authorized to initiate new conversations."}), 403)
 
-        # Call the stored procedure for creating a new Messages entry and corresponding MessageSettings entries
+        # Call the stored procedure for creating a new Messages entry (which also moves the sender's read watermark up to it)
         cur.callproc("create_message", (conversation_id, flask.session.get('CAS_USERNAME'), request_dict['messageBody'], 0))
         message_id = cur.fetchall()[0][0]
         cur.nextset()
 
-        # For each label provided, call the stored procedure for applying a label to a conversation
-        for label_body in request_dict["labels"]:
-            cur.callproc("apply_label", (conversation_id, label_body))
+        # Apply all of the labels provided at once (creating any that don't exist yet)
+        apply_labels(cur, conversation_id, request_dict["labels"])
         
         # Commit database changes and close connection
         conn.commit()
+
+        # Let reps and admins (and the initiator's other open streams) know about the new conversation
+        event_bus.publish('conversation_created', {"conversationId": conversation_id, "messageId": message_id}, conversation_id, initiator=flask.session.get('CAS_USERNAME'))
+    except ValueError as e:
+        # A label couldn't be found or created; nothing has been committed, so just report it
+        conn.rollback()
+        print(f"Error when applying labels to new conversation: {e}")
+        return make_response(jsonify({"message": "One of the labels could not be applied."}), 500)
     except mariadb.Error as e:
         print(f"Error when initiating conversation: {e}")
     finally:
@@ -95,7 +112,7 @@ def create_message(conversation_id):
     
     try:
 
-        # Call the stored procedure for creating a new Messages entry and corresponding MessageSettings entries
+        # Call the stored procedure for creating a new Messages entry (which also moves the sender's read watermark up to it)
         cur.callproc("create_message", (conversation_id, flask.session.get('CAS_USERNAME'), request_dict['messageBody'], 0))
         message_id = cur.fetchall()[0][0]
         cur.nextset()
@@ -110,6 +127,9 @@ def create_message(conversation_id):
 
         # Commit database changes and close connection
         conn.commit()
+
+        # Let everyone streaming this conversation know about the new message
+        event_bus.publish('message_created', {"conversationId": int(conversation_id), "messageId": message_id}, int(conversation_id))
     except mariadb.Error as e:
         print(f"Error when saving reply: {e}")
     finally:
@@ -119,10 +139,376 @@ def create_message(conversation_id):
     # Respond with the ID of the new Messages entry
     return make_response(jsonify({"messageId": message_id}), 201)
 
+@app.route("/api/conversations/summary")
+@conditional_get(lambda: get_conversations_version(flask.session.get('CAS_USERNAME')), user_is_not_banned)
+def get_conversation_summaries():
+    '''Get a lightweight summary (status, labels, archived/read state, unread count, and a preview of the latest message) of each conversation to which the signed-in user currently has access, most recently active first.
+    The optional query parameters `status`, `label`, and `archived` (true/false) filter the conversations on the server side.'''
+
+    # prevent non-signed in users from accessing
+    if flask.session.get('CAS_USERNAME') == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Get the filters (None means don't filter on that property)
+    status_filter = request.args.get("status")
+    label_filter = request.args.get("label")
+    archived_filter = {"true": 1, "false": 0}.get(request.args.get("archived"))
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    try:
+
+        # Call the stored procedure for getting the conversation summaries
+        cur.callproc("get_conversation_summaries", (flask.session.get('CAS_USERNAME'), status_filter, label_filter, archived_filter))
+        summaries_query_result = cur.fetchall()
+
+        # Respond appropriately if the stored procedure determined that the requester was not authorized
+        if summaries_query_result == [(-403,)]:
+            return make_response(jsonify({"message": "User is banned"}), 403)
+
+        # Handle the summaries query; create a list of summary dictionaries (and an index into it by conversation ID)
+        summaries = []
+        summaries_by_id = dict()
+        for curr_conv_id, status, isArchived, unreadCount, last_message_id, sender_username, sender_display_name, preview, dateandtime in summaries_query_result:
+            last_message = None if last_message_id == None else {"id": last_message_id, "sender": {"username": sender_username, "displayName": sender_display_name}, "preview": preview, "dateTime": str(dateandtime)}
+            summaries_by_id[curr_conv_id] = {"id": curr_conv_id, "status": status, "labels": [], "isArchived": bool(isArchived), "isRead": unreadCount == 0, "unreadCount": unreadCount, "lastMessage": last_message}
+            summaries.append(summaries_by_id[curr_conv_id])
+
+        # Handle the labels query; add each label to its conversation's list of labels
+        cur.nextset()
+        for curr_conv_id, label_body in cur.fetchall():
+            summaries_by_id[curr_conv_id]["labels"].append(label_body)
+
+        # Move on from the final query
+        cur.nextset()
+    except mariadb.Error as e:
+        print(f"Error when getting conversation summaries: {e}")
+    finally:
+        # Close the database connection
+        conn.close()
+
+    # Respond with the list of summaries
+    return make_response(jsonify({"conversations": summaries}), 200)
+
+# Each user's facet counts, keyed by username and stored with the conversations version they were computed at.
+# Any write the user could see changes that version (see get_conversations_version), so a cached entry is only used while it is still current.
+facets_cache = TTLCache(ttl=float(os.getenv("FACETS_CACHE_TTL", 300)), max_size=int(os.getenv("FACETS_CACHE_SIZE", 10000)))
+
+def get_facets_version():
+    '''Get the signed-in user's conversations version, remembering it for the rest of the request so that it is only queried once.'''
+    flask.g.facets_version = get_conversations_version(flask.session.get('CAS_USERNAME'))
+    return flask.g.facets_version
+
+@app.route("/api/conversations/facets")
+@conditional_get(get_facets_version, user_is_not_banned)
+def get_conversation_facets():
+    '''Get counts of the conversations to which the signed-in user currently has access: per status, per label, archived/unarchived, and unread (conversations and messages).
+    Lets the client show filter counts without downloading every conversation.'''
+
+    # prevent non-signed in users from accessing
+    if flask.session.get('CAS_USERNAME') == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Use the cached counts if nothing has changed since they were computed
+    version = flask.g.facets_version if 'facets_version' in flask.g else get_facets_version()
+    cached = facets_cache.get(flask.session.get('CAS_USERNAME'))
+    if version != None and cached != None and cached[0] == version:
+        return make_response(jsonify(cached[1]), 200)
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    try:
+
+        # Call the stored procedure for getting the facet counts
+        cur.callproc("get_conversation_facets", (flask.session.get('CAS_USERNAME'),))
+        statuses_query_result = cur.fetchall()
+
+        # Respond appropriately if the stored procedure determined that the requester was not authorized
+        if statuses_query_result == [(-403,)]:
+            return make_response(jsonify({"message": "User is banned"}), 403)
+
+        # Handle the status and label counts queries
+        statuses = {status: count for status, count in statuses_query_result}
+        cur.nextset()
+        labels = {label_body: count for label_body, count in cur.fetchall()}
+
+        # Handle the totals query
+        cur.nextset()
+        total, archived, unread, unread_messages = cur.fetchone()
+
+        # Move on from the final query
+        cur.nextset()
+    except mariadb.Error as e:
+        print(f"Error when getting conversation facets: {e}")
+        return make_response(jsonify({"message": "Error when getting conversation facets"}), 500)
+    finally:
+        # Close the database connection
+        conn.close()
+
+    # Cache and respond with the counts
+    facets = {"statuses": statuses, "labels": labels, "total": int(total), "archived": int(archived), "unarchived": int(total - archived), "unread": int(unread), "unreadMessages": int(unread_messages)}
+    facets_cache.set(flask.session.get('CAS_USERNAME'), (version, facets))
+    return make_response(jsonify(facets), 200)
+
+# Number of search results per page when no `limit` is given, and the most that can be requested
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+def encode_search_cursor(score, conversation_id):
+    '''Turn the score and ID of the last search result on a page into an opaque cursor for the client.
+    The score is written in hexadecimal (float.hex), so that it comes back as exactly the same DOUBLE and results that tie with it are neither skipped nor repeated.'''
+    return base64.urlsafe_b64encode(f"{float(score).hex()}:{conversation_id}".encode()).decode()
+
+def decode_search_cursor(cursor):
+    '''Turn a search cursor from the client back into a tuple of (score, conversation ID), or return None if the cursor is invalid.'''
+    try:
+        score, conversation_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        score = float.fromhex(score)
+        if not math.isfinite(score):
+            return None
+        return score, int(conversation_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+@app.route("/api/conversations/search")
+def search_conversations():
+    '''Search the messages and labels of the conversations to which the signed-in user currently has access, using the query parameter `q`.
+    Responds with the matching conversations, most relevant first, each with its relevance score and best matching message (whose sender is shown only if it would be in the conversation itself; admins can pass `overrideAnonymity=true`).
+    Supports pagination with `limit` (at most 100; 20 by default) and `cursor` (the `nextCursor` from the previous page, which is null on the last page).'''
+
+    # prevent non-signed in users from accessing
+    if flask.session.get('CAS_USERNAME') == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Get and validate the search query
+    query = (request.args.get("q") or "").strip()
+    if query == "" or len(query) > 200:
+        return make_response(jsonify({"message": "The query parameter 'q' must be between 1 and 200 characters long"}), 400)
+
+    # Determine whether or not the user requested to override all anonymity within the results
+    anonymityOverrideRequested = 1 if request.args.get("overrideAnonymity") == "true" else 0
+
+    # Get the pagination parameters
+    limit = request.args.get("limit", str(SEARCH_DEFAULT_LIMIT))
+    if not limit.isdigit() or not 0 < int(limit) <= SEARCH_MAX_LIMIT:
+        return make_response(jsonify({"message": f"The query parameter 'limit' must be an integer between 1 and {SEARCH_MAX_LIMIT}"}), 400)
+    limit = int(limit)
+    after_score, after_conv_id = None, None
+    if request.args.get("cursor") != None:
+        cursor = decode_search_cursor(request.args.get("cursor"))
+        if cursor == None:
+            return make_response(jsonify({"message": "The query parameter 'cursor' is not a valid search cursor"}), 400)
+        after_score, after_conv_id = cursor
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    try:
+
+        # Call the stored procedure for searching the conversations (which returns one extra result, to tell whether there is another page)
+        cur.callproc("search_conversations", (flask.session.get('CAS_USERNAME'), query, anonymityOverrideRequested, after_score, after_conv_id, limit))
+        search_query_result = cur.fetchall()
+
+        # Respond appropriately if the stored procedure determined that the requester was not authorized
+        if search_query_result == [(-403,)]:
+            return make_response(jsonify({"message": "User is banned"}), 403)
+
+        # Handle the results query; create a list of result dictionaries (and an index into it by conversation ID)
+        has_next_page = len(search_query_result) > limit
+        search_query_result = search_query_result[:limit]
+        results = []
+        results_by_id = dict()
+        for curr_conv_id, score, status, message_id, sender_username, sender_display_name, preview, dateandtime in search_query_result:
+            best_message = None if message_id == None else {"id": message_id, "sender": {"username": sender_username, "displayName": sender_display_name}, "preview": preview, "dateTime": str(dateandtime)}
+            results_by_id[curr_conv_id] = {"id": curr_conv_id, "score": score, "status": status, "labels": [], "bestMessage": best_message}
+            results.append(results_by_id[curr_conv_id])
+
+        # Handle the labels query; add each label to its conversation's list of labels
+        cur.nextset()
+        for curr_conv_id, label_body in cur.fetchall():
+            results_by_id[curr_conv_id]["labels"].append(label_body)
+
+        # Move on from the final query
+        cur.nextset()
+    except mariadb.Error as e:
+        print(f"Error when searching conversations: {e}")
+        return make_response(jsonify({"message": "Error when searching conversations"}), 500)
+    finally:
+        # Close the database connection
+        conn.close()
+
+    # Respond with the page of results, and the cursor for the next page
+    next_cursor = encode_search_cursor(results[-1]["score"], results[-1]["id"]) if has_next_page else None
+    return make_response(jsonify({"conversations": results, "nextCursor": next_cursor}), 200)
+
+def get_pagination_args():
+    '''Parse the optional keyset pagination query parameters: `after` (only return items with IDs greater than this) and `limit` (the maximum number of items to return).
+    Return a tuple of (after, limit, error_message), in which after and limit are None if not provided, and error_message is None unless a parameter is invalid.'''
+
+    values = []
+    for param in ["after", "limit"]:
+        value = request.args.get(param)
+        if value == None:
+            values.append(None)
+            continue
+        if not value.isdigit() or (param == "limit" and int(value) == 0):
+            return None, None, f"The query parameter '{param}' must be a {'positive' if param == 'limit' else 'non-negative'} integer"
+        values.append(int(value))
+    return values[0], values[1], None
+
+# How far (in seconds) before the previous watermark a delta sync looks for changes, so that changes committed slightly out of order aren't missed.
+# Clients should merge delta sync results by ID, since changes within this window may be sent twice.
+DELTA_SYNC_OVERLAP_SECONDS = 5
+
+def encode_sync_token(watermark):
+    '''Turn a watermark (a UNIX timestamp from the database) into an opaque sync token for the client.'''
+    return base64.urlsafe_b64encode(str(watermark).encode()).decode()
+
+def decode_sync_token(token):
+    '''Turn a sync token from the client back into a watermark, or return None if the token is invalid. An empty token means "from the beginning".'''
+    if token == "":
+        return Decimal(0)
+    try:
+        return Decimal(base64.urlsafe_b64decode(token.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, InvalidOperation, ValueError):
+        return None
+
+def add_messages_and_labels(cur, conversations):
+    '''Consume the messages and labels result sets that follow the conversations result set in get_conversations and get_conversation_changes,
+    adding each message and label to the corresponding conversation in the conversations dict.'''
+
+    # Handle the messages query; add each message to its conversation's messages dictionary
+    cur.nextset()
+    for curr_conv_id, message_id, sender_username, sender_display_name, message_body, dateandtime, isRead in cur.fetchall():
+        conversations[curr_conv_id]["messages"][message_id] = {"sender": {"username": sender_username, "displayName": sender_display_name}, "body": message_body, "dateTime": str(dateandtime), "isRead": bool(isRead)}
+
+    # Handle the labels query; add each label to its conversation's list of labels
+    cur.nextset()
+    for curr_conv_id, label_body in cur.fetchall():
+        conversations[curr_conv_id]["labels"].append(label_body)
+
+# Number of rows read from the database at a time when streaming the list of conversations (each batch is written to the response before the next one is read)
+STREAM_FETCH_SIZE = 500
+
+def close_streaming_cursor(conn, cur):
+    '''Close an unbuffered cursor (discarding any rows it hasn't read), then its connection, which returns the connection to the pool.'''
+    try:
+        cur.close()
+    except mariadb.Error as e:
+        print(f"Error when closing streaming cursor: {e}")
+    finally:
+        conn.close()
+
+def generate_conversations_json(conn, cur, first_rows, paginated):
+    '''Generate the JSON for the list of conversations, piece by piece, from the single result set of the stream_conversations stored procedure (starting with first_rows, which have already been fetched).
+    The JSON is the same as get_conversations would build with jsonify, but only one batch of rows is held in memory at a time. Closes the cursor and the connection when done.'''
+
+    # Which part of the current conversation is being written ("labels" or "messages"), and how many items have been written in it so far
+    part = None
+    num_items = 0
+    last_conv_id = None
+    try:
+        chunk = ['{"conversations": {' if paginated else '{']
+        rows = first_rows
+        while rows:
+            for curr_conv_id, row_type, message_id, status, isArchived, ownIdentityRevealed, allIdentitiesRevealed, unreadCount, label_body, sender_username, sender_display_name, message_body, dateandtime, isRead in rows:
+
+                # A conversation's own row: close the previous conversation, then write everything but the labels and messages, which follow in their own rows
+                if row_type == 0:
+                    if part != None:
+                        chunk.append('], "messages": {}}' if part == "labels" else '}}')
+                    conversation = {"status": status, "isArchived": bool(isArchived), "allIdentitiesRevealed": bool(allIdentitiesRevealed), "ownIdentityRevealed": bool(ownIdentityRevealed), "isRead": unreadCount == 0, "unreadCount": unreadCount}
+                    chunk.append(f'{"," if last_conv_id != None else ""}"{curr_conv_id}": {json.dumps(conversation)[:-1]}, "labels": [')
+                    part, num_items, last_conv_id = "labels", 0, curr_conv_id
+
+                # A label row
+                elif row_type == 1:
+                    chunk.append(f'{"," if num_items > 0 else ""}{json.dumps(label_body)}')
+                    num_items += 1
+
+                # A message row: the conversation's labels are done once its first message arrives
+                else:
+                    if part == "labels":
+                        chunk.append('], "messages": {')
+                        part, num_items = "messages", 0
+                    message = {"sender": {"username": sender_username, "displayName": sender_display_name}, "body": message_body, "dateTime": str(dateandtime), "isRead": bool(isRead)}
+                    chunk.append(f'{"," if num_items > 0 else ""}"{message_id}": {json.dumps(message)}')
+                    num_items += 1
+
+            # Write this batch, then read the next one
+            yield "".join(chunk)
+            chunk = []
+            rows = cur.fetchmany(STREAM_FETCH_SIZE)
+
+        # Close the last conversation and the conversations object, adding the cursor for the next page if the user requested pagination
+        if part != None:
+            chunk.append('], "messages": {}}' if part == "labels" else '}}')
+        chunk.append('}')
+        cur.nextset()
+        has_more = bool(cur.fetchone()[0])
+        cur.nextset()
+        if paginated:
+            chunk.append(f', "nextCursor": {json.dumps(last_conv_id if has_more else None)}}}')
+        yield "".join(chunk)
+    except mariadb.Error as e:
+        # The status and headers have already been sent, so all that can be done is to cut the response short (leaving invalid JSON for the client to reject)
+        print(f"Error when streaming conversations: {e}")
+    finally:
+        # Close the cursor, then the database connection
+        close_streaming_cursor(conn, cur)
+
+def stream_conversations_response(anonymityOverrideRequested, after, limit):
+    '''Respond with the list of conversations (as get_conversations does for the same parameters), streaming the JSON as the rows are read instead of building it all in memory first.'''
+
+    # Get a database connection from the pool and an unbuffered cursor on it (rather than get_conn_and_cursor's buffered one), so that rows are read from the server only as they're needed
+    try:
+        conn = get_pool().get_connection()
+        cur = conn.cursor(buffered=False)
+    except mariadb.Error as e:
+        print(f"Error when getting connection for streaming conversations: {e}")
+        return make_response(jsonify({"message": "Error when getting conversations"}), 500)
+
+    try:
+
+        # Call the stored procedure that returns the conversations, their labels and their messages as a single result set in conversation order
+        cur.callproc("stream_conversations", (flask.session.get('CAS_USERNAME'), anonymityOverrideRequested, after, limit))
+        first_rows = cur.fetchmany(STREAM_FETCH_SIZE)
+
+        # Respond appropriately if the stored procedure determined that the requester was not authorized
+        if first_rows == [(-403,)]:
+            close_streaming_cursor(conn, cur)
+            return make_response(jsonify({"message": "User is banned"}), 403)
+    except mariadb.Error as e:
+        print(f"Error when streaming conversations: {e}")
+        close_streaming_cursor(conn, cur)
+        return make_response(jsonify({"message": "Error when getting conversations"}), 500)
+
+    # The generator closes the connection once the whole response has been written
+    return flask.Response(generate_conversations_json(conn, cur, first_rows, after != None or limit != None), mimetype='application/json')
+
+def may_get_conversations(conversation_id):
+    '''Return True iff the signed-in user may get the list of conversations (if conversation_id is None) or the specified conversation, for conditional_get.'''
+    if conversation_id == None:
+        return user_is_not_banned()
+    return conversation_id.isdigit() and can_access_conversation(flask.session.get('CAS_USERNAME'), int(conversation_id))
+
 @app.route("/api/conversations", defaults={'conversation_id': None})
 @app.route("/api/conversations/<conversation_id>")
+@conditional_get(lambda conversation_id: get_conversations_version(flask.session.get('CAS_USERNAME'), conversation_id), may_get_conversations)
 def get_conversations(conversation_id = None):
-    '''Get all the conversations to which the signed-in user currently has access (if no conversation_id is given), or get all of the data for a specified conversation (if a conversation_id is given).'''
+    '''Get all the conversations to which the signed-in user currently has access (if no conversation_id is given), or get all of the data for a specified conversation (if a conversation_id is given).
+    Both support keyset pagination with the `after` and `limit` query parameters (over conversation IDs or message IDs, respectively), in which case the response includes the `nextCursor` to pass as `after` for the next page (null on the last page).
+    The list of conversations can also be streamed with `stream=true` (same JSON; see stream_conversations_response).
+    Both also support delta sync: `since=<syncToken>` (use an empty token the first time) returns only the conversations that changed since the token was issued, with only their new messages, along with the next `syncToken`;
+    `sinceMessageId=<id>` returns a conversation with only the messages after that one.'''
 
     # prevent non-signed in users from accessing
     if flask.session.get('CAS_USERNAME') == None:
@@ -130,98 +516,143 @@ def get_conversations(conversation_id = None):
         resp.headers.set('WWW-Authenticate', 'CAS')
         return resp
 
+    # Determine whether or not the user requested to override all anonymity within the requested conversation(s)
+    anonymityOverrideRequested = 1 if request.args.get("overrideAnonymity") == "true" else 0
+
+    # Get the pagination parameters (conversation IDs for the list of conversations, message IDs for a specific conversation)
+    after, limit, pagination_error = get_pagination_args()
+    if pagination_error != None:
+        return make_response(jsonify({"message": pagination_error}), 400)
+
+    # Get the delta sync parameters: a sync token for the list of conversations, or the last message ID the client already has for a specific conversation
+    since = None
+    if request.args.get("since") != None:
+        since = decode_sync_token(request.args.get("since"))
+        if since == None:
+            return make_response(jsonify({"message": "The query parameter 'since' is not a valid sync token"}), 400)
+    if request.args.get("sinceMessageId") != None and after == None:
+        if not request.args.get("sinceMessageId").isdigit():
+            return make_response(jsonify({"message": "The query parameter 'sinceMessageId' must be a non-negative integer"}), 400)
+        after = int(request.args.get("sinceMessageId"))
+
+    # Stream the list of conversations if requested (`stream=true`), so that large lists are never held in memory all at once
+    if conversation_id == None and since == None and request.args.get("stream") == "true":
+        return stream_conversations_response(anonymityOverrideRequested, after, limit)
+
     # Get database connection and cursor
     conn, cur = get_conn_and_cursor()
 
     try:
 
-        # Determine whether this is a request for all of a user's conversations or for a specific conversation
-        if conversation_id == None:
-            
-            # Need to get all conversations to which this user has access
-            # Call the stored procedure for getting all such conversation IDs
-            cur.callproc("get_conversation_ids", (flask.session.get('CAS_USERNAME'),))
-            
-            # Map list of 1-tuples to list of integers
-            conv_ids_to_get = [row[0] for row in cur.fetchall()]
-            
-            # Move on from this query
-            cur.nextset()
+        # Determine whether this is a request for changes to a user's conversations since a watermark
+        if conversation_id == None and since != None:
+
+            # Call the stored procedure for getting the conversations that changed since the watermark (less the overlap window)
+            cur.callproc("get_conversation_changes", (flask.session.get('CAS_USERNAME'), max(since - DELTA_SYNC_OVERLAP_SECONDS, 0)))
+            watermark_query_result = cur.fetchall()
 
             # Respond appropriately if the stored procedure determined that the requester was not authorized
-            if conv_ids_to_get == [-403]:
+            if watermark_query_result == [(-403,)]:
                 return make_response(jsonify({"message": "User is banned"}), 403)
-        else:
-            
-            # Need to get only the conversation specified in the URL
-            conv_ids_to_get = [conversation_id]
 
-        # Determine whether or not the user requested to override all anonymity within the requested conversation(s)
-        anonymityOverrideRequested = 1 if request.args.get("overrideAnonymity") == "true" else 0
+            # Handle the changed conversations query; messagesComplete indicates whether all of a conversation's messages are included (e.g., because anonymity changed), or only the new ones
+            cur.nextset()
+            conversations = dict()
+            for curr_conv_id, status, isArchived, ownIdentityRevealed, allIdentitiesRevealed, unreadCount, resendAllMessages in cur.fetchall():
+                conversations[curr_conv_id] = {"messages": dict(), "messagesComplete": bool(resendAllMessages), "status": status, "labels": [], "isArchived": bool(isArchived), "allIdentitiesRevealed": bool(allIdentitiesRevealed), "ownIdentityRevealed": bool(ownIdentityRevealed), "isRead": unreadCount == 0, "unreadCount": unreadCount}
 
-        # Create a dictionary to map conversation ID to conversation data dictionary
-        conversations = dict()
+            # Handle the messages and labels queries
+            add_messages_and_labels(cur, conversations)
 
-        # Loop through list of conversation IDs and add the appropriate key/value (ID/data) pairs to the dictionary
-        for curr_conv_id in conv_ids_to_get:
-            
-            # Call the stored procedure for getting data about a conversation
-            cur.callproc("get_conversation", (curr_conv_id, flask.session.get('CAS_USERNAME'), anonymityOverrideRequested))
-            messages_query_result = cur.fetchall()
+            # Handle the query for conversations to which the user no longer has access
             cur.nextset()
+            removed_conversation_ids = [row[0] for row in cur.fetchall()]
 
-            # Respond appropriately if the stored procedure determined that the requester was not authorized
-            if messages_query_result == [(-403,)]:
-                return make_response(jsonify({"message": f"User is either banned or not authorized to view conversation #{curr_conv_id}"}), 403)
+            # Move on from the final query
+            cur.nextset()
 
-            # Respond appropriately if the stored procedure determined that a requested conversation does not exist
-            if messages_query_result == [(-404,)]:
-                return make_response(jsonify({"message": f"Conversation #{curr_conv_id} not found"}), 404)
+            # Respond with the changes and the token to use for the next delta sync
+            return make_response(jsonify({"conversations": conversations, "removedConversationIds": removed_conversation_ids, "syncToken": encode_sync_token(watermark_query_result[0][0])}), 200)
 
-            # Handle the messages query; create a dictionary comprising the messages data
-            messages = dict()
-            for message_id, sender_username, sender_display_name, message_body, dateandtime, isRead in messages_query_result:
-                messages[message_id] = {"sender": {"username": sender_username, "displayName": sender_display_name}, "body": message_body, "dateTime": str(dateandtime), "isRead": bool(isRead)}
+        # Determine whether this is a request for all of a user's conversations or for a specific conversation
+        if conversation_id == None:
             
-            # Handle the status query; store status as a string
-            status = cur.fetchone()[0]
+            # Need to get all conversations to which this user has access
+            # Call the stored procedure that gets all of them at once, in a fixed number of queries
+            cur.callproc("get_conversations", (flask.session.get('CAS_USERNAME'), anonymityOverrideRequested, after, limit))
+            conversations_query_result = cur.fetchall()
 
-            # Handle the labels query; store them in a list of strings
-            cur.nextset()
-            labels = []
-            for row in cur.fetchall():
-                labels.append(row[0])
-            
-            # Handle the isArchived query; store result in a boolean
-            cur.nextset()
-            isArchived = bool(cur.fetchone()[0])
+            # Respond appropriately if the stored procedure determined that the requester was not authorized
+            if conversations_query_result == [(-403,)]:
+                return make_response(jsonify({"message": "User is banned"}), 403)
 
-            # Handle the all identities revealed query; store result in a boolean
-            cur.nextset()
-            allIdentitiesRevealed = bool(cur.fetchone()[0])
-            
-            # Handle the own identity revealed query; store result in a boolean
-            cur.nextset()
-            ownIdentityRevealed = bool(cur.fetchone()[0])
+            # Handle the conversations query; create a dictionary mapping conversation ID to conversation data dictionary
+            conversations = dict()
+            for curr_conv_id, status, isArchived, ownIdentityRevealed, allIdentitiesRevealed, unreadCount in conversations_query_result:
+                conversations[curr_conv_id] = {"messages": dict(), "status": status, "labels": [], "isArchived": bool(isArchived), "allIdentitiesRevealed": bool(allIdentitiesRevealed), "ownIdentityRevealed": bool(ownIdentityRevealed), "isRead": unreadCount == 0, "unreadCount": unreadCount}
+
+            # Handle the messages and labels queries
+            add_messages_and_labels(cur, conversations)
 
-            # Handle the all messages read query; store result in a boolean
+            # Handle the query indicating whether there are more conversations after this page
             cur.nextset()
-            allMessagesRead = bool(cur.fetchone()[0])
+            has_more = bool(cur.fetchone()[0])
 
             # Move on from the final query
             cur.nextset()
 
-            # Add this key/value (conversation id/conversation data) pair to the conversations dict
-            conversations[curr_conv_id] = {"messages": messages, "status": status, "labels": labels, "isArchived": isArchived, "allIdentitiesRevealed": allIdentitiesRevealed, "ownIdentityRevealed": ownIdentityRevealed, "isRead": allMessagesRead}
+            # Respond with just the conversations dict, unless the user requested pagination, in which case also include the cursor for the next page
+            if after == None and limit == None:
+                return make_response(jsonify(conversations), 200)
+            next_cursor = max(conversations) if has_more else None
+            return make_response(jsonify({"conversations": conversations, "nextCursor": next_cursor}), 200)
+
+        # Call the stored procedure for getting data about the conversation specified in the URL
+        cur.callproc("get_conversation", (conversation_id, flask.session.get('CAS_USERNAME'), anonymityOverrideRequested, after, limit))
+        messages_query_result = cur.fetchall()
+        cur.nextset()
+
+        # Respond appropriately if the stored procedure determined that the requester was not authorized
+        if messages_query_result == [(-403,)]:
+            return make_response(jsonify({"message": f"User is either banned or not authorized to view conversation #{conversation_id}"}), 403)
+
+        # Respond appropriately if the stored procedure determined that the requested conversation does not exist
+        if messages_query_result == [(-404,)]:
+            return make_response(jsonify({"message": f"Conversation #{conversation_id} not found"}), 404)
+
+        # The stored procedure returns one message more than the limit if there are more messages after this page; leave that one for the next page
+        next_cursor = None
+        if limit != None and len(messages_query_result) > limit:
+            messages_query_result = messages_query_result[:limit]
+            next_cursor = messages_query_result[-1][0]
+
+        # Handle the messages query; create a dictionary comprising the messages data
+        messages = dict()
+        for message_id, sender_username, sender_display_name, message_body, dateandtime, isRead in messages_query_result:
+            messages[message_id] = {"sender": {"username": sender_username, "displayName": sender_display_name}, "body": message_body, "dateTime": str(dateandtime), "isRead": bool(isRead)}
+        
+        # Handle the status and flags query (a single row)
+        status, isArchived, allIdentitiesRevealed, ownIdentityRevealed, allMessagesRead = cur.fetchone()
+
+        # Handle the labels query; store them in a list of strings
+        cur.nextset()
+        labels = []
+        for row in cur.fetchall():
+            labels.append(row[0])
+
+        # Move on from the final query
+        cur.nextset()
+
+        # Collect the data for the requested conversation
+        conversation = {"messages": messages, "status": status, "labels": labels, "isArchived": bool(isArchived), "allIdentitiesRevealed": bool(allIdentitiesRevealed), "ownIdentityRevealed": bool(ownIdentityRevealed), "isRead": bool(allMessagesRead), "nextCursor": next_cursor}
     except mariadb.Error as e:
         print(f"Error when getting conversation data: {e}")
     finally:
         # Close the database connection
         conn.close()
 
-    # Respond with the conversations dict if the user requested all of their conversations;
-    # respond with just the data for the desired conversation if the user requested only a specific conversation
-    return make_response(jsonify(conversations if conversation_id == None else conversations[conversation_id]), 200)
+    # Respond with the data for the requested conversation
+    return make_response(jsonify(conversation), 200)
 
 
 @app.route("/api/conversations/<conversation_id>", methods=["PATCH"])
@@ -313,6 +744,14 @@ def update_conversation(conversation_id):
         # Commit database changes down here only so that either everything succeeds or nothing does, consistent with the response code/message
         if len(success_messages):
             conn.commit()
+
+            # Let everyone streaming this conversation know what changed (archiving only matters to the user who archived it)
+            if 'setStatus' in request_dict and request_dict['setStatus'] != None:
+                event_bus.publish('status_changed', {"conversationId": int(conversation_id), "status": request_dict['setStatus']}, int(conversation_id))
+            if 'setArchived' in request_dict and request_dict['setArchived'] != None:
+                event_bus.publish('archive_changed', {"conversationId": int(conversation_id), "isArchived": bool(request_dict['setArchived'])}, int(conversation_id), flask.session.get('CAS_USERNAME'))
+            if 'revealIdentity' in request_dict and request_dict['revealIdentity']:
+                event_bus.publish('identity_revealed', {"conversationId": int(conversation_id)}, int(conversation_id))
     except mariadb.Error as e:
         print(f"Error when modifying conversation: {e}")
     finally:
@@ -321,3 +760,74 @@ def update_conversation(conversation_id):
 
     # Send a response with all of the accrued success messages
     return make_response(jsonify({"message": ", ".join(success_messages)}), 200)
+
+
+# Maximum number of conversations marked as read per stored procedure call
+MARK_READ_BATCH_SIZE = 500
+
+@app.route("/api/conversations/read", methods=["POST"])
+def mark_conversations_read():
+    '''Mark messages as read in many conversations at once.
+    The request body is of the form {"conversations": [{"conversationId": 1, "upToMessageId": 10}, ...]}, meaning that the requester has read every message in conversation #1 up to and including message #10.
+    Read watermarks only move forward, so marking messages that were already read has no effect.
+    Responds with the requester's resulting read state in each of the conversations they can access, and the IDs of any they can't (which are left alone).'''
+
+    # prevent non-signed in users from accessing
+    if flask.session.get('CAS_USERNAME') == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Confirm that the request has the correct content type
+    request_dict = request.get_json()
+    if request_dict == None:
+        return make_response(jsonify(message="Bad request. Please check that Content-Type is application/json"), 400)
+
+    # Confirm that the request body lists (conversation ID, message ID) pairs, keeping only the highest message ID given for each conversation
+    if not isinstance(request_dict.get('conversations'), list):
+        return make_response(jsonify({"message": "Bad request. 'conversations' must be a list of objects with 'conversationId' and 'upToMessageId'"}), 400)
+    up_to_message_ids = dict()
+    for pair in request_dict['conversations']:
+        if not isinstance(pair, dict) or any(type(pair.get(key)) != int for key in ('conversationId', 'upToMessageId')):
+            return make_response(jsonify({"message": "Bad request. 'conversations' must be a list of objects with 'conversationId' and 'upToMessageId'"}), 400)
+        up_to_message_ids[pair['conversationId']] = max(pair['upToMessageId'], up_to_message_ids.get(pair['conversationId'], 0))
+    pairs = list(up_to_message_ids.items())
+
+    # Get the connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    try:
+        read_states = dict()
+        for batch_start in range(0, len(pairs), MARK_READ_BATCH_SIZE):
+
+            # Load this batch into a temporary table, then call the stored procedure that applies all of it in one statement
+            cur.execute("CREATE OR REPLACE TEMPORARY TABLE ReadUpdates (conversationId INT PRIMARY KEY, upToMessageId INT);")
+            cur.executemany("INSERT INTO ReadUpdates (conversationId, upToMessageId) VALUES (?, ?);", pairs[batch_start:batch_start + MARK_READ_BATCH_SIZE])
+            cur.callproc("mark_conversations_read", (flask.session.get('CAS_USERNAME'),))
+            read_query_result = cur.fetchall()
+            cur.nextset()
+
+            # Respond appropriately if the stored procedure determined that the requester was not authorized
+            if read_query_result == [(-403,)]:
+                return make_response(jsonify({"message": "User is banned"}), 403)
+
+            for conv_id, last_read_message_id, unread_count in read_query_result:
+                read_states[conv_id] = {"lastReadMessageId": last_read_message_id, "unreadCount": unread_count}
+        cur.execute("DROP TEMPORARY TABLE IF EXISTS ReadUpdates;")
+
+        # Commit only once every batch has been applied, so that either everything succeeds or nothing does
+        conn.commit()
+    except mariadb.Error as e:
+        print(f"Error when marking conversations as read: {e}")
+        return make_response(jsonify({"message": "Error when marking conversations as read"}), 500)
+    finally:
+        # Close the database connection
+        conn.close()
+
+    # Let the requester's other open streams (e.g., on other devices) know about their new read state
+    for conv_id, read_state in read_states.items():
+        event_bus.publish('read_state_changed', {"conversationId": conv_id, **read_state}, conv_id, flask.session.get('CAS_USERNAME'))
+
+    # Respond with the read state of each accessible conversation, and the IDs of the rest
+    not_updated = [conv_id for conv_id, up_to_message_id in pairs if conv_id not in read_states]
+    return make_response(jsonify({"conversations": read_states, "notUpdated": not_updated}), 200)
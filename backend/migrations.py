@@ -0,0 +1,227 @@
+import hashlib
+import os
+import re
+import sys
+import time
+import mariadb
+from database_handler import get_new_db_connection, get_stored_procedures
+
+# Versioned schema migrations for the database.
+# The SchemaVersion table records which of the MIGRATIONS below have been applied, and running this file applies the rest, in order, then redeploys every stored procedure whose definition has changed.
+# To change the schema (e.g., add a column or an index), append a new migration to the end of MIGRATIONS; never edit or reorder one that has already been released,
+# since deployed databases won't run it again. To change a stored procedure, just edit it in database_handler.get_stored_procedures().
+#
+# Usage (from the backend directory): python3 migrations.py [--dry-run]
+# With --dry-run, the pending migrations and procedure changes are printed but not applied.
+#
+# Databases created before SchemaVersion existed start at version 0, so every migration must be safe to run against a database that already has some or all of its changes
+# (hence CREATE TABLE IF NOT EXISTS, ADD COLUMN IF NOT EXISTS, and so on).
+
+class Backfill:
+    '''A data migration step that runs its statement on one range of primary keys at a time, committing after each chunk,
+    so that it never locks more than a chunk of rows and can run against a live database.
+    The statement must contain "{chunk}", which is replaced with the condition that selects the current chunk's rows (e.g., "UPDATE Messages SET ... WHERE {chunk};").
+    If only_if is given, it's a query whose result decides whether the backfill runs at all (e.g., whether the table it copies from exists).
+    A migration is only recorded once all of its steps have finished, so an interrupted backfill starts over from the first chunk: its statement must be safe to rerun.'''
+
+    def __init__(self, table, statement, only_if=None, key="id"):
+        self.table = table
+        self.statement = statement
+        self.only_if = only_if
+        self.key = key
+
+    def __str__(self):
+        return f"Backfill of {self.table} in chunks of {self.key}: {self.statement}" + (f" (only if {self.only_if})" if self.only_if != None else "")
+
+    def run(self, conn, cur, chunk_size):
+        if self.only_if != None:
+            cur.execute(self.only_if)
+            if not cur.fetchone()[0]:
+                print("    Skipped (condition not met)")
+                return
+        cur.execute(f"SELECT MIN({self.key}), MAX({self.key}) FROM {self.table};")
+        first_key, last_key = cur.fetchone()
+        if first_key == None:
+            return
+        statement = self.statement.replace("{chunk}", f"{self.table}.{self.key} BETWEEN ? AND ?")
+        num_updated = 0
+        for chunk_start in range(first_key, last_key + 1, chunk_size):
+            cur.execute(statement, (chunk_start, chunk_start + chunk_size - 1))
+            num_updated += cur.rowcount
+            conn.commit()
+        print(f"    Updated {num_updated} rows of {self.table}")
+
+# Each migration is (version, description, steps), where each step is either a SQL statement or a Backfill
+MIGRATIONS = [
+    (1, "Create the initial tables", [
+        "CREATE TABLE IF NOT EXISTS Users (username VARCHAR(40), displayName VARCHAR(100), isBanned BOOL, isCCSGA BOOL, isAdmin BOOL, rolesLastUpdated DATETIME, updatedBy VARCHAR(40), PRIMARY KEY (username), FOREIGN KEY (updatedBy) REFERENCES Users(username));",
+        "CREATE TABLE IF NOT EXISTS Conversations (id INT AUTO_INCREMENT, status VARCHAR(40), PRIMARY KEY (id));",
+        "CREATE TABLE IF NOT EXISTS Messages (id INT AUTO_INCREMENT, conversationId INT, sender VARCHAR(40), body TEXT, dateandtime DATETIME, PRIMARY KEY (id), FOREIGN KEY (conversationId) REFERENCES Conversations(id), FOREIGN KEY (sender) REFERENCES Users(username));",
+        "CREATE TABLE IF NOT EXISTS Labels (id INT AUTO_INCREMENT, body VARCHAR(40), PRIMARY KEY (id), UNIQUE (body));",
+        "CREATE TABLE IF NOT EXISTS ConversationSettings (id INT AUTO_INCREMENT, conversationId INT, username VARCHAR(40), isArchived BOOL, identityRevealed BOOL, isInitiator BOOL, isAccessible BOOL DEFAULT 1, PRIMARY KEY (id), FOREIGN KEY (conversationId) REFERENCES Conversations(id), FOREIGN KEY (username) REFERENCES Users(username), UNIQUE KEY convIdAndUsername (conversationId, username));",
+        # (The initial schema also had a MessageSettings table, which migration 5 replaces, so new databases don't get it)
+        "CREATE TABLE IF NOT EXISTS AppliedLabels (id INT AUTO_INCREMENT, conversationId INT, labelId INT, PRIMARY KEY (id), FOREIGN KEY (conversationId) REFERENCES Conversations(id), FOREIGN KEY (labelId) REFERENCES Labels(id));",
+        "CREATE TABLE IF NOT EXISTS Links (id INT AUTO_INCREMENT, icon TEXT, body TEXT, url TEXT, dateandtime DATETIME, PRIMARY KEY (id));",
+        "CREATE TABLE IF NOT EXISTS Announcements (id INT AUTO_INCREMENT, icon TEXT, body TEXT, dateandtime DATETIME, PRIMARY KEY (id));"
+    ]),
+    (2, "Index messages by conversation for keyset pagination", [
+        "CREATE INDEX IF NOT EXISTS messagesConvIdAndId ON Messages (conversationId, id);"
+    ]),
+    (3, "Track when conversations and settings change, for delta sync", [
+        # identitiesRevealedAt tracks the last time anyone revealed their identity in a conversation
+        "ALTER TABLE Conversations ADD COLUMN IF NOT EXISTS updatedAt TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);",
+        "ALTER TABLE Conversations ADD COLUMN IF NOT EXISTS identitiesRevealedAt TIMESTAMP(6) NULL DEFAULT NULL;",
+        "ALTER TABLE ConversationSettings ADD COLUMN IF NOT EXISTS updatedAt TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);"
+    ]),
+    (4, "Add resource versions for ETags", [
+        "CREATE TABLE IF NOT EXISTS ResourceVersions (name VARCHAR(40), version BIGINT NOT NULL DEFAULT 0, PRIMARY KEY (name));",
+        "INSERT IGNORE INTO ResourceVersions (name, version) VALUES ('roles', 0);"
+    ]),
+    (5, "Replace per-message read state (MessageSettings) with read watermarks", [
+        # lastReadMessageId is the read watermark: a user has read every message in a conversation whose ID is at most this
+        "ALTER TABLE ConversationSettings ADD COLUMN IF NOT EXISTS lastReadMessageId INT NOT NULL DEFAULT 0;",
+        # Each watermark ends just before the user's earliest unread message in the conversation (or at the last message, if they had read everything)
+        Backfill("ConversationSettings", '''UPDATE ConversationSettings SET lastReadMessageId = COALESCE(
+                (SELECT MIN(Messages.id) - 1 FROM Messages JOIN MessageSettings ON MessageSettings.messageId = Messages.id WHERE Messages.conversationId = ConversationSettings.conversationId AND MessageSettings.username = ConversationSettings.username AND NOT MessageSettings.isRead),
+                (SELECT MAX(Messages.id) FROM Messages WHERE Messages.conversationId = ConversationSettings.conversationId),
+                0) WHERE {chunk};''',
+            only_if="SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'MessageSettings';"),
+        "DROP TABLE IF EXISTS MessageSettings;"
+    ]),
+    (6, "Index conversations by update time", [
+        "CREATE INDEX IF NOT EXISTS conversationsUpdatedAt ON Conversations (updatedAt);"
+    ]),
+    (7, "Add the background job queue", [
+        "CREATE TABLE IF NOT EXISTS Jobs (id INT AUTO_INCREMENT, type VARCHAR(40), payload TEXT, status VARCHAR(20) NOT NULL DEFAULT 'queued', attempts INT NOT NULL DEFAULT 0, maxAttempts INT NOT NULL DEFAULT 5, progress INT NOT NULL DEFAULT 0, lastError TEXT, createdBy VARCHAR(40), createdAt DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), updatedAt TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6), runAfter DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), lockedBy VARCHAR(100), lockedAt DATETIME(6), PRIMARY KEY (id), FOREIGN KEY (createdBy) REFERENCES Users(username), KEY jobsStatusAndRunAfter (status, runAfter));"
+    ]),
+    (8, "Add indexes for the stored procedures' hot queries (see benchmarks/index_advisor.py)", [
+        "CREATE INDEX IF NOT EXISTS usersIsCCSGA ON Users (isCCSGA);", # Listing reps
+        "CREATE INDEX IF NOT EXISTS usersIsAdmin ON Users (isAdmin);", # Listing and counting admins
+        "CREATE INDEX IF NOT EXISTS usersIsBanned ON Users (isBanned);", # Listing banned users
+        "CREATE INDEX IF NOT EXISTS messagesConvIdAndDateandtime ON Messages (conversationId, dateandtime);", # Delta sync's new messages, and staff read watermarks
+        "CREATE INDEX IF NOT EXISTS convSettingsUsernameAndAccess ON ConversationSettings (username, isAccessible, conversationId);", # A user's accessible conversations, in keyset (conversation ID) order
+        "CREATE INDEX IF NOT EXISTS appliedLabelsConvIdAndLabelId ON AppliedLabels (conversationId, labelId);" # A conversation's labels, without reading the table rows (the foreign key already indexes conversationId alone)
+    ]),
+    (9, "Keep a count of each user's unread messages in each conversation", [
+        # unreadCount is the number of messages in the conversation whose IDs are above lastReadMessageId; create_message and marking messages as read keep it up to date
+        "ALTER TABLE ConversationSettings ADD COLUMN IF NOT EXISTS unreadCount INT NOT NULL DEFAULT 0;",
+        Backfill("ConversationSettings", "UPDATE ConversationSettings SET unreadCount = (SELECT COUNT(*) FROM Messages WHERE Messages.conversationId = ConversationSettings.conversationId AND Messages.id > ConversationSettings.lastReadMessageId) WHERE {chunk};")
+    ]),
+    (10, "Add full-text indexes for searching conversations", [
+        # Used by search_conversations; InnoDB ignores words shorter than innodb_ft_min_token_size (3 by default) and its stopwords
+        "CREATE FULLTEXT INDEX IF NOT EXISTS messagesBodyFulltext ON Messages (body);",
+        "CREATE FULLTEXT INDEX IF NOT EXISTS labelsBodyFulltext ON Labels (body);"
+    ])
+]
+
+def create_migration_tables(cur):
+    '''Create the tables that record the applied migrations and the deployed stored procedures, if they don't already exist.'''
+
+    cur.execute("CREATE TABLE IF NOT EXISTS SchemaVersion (version INT, description VARCHAR(200), appliedAt DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), durationMs INT, PRIMARY KEY (version));")
+    cur.execute("CREATE TABLE IF NOT EXISTS SchemaProcedures (name VARCHAR(64), checksum CHAR(64), deployedAt DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6), PRIMARY KEY (name));")
+
+def table_exists(cur, table):
+    cur.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ?;", (table,))
+    return cur.fetchone()[0] > 0
+
+def get_current_version(cur):
+    '''Return the version of the latest migration that has been applied (0 if none have).'''
+
+    if not table_exists(cur, "SchemaVersion"):
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaVersion;")
+    return cur.fetchone()[0]
+
+def get_procedure_changes(cur):
+    '''Compare the stored procedures in database_handler with the ones recorded as deployed, and return a tuple of
+    (list of (name, checksum, statement) for the procedures that are new or have changed, list of names of deployed procedures that no longer exist in database_handler).'''
+
+    deployed = {}
+    if table_exists(cur, "SchemaProcedures"):
+        cur.execute("SELECT name, checksum FROM SchemaProcedures;")
+        deployed = dict(cur.fetchall())
+    cur.execute("SELECT ROUTINE_NAME FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = DATABASE() AND ROUTINE_TYPE = 'PROCEDURE';")
+    existing = {row[0] for row in cur.fetchall()}
+
+    changed = []
+    names = set()
+    for statement in get_stored_procedures():
+        name = re.match(r"\s*CREATE OR REPLACE PROCEDURE (\w+)", statement).group(1)
+        names.add(name)
+        checksum = hashlib.sha256(statement.encode()).hexdigest()
+        if deployed.get(name) != checksum or name not in existing:
+            changed.append((name, checksum, statement))
+    removed = sorted(name for name in deployed if name not in names)
+    return changed, removed
+
+def migrate(dry_run=False):
+    '''Apply the pending migrations in order, then deploy the stored procedures that are new or have changed and drop the ones that have been removed.
+    With dry_run, print what would be done without changing anything. Return True if everything succeeded.'''
+
+    chunk_size = int(os.getenv("MIGRATION_CHUNK_SIZE", 1000))
+
+    # Use a dedicated connection, since migrations can hold it for a long time
+    conn = get_new_db_connection()
+    if conn == None:
+        return False
+    cur = conn.cursor()
+    try:
+        # Make sure that only one copy of this program migrates the database at a time
+        cur.execute("SELECT GET_LOCK('schema_migrations', 0);")
+        if not cur.fetchone()[0]:
+            print("Another migration is already running; try again once it has finished")
+            return False
+
+        current_version = get_current_version(cur)
+        pending = [migration for migration in MIGRATIONS if migration[0] > current_version]
+        print(f"Database is at schema version {current_version}; {len(pending)} migration(s) pending")
+        if not dry_run:
+            create_migration_tables(cur)
+
+        for version, description, steps in pending:
+            print(f"{'Would apply' if dry_run else 'Applying'} migration {version}: {description}")
+            start = time.perf_counter()
+            for step in steps:
+                if dry_run:
+                    print(f"    {step}")
+                elif isinstance(step, Backfill):
+                    step.run(conn, cur, chunk_size)
+                else:
+                    cur.execute(step)
+            if not dry_run:
+                cur.execute("INSERT INTO SchemaVersion (version, description, durationMs) VALUES (?, ?, ?);", (version, description, int((time.perf_counter() - start) * 1000)))
+                conn.commit()
+
+        # Redeploy procedures by checksum, so that an edited procedure reaches every database without having to be dropped by hand
+        # (CREATE OR REPLACE drops and recreates a procedure, so a call that arrives in between can briefly fail)
+        changed, removed = get_procedure_changes(cur)
+        print(f"{len(changed)} stored procedure(s) to deploy, {len(removed)} to drop")
+        for name, checksum, statement in changed:
+            print(f"{'Would deploy' if dry_run else 'Deploying'} procedure {name}")
+            if not dry_run:
+                cur.execute(statement)
+                cur.execute("INSERT INTO SchemaProcedures (name, checksum) VALUES (?, ?) ON DUPLICATE KEY UPDATE checksum = VALUES(checksum), deployedAt = CURRENT_TIMESTAMP(6);", (name, checksum))
+                conn.commit()
+        for name in removed:
+            print(f"{'Would drop' if dry_run else 'Dropping'} procedure {name}")
+            if not dry_run:
+                cur.execute(f"DROP PROCEDURE IF EXISTS {name};")
+                cur.execute("DELETE FROM SchemaProcedures WHERE name = ?;", (name,))
+                conn.commit()
+        return True
+    except mariadb.Error as e:
+        print(f"Error when migrating the database: {e}")
+        conn.rollback()
+        return False
+    finally:
+        cur.execute("SELECT RELEASE_LOCK('schema_migrations');")
+        cur.fetchall()
+        conn.close()
+
+def main(args):
+    dry_run = "--dry-run" in args
+    if not migrate(dry_run):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,8 +1,8 @@
 import flask
-import mariadb
 from flask import make_response, jsonify, request
 from backend import app
-from backend.database_handler import get_conn_and_cursor, confirm_user_in_db
+from backend.database_handler import confirm_user_in_db, get_pool_stats
+from backend.route_wrappers import get_session_display_name, get_user_context, user_has_role
 
 @app.route('/api/authenticate')
 def get_user_info():
@@ -13,28 +13,29 @@ def get_user_info():
         return make_response(jsonify({'isSignedIn': False, 'username': 'not signed in', 'displayName': 'not signed in', 'isBanned': False, 'isCCSGA': False, 'isAdmin': False}), 200)
     
     # Make sure user is in database
-    try:
-        display_name = flask.session.get('CAS_ATTRIBUTES')['cas:displayName']
-    except KeyError:
-        print("Missing key 'cas:displayName' (to be used as full name) for user '%s'." % username)
-        print("Using username for full name instead (if needed)")
-        display_name = username
-    confirm_user_in_db(username, display_name)
-    
-    # Get database connection and cursor
-    conn, cur = get_conn_and_cursor()
-
-    try:
+    confirm_user_in_db(username, get_session_display_name())
 
-        # Get other attributes for this user from database
-        cur.execute("SELECT isBanned, isCCSGA, isAdmin from Users where username = ?;", (username,))
-        is_banned, is_ccsga, is_admin = cur.fetchone()
-    except mariadb.Error as e:
-        print(f"Error when getting signed-in user info: {e}")
-    finally:
-        # Close the database connection
-        conn.close()
+    # Get this user's info (including roles) from the request-scoped user context
+    user_context = get_user_context()
+    if user_context == None:
+        return make_response(jsonify({"message": "Error when getting signed-in user info"}), 500)
 
     # Send response with authenticated user info
-    return make_response(jsonify({'isSignedIn': True, 'username': username, 'displayName': display_name, 'isBanned': bool(is_banned), 'isCCSGA': bool(is_ccsga), 'isAdmin': bool(is_admin)}), 200)
+    return make_response(jsonify({'isSignedIn': True, 'username': username, 'displayName': user_context['displayName'], 'isBanned': user_context['isBanned'], 'isCCSGA': user_context['isCCSGA'], 'isAdmin': user_context['isAdmin']}), 200)
+
+@app.route('/api/db_pool_stats')
+def get_db_pool_stats():
+    '''Get statistics about the database connection pool of the worker process that handles this request (admin-restricted).'''
+
+    # prevent non-signed in users from accessing
+    if flask.session.get('CAS_USERNAME') == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Only admins may view the pool stats
+    if not user_has_role('isAdmin'):
+        return make_response(jsonify({"message": "User is not an admin, so this request is not allowed."}), 403)
 
+    # Send response with the stats for this worker's pool
+    return make_response(jsonify(get_pool_stats()), 200)
@@ -0,0 +1,137 @@
+# Prepares the Flutter web build for serving. Run it from the backend directory every time the frontend is rebuilt (after `flutter build web`), before deploying the build:
+#
+#     python3 prepare_static.py [build directory, ../frontend/build/web by default]
+#
+# First, it fingerprints the files that index.html references (e.g., main.dart.js): each one gets a copy whose name includes a hash of its contents (e.g., main.dart.3f2a9c81d0b4.js),
+# and asset-manifest.json maps the original names to the fingerprinted ones. view_handler serves index.html with the fingerprinted names in place of the originals,
+# so browsers can cache those files forever: a new build that changes a file also changes its name.
+#
+# Then it compresses the static files ahead of time, so that view_handler.static_proxy can send them compressed without compressing them on every request.
+# For each compressible file, it writes a gzip copy (file.js.gz) and, if the brotli package is installed, a brotli copy (file.js.br) next to it,
+# keeping only the copies that are actually smaller. Copies left over from files that no longer exist are removed.
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_BUILD_DIRECTORY = '../frontend/build/web'
+ASSET_MANIFEST_FILENAME = 'asset-manifest.json'
+
+# References to local files in index.html (src and href attributes); the service worker is registered from a script, so it keeps its name
+FILE_REFERENCE = re.compile(r'\b(?:src|href)="([^":?#]+)"')
+
+# Number of hex digits of the SHA-256 of a file's contents to put in its fingerprinted name
+FINGERPRINT_LENGTH = 12
+
+# Files smaller than this many bytes aren't worth compressing (the same default as COMPRESSION_MIN_SIZE in compression.py)
+MIN_SIZE = 1024
+
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.html', '.json', '.map', '.svg', '.txt', '.xml', '.wasm', '.ttf', '.otf'}
+COMPRESSED_EXTENSIONS = ('.gz', '.br')
+
+def fingerprint_files(build_directory):
+    '''Make a fingerprinted copy of every file that index.html references, write asset-manifest.json, and remove the fingerprinted copies from any previous run that are no longer used.
+    Return the manifest (a dictionary mapping each original name to its fingerprinted name).'''
+
+    manifest_path = os.path.join(build_directory, ASSET_MANIFEST_FILENAME)
+    old_manifest = dict()
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            old_manifest = json.load(f)
+
+    with open(os.path.join(build_directory, 'index.html')) as f:
+        index_html = f.read()
+    manifest = dict()
+    for name in FILE_REFERENCE.findall(index_html):
+        path = os.path.join(build_directory, name)
+        if name in manifest or not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        root, extension = os.path.splitext(name)
+        manifest[name] = f"{root}.{hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]}{extension}"
+        with open(os.path.join(build_directory, manifest[name]), 'wb') as f:
+            f.write(data)
+
+    # Remove outdated fingerprinted copies (and their precompressed copies, which are removed anyway once their originals are gone)
+    for fingerprinted_name in set(old_manifest.values()) - set(manifest.values()):
+        fingerprinted_path = os.path.join(build_directory, fingerprinted_name)
+        if os.path.isfile(fingerprinted_path):
+            os.remove(fingerprinted_path)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def compress_file(path):
+    '''Write the precompressed copies of a file, and return a dictionary mapping each extension written to the size of that copy.'''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    copies = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)} # mtime=0 makes the output depend only on the contents
+    if brotli != None:
+        copies['.br'] = brotli.compress(data, quality=11)
+
+    sizes = dict()
+    stat = os.stat(path)
+    for extension, compressed in copies.items():
+        compressed_path = path + extension
+        if len(compressed) >= len(data):
+            # Not worth it; make sure no outdated copy is left behind
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
+            continue
+        with open(compressed_path, 'wb') as f:
+            f.write(compressed)
+        os.utime(compressed_path, (stat.st_atime, stat.st_mtime)) # Give the copy the original's modification time, for Last-Modified headers
+        sizes[extension] = len(compressed)
+    return sizes
+
+def precompress_files(build_directory):
+    '''Precompress every compressible file in the build directory, remove stale copies, and print a summary.'''
+
+    total_size = 0
+    total_compressed_sizes = {extension: 0 for extension in COMPRESSED_EXTENSIONS}
+    num_files = 0
+    for directory, _, filenames in os.walk(build_directory):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            root, extension = os.path.splitext(path)
+
+            # Remove precompressed copies whose originals are gone (e.g., renamed in a new build)
+            if extension in COMPRESSED_EXTENSIONS:
+                if not os.path.exists(root):
+                    os.remove(path)
+                continue
+
+            if extension.lower() not in COMPRESSIBLE_EXTENSIONS or os.path.getsize(path) < MIN_SIZE:
+                continue
+            sizes = compress_file(path)
+            num_files += 1
+            total_size += os.path.getsize(path)
+            for compressed_extension in COMPRESSED_EXTENSIONS:
+                total_compressed_sizes[compressed_extension] += sizes.get(compressed_extension, os.path.getsize(path))
+
+    print(f"Precompressed {num_files} files ({total_size} bytes)")
+    print(f"gzip: {total_compressed_sizes['.gz']} bytes")
+    if brotli != None:
+        print(f"brotli: {total_compressed_sizes['.br']} bytes")
+    else:
+        print("brotli: skipped (install the brotli package to also make brotli copies)")
+
+if __name__ == "__main__":
+    build_directory = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_BUILD_DIRECTORY
+    if not os.path.isdir(build_directory):
+        print(f"There is no build at {build_directory}; run `flutter build web` in the frontend directory first, and run this program from the backend directory.")
+        sys.exit(1)
+    manifest = fingerprint_files(build_directory)
+    for name, fingerprinted_name in sorted(manifest.items()):
+        print(f"{name} -> {fingerprinted_name}")
+    precompress_files(build_directory)
@@ -1,29 +1,53 @@
 from functools import wraps
+import hashlib
 import flask
-from flask import abort
+from flask import abort, make_response, request
 from flask_cas import login_required
-from backend.database_handler import confirm_user_in_db, is_student, is_ccsga, is_admin
+from backend.database_handler import confirm_user_in_db, get_user_roles
+
+def get_session_display_name():
+    '''Get the signed-in user's display name from their CAS attributes, falling back on their username if no display name is provided.'''
+
+    username = flask.session.get('CAS_USERNAME')
+    try:
+        return flask.session.get('CAS_ATTRIBUTES')['cas:displayName']
+    except (KeyError, TypeError):
+        print("Missing key 'cas:displayName' (to be used as full name) for user '%s'." % username)
+        print("Using username for full name instead (if needed)")
+        return username
+
+def get_user_context():
+    '''Get a dictionary describing the signed-in user (username, displayName, isBanned, isCCSGA, isAdmin, and isStudent), or None if no user is signed in.
+    The user's roles are loaded from the database at most once per request and are stored on flask.g, so every role check within a request shares a single query.'''
+
+    if 'user_context' not in flask.g:
+
+        username = flask.session.get('CAS_USERNAME')
+        roles = get_user_roles(username)
+        if roles == None:
+            flask.g.user_context = None
+        else:
+            flask.g.user_context = {"username": username, "displayName": get_session_display_name(), **roles}
+            # User is a student iff they are neither a CCSGA rep nor an admin
+            flask.g.user_context["isStudent"] = not (roles["isCCSGA"] or roles["isAdmin"])
+
+    return flask.g.user_context
+
+def user_has_role(*roles):
+    '''Return True iff the signed-in user has at least one of the specified roles (any of 'isStudent', 'isCCSGA', and 'isAdmin').'''
+
+    user_context = get_user_context()
+    return user_context != None and any(user_context[role] for role in roles)
 
 def login_required_with_db_confirm(function):
     '''Same as flask_cas.login_required, but also make sure there's a Users entry for this user in the DB. As a rule, this should be used instead off flask_cas.login_required.'''
 
     @wraps(function)
     def wrap(*args, **kwargs):
-        
-        # Get username
-        username = flask.session.get('CAS_USERNAME')
-        
-        # Get display name, if one is provided
-        try:
-            displayName = flask.session.get('CAS_ATTRIBUTES')['cas:displayName']
-        except KeyError:
-            print("Missing key 'cas:displayName' (to be used as full name) for user '%s'." % username)
-            print("Using username for full name instead (if needed)")
-            displayName = username
-        
+
         # Confirm user is in database
-        confirm_user_in_db(username, displayName)
-        
+        confirm_user_in_db(flask.session.get('CAS_USERNAME'), get_session_display_name())
+
         # Proceed to the wrapped function
         return function(*args, **kwargs)
 
@@ -37,11 +61,11 @@ def student_required(function):
     def wrap(*args, **kwargs):
 
         # Proceed to wrapped function if user is a student; respond with a 403 error otherwise
-        if is_student(flask.session.get('CAS_USERNAME')):
+        if user_has_role('isStudent'):
             return function(*args, **kwargs)
         else:
             abort(403)
-    
+
     # Wrap this function with login_required_with_db_confirm, to require first that the User logs in and is in the database
     return login_required_with_db_confirm(wrap)
 
@@ -52,11 +76,11 @@ def ccsga_required(function):
     def wrap(*args, **kwargs):
 
         # Proceed to wrapped function if user is a rep; respond with a 403 error otherwise
-        if is_ccsga(flask.session.get('CAS_USERNAME')):
+        if user_has_role('isCCSGA'):
             return function(*args, **kwargs)
         else:
             abort(403)
-    
+
     # Wrap this function with login_required_with_db_confirm, to require first that the User logs in and is in the database
     return login_required_with_db_confirm(wrap)
 
@@ -67,11 +91,11 @@ def admin_required(function):
     def wrap(*args, **kwargs):
 
         # Proceed to wrapped function if user is an admin; respond with a 403 error otherwise
-        if is_admin(flask.session.get('CAS_USERNAME')):
+        if user_has_role('isAdmin'):
             return function(*args, **kwargs)
         else:
             abort(403)
-    
+
     # Wrap this function with login_required_with_db_confirm, to require first that the User logs in and is in the database
     return login_required_with_db_confirm(wrap)
 
@@ -82,11 +106,11 @@ def student_or_admin_required(function):
     def wrap(*args, **kwargs):
 
         # Proceed to wrapped function if user is a student or an admin; respond with a 403 error otherwise
-        if is_student(flask.session.get('CAS_USERNAME')) or is_admin(flask.session.get('CAS_USERNAME')):
+        if user_has_role('isStudent', 'isAdmin'):
             return function(*args, **kwargs)
         else:
             abort(403)
-    
+
     # Wrap this function with login_required_with_db_confirm, to require first that the User logs in and is in the database
     return login_required_with_db_confirm(wrap)
 
@@ -97,10 +121,52 @@ def ccsga_or_admin_required(function):
     def wrap(*args, **kwargs):
 
         # Proceed to wrapped function if user is a rep or an admin; respond with a 403 error otherwise
-        if is_ccsga(flask.session.get('CAS_USERNAME')) or is_admin(flask.session.get('CAS_USERNAME')):
+        if user_has_role('isCCSGA', 'isAdmin'):
             return function(*args, **kwargs)
         else:
             abort(403)
-    
+
     # Wrap this function with login_required_with_db_confirm, to require first that the User logs in and is in the database
     return login_required_with_db_confirm(wrap)
+
+def user_is_not_banned():
+    '''Return True iff a user is signed in, is in the database, and isn't banned.'''
+
+    user_context = get_user_context()
+    return user_context != None and not user_context["isBanned"]
+
+def conditional_get(version_function, authorized):
+    '''Can be used as a function decorator (e.g., @conditional_get(lambda **kwargs: get_roles_version(), lambda **kwargs: user_has_role('isAdmin'))) to give a GET route a strong ETag and support If-None-Match.
+    authorized is called with the route's arguments and should return True iff the signed-in user may get the route's response; the ETag is only computed (and a 304 only returned) after it does.
+    Otherwise the route is called as usual, so that it can respond with its own 401, 403 or 404.
+    version_function is called with the route's arguments and should cheaply return a version of everything the response depends on (or None if it can't be determined).
+    If the ETag built from that version, the signed-in user, and the request's full path matches If-None-Match, a 304 is returned without calling the route at all.'''
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrap(*args, **kwargs):
+
+            # Only signed-in users who may get the response get ETags (the route itself responds to everyone else)
+            username = flask.session.get('CAS_USERNAME')
+            if username == None or not authorized(*args, **kwargs):
+                return function(*args, **kwargs)
+            version = version_function(*args, **kwargs)
+            if version == None:
+                return function(*args, **kwargs)
+            etag = hashlib.sha256(f"{username}|{request.full_path}|{version}".encode()).hexdigest()
+
+            # Respond with 304 if the client already has this version; otherwise let the route build the response and tag it
+            if request.if_none_match.contains_weak(etag):
+                resp = make_response("", 304)
+            else:
+                resp = make_response(function(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag)
+            resp.headers.set('Cache-Control', 'private, no-cache') # Browsers may keep the response, but must revalidate it every time
+            return resp
+
+        return wrap
+
+    return decorator
@@ -0,0 +1,255 @@
+import json
+import os
+import threading
+import time
+import flask
+import mariadb
+from flask import Response, make_response, jsonify, request
+from backend import app
+from backend.database_handler import get_conn_and_cursor, get_accessible_conversation_ids, get_user_roles
+from backend.event_bus import event_bus
+
+# How often (in seconds) to send a comment line over an idle stream, so that proxies keep the connection open and dead clients are noticed
+HEARTBEAT_SECONDS = 15
+
+# How long (in milliseconds) EventSource clients should wait before reconnecting after the stream drops
+RECONNECT_MILLISECONDS = 5000
+
+# How long (in seconds) a long poll waits for new messages by default, and at most (staying under Nginx's default proxy_read_timeout)
+DEFAULT_WAIT_SECONDS = 30
+MAX_WAIT_SECONDS = 55
+
+# Most streams and long polls that may be open at once (optional; see .env_sample). Each one holds a gunicorn thread, so this must stay well below --threads,
+# leaving the rest of the threads for the other routes; requests beyond it get a 503 and should retry after RETRY_AFTER_SECONDS
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", 150))
+RETRY_AFTER_SECONDS = 30
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+def too_many_streams_response():
+    '''Respond to a stream or long poll that would exceed MAX_STREAMS.'''
+    resp = make_response(jsonify({"message": "Too many open connections; try again later"}), 503)
+    resp.headers.set('Retry-After', str(RETRY_AFTER_SECONDS))
+    return resp
+
+class StreamAccess:
+    '''Keeps track of which conversation events a signed-in user's stream may receive, based on ConversationSettings.isAccessible and the user's roles.
+    accepts() runs on publishing threads while reload() runs on the stream's own thread, so both go through a lock.'''
+
+    def __init__(self, username):
+        self.username = username
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        '''(Re)load the user's accessible conversations and roles from the database.'''
+
+        # Query outside of the lock, so that publishers aren't kept waiting on the database
+        conversation_ids = get_accessible_conversation_ids(self.username)
+        roles = get_user_roles(self.username)
+        with self._lock:
+            self.conversation_ids = conversation_ids
+            self.is_staff = roles != None and (roles["isCCSGA"] or roles["isAdmin"])
+
+    def is_banned(self):
+        with self._lock:
+            return self.conversation_ids == None
+
+    def accepts(self, event):
+        '''Return True iff the user may receive the event. Called on the publishing thread, so it must not touch the database.'''
+
+        # Events meant for a specific user only go to that user
+        if event.username != None and event.username != self.username:
+            return False
+
+        with self._lock:
+
+            # Banned users only hear about changes to their own roles
+            if self.conversation_ids == None:
+                return event.type == 'roles_changed'
+
+            # New conversations are announced to reps and admins and to their initiators, who all gain access to them
+            if event.type == 'conversation_created':
+                if not self.is_staff and event.initiator != self.username:
+                    return False
+                self.conversation_ids.add(event.conversation_id)
+                return True
+
+            # Other conversation events only go to users with access to the conversation
+            return event.conversation_id == None or event.conversation_id in self.conversation_ids
+
+def format_event(event_type, data, event_id=None):
+    '''Format an event in the text/event-stream format.'''
+    return (f"id: {event_id}\n" if event_id != None else "") + f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+def generate_stream(access, subscription, complete):
+    '''Yield the text of the event stream for one subscriber until the client disconnects (or loses access entirely).'''
+
+    try:
+        yield f"retry: {RECONNECT_MILLISECONDS}\n\n"
+
+        # Tell the client to resynchronize (e.g., with a delta sync) if events since its Last-Event-ID may have been missed
+        if not complete:
+            yield format_event('resync', {})
+
+        while True:
+            events = subscription.get(timeout=HEARTBEAT_SECONDS)
+
+            # Tell the client to resynchronize if it fell so far behind that events were dropped
+            if subscription.overflowed:
+                subscription.overflowed = False
+                yield format_event('resync', {})
+
+            # Keep the connection alive if nothing happened
+            if not events:
+                yield ": heartbeat\n\n"
+                continue
+
+            for event in events:
+
+                # The user's roles changed, so their access might have too
+                if event.type == 'roles_changed':
+                    access.reload()
+
+                yield format_event(event.type, event.data, event.id)
+
+                # End the stream if the user has been banned
+                if access.is_banned():
+                    yield format_event('forbidden', {"message": "User is banned"})
+                    return
+    finally:
+        subscription.close()
+
+@app.route("/api/conversations/stream")
+def stream_conversation_events():
+    '''Stream events about the signed-in user's conversations (new conversations, new messages, status changes, etc.) as Server-Sent Events.
+    Events carry only IDs and changed values; clients should fetch the new data itself (e.g., with sinceMessageId).
+    Reconnecting clients can resume with the Last-Event-ID header (or the lastEventId query parameter); a `resync` event means that some events may have been missed.
+    This requires the publishing routes to run in the same process, so serve the app with a single gunicorn worker process that uses threads or greenlets (see README).'''
+
+    # prevent non-signed in users from accessing
+    username = flask.session.get('CAS_USERNAME')
+    if username == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Note the latest event before loading the user's access, so that nothing published in the meantime is missed
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId') or event_bus.last_event_id()
+
+    # Keep enough threads free for the other routes
+    if not stream_slots.acquire(blocking=False):
+        return too_many_streams_response()
+
+    try:
+        # Determine which conversations the user may hear about
+        access = StreamAccess(username)
+        if access.is_banned():
+            stream_slots.release()
+            return make_response(jsonify({"message": "User is banned"}), 403)
+
+        # Subscribe to the bus, and stream events to the client as they arrive
+        subscription, complete = event_bus.subscribe(access.accepts, last_event_id)
+    except Exception:
+        stream_slots.release()
+        raise
+    resp = Response(generate_stream(access, subscription, complete), mimetype='text/event-stream')
+    resp.headers.set('Cache-Control', 'no-cache')
+    resp.headers.set('X-Accel-Buffering', 'no') # Keep Nginx from buffering the stream
+
+    # Unsubscribe and give the slot back once the response is closed (this happens even if the client disconnects before the stream starts, when generate_stream never runs)
+    resp.call_on_close(subscription.close)
+    resp.call_on_close(stream_slots.release)
+    return resp
+
+def get_messages_after(conversation_id, username, after_message_id):
+    '''Get the messages in a conversation after the given message ID, as the given user is allowed to see them.
+    Return a tuple of (messages dict, error response), in which exactly one is None.'''
+
+    # Get database connection and cursor
+    conn, cur = get_conn_and_cursor()
+
+    messages, error_response = None, None
+    try:
+
+        # Call the stored procedure for getting data about the conversation, starting after the given message
+        cur.callproc("get_conversation", (conversation_id, username, 0, after_message_id, None))
+        messages_query_result = cur.fetchall()
+
+        # Skip the rest of the conversation data, which a long poll doesn't need
+        while cur.nextset():
+            cur.fetchall()
+
+        # Respond appropriately if the stored procedure determined that the requester was not authorized
+        if messages_query_result == [(-403,)]:
+            error_response = make_response(jsonify({"message": f"User is either banned or not authorized to view conversation #{conversation_id}"}), 403)
+
+        # Respond appropriately if the stored procedure determined that the requested conversation does not exist
+        elif messages_query_result == [(-404,)]:
+            error_response = make_response(jsonify({"message": f"Conversation #{conversation_id} not found"}), 404)
+
+        # Create a dictionary comprising the messages data
+        else:
+            messages = dict()
+            for message_id, sender_username, sender_display_name, message_body, dateandtime, isRead in messages_query_result:
+                messages[message_id] = {"sender": {"username": sender_username, "displayName": sender_display_name}, "body": message_body, "dateTime": str(dateandtime), "isRead": bool(isRead)}
+    except mariadb.Error as e:
+        print(f"Error when getting new messages: {e}")
+        error_response = make_response(jsonify({"message": "Error when getting new messages"}), 500)
+    finally:
+        # Close the database connection
+        conn.close()
+
+    return messages, error_response
+
+@app.route("/api/conversations/<conversation_id>/wait")
+def wait_for_messages(conversation_id):
+    '''Long-poll fallback for clients that can't use the stream: wait until the conversation has messages after the `afterMessageId` query parameter, then respond with them right away.
+    If none arrive within `timeout` seconds (default 30, at most 55), respond with an empty messages dictionary, and the client should simply ask again.
+    While waiting, the database is only queried when the event bus reports a new message in this conversation, not in a polling loop.'''
+
+    # prevent non-signed in users from accessing
+    username = flask.session.get('CAS_USERNAME')
+    if username == None:
+        resp = make_response(jsonify({"message": "User not authenticated"}), 401)
+        resp.headers.set('WWW-Authenticate', 'CAS')
+        return resp
+
+    # Confirm that the message ID to wait after was provided, and that the timeout (if provided) is valid
+    after_message_id = request.args.get("afterMessageId")
+    if after_message_id == None or not after_message_id.isdigit():
+        return make_response(jsonify({"message": "The query parameter 'afterMessageId' must be a non-negative integer"}), 400)
+    timeout = request.args.get("timeout", str(DEFAULT_WAIT_SECONDS))
+    if not timeout.isdigit():
+        return make_response(jsonify({"message": "The query parameter 'timeout' must be a non-negative integer"}), 400)
+    timeout = min(int(timeout), MAX_WAIT_SECONDS)
+
+    # Conversation IDs are integers, so nothing else can exist
+    if not conversation_id.isdigit():
+        return make_response(jsonify({"message": f"Conversation #{conversation_id} not found"}), 404)
+
+    # Keep enough threads free for the other routes
+    if not stream_slots.acquire(blocking=False):
+        return too_many_streams_response()
+
+    # Subscribe to new messages in this conversation before checking for them, so that none can slip in between the check and the wait
+    subscription, complete = event_bus.subscribe(lambda event: event.type == 'message_created' and event.conversation_id == int(conversation_id))
+    try:
+
+        # Check for new messages (this also confirms that the user may view the conversation), then wait for notifications until some arrive or time runs out
+        deadline = time.monotonic() + timeout
+        messages, error_response = get_messages_after(conversation_id, username, int(after_message_id))
+        while error_response == None and not messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if subscription.get(timeout=remaining):
+                messages, error_response = get_messages_after(conversation_id, username, int(after_message_id))
+    finally:
+        subscription.close()
+        stream_slots.release()
+
+    if error_response != None:
+        return error_response
+
+    # Respond with the new messages (if any)
+    return make_response(jsonify({"messages": messages}), 200)
@@ -8,6 +8,7 @@ import requests
 from dotenv import load_dotenv
 try:
     from database_handler import get_conn_and_cursor, confirm_user_in_db
+    from job_queue import sync_conversation_access
 except ModuleNotFoundError:
     print("Make sure you're actually in the test directory when you run this program.")
     exit(1)
@@ -28,6 +29,7 @@ class TestAdminRoutes(unittest.TestCase):
         self.conn, self.cur = get_conn_and_cursor()
         self.conv_ids_for_cleanup = []
         self.message_ids_for_cleanup = []
+        self.job_ids_for_cleanup = []
 
     def test_override_anonymity(self):
         
@@ -42,21 +44,18 @@ class TestAdminRoutes(unittest.TestCase):
         # Change message sender so that the signed-in user can't just automatically view their own info
         test_username, test_disp_name = 'test_user_1', 'Test User 1'
         self.cur.execute("INSERT IGNORE INTO Users (username, isBanned, isCCSGA, isAdmin, displayName, rolesLastUpdated) VALUES (?, ?, ?, ?, ?, UTC_TIMESTAMP());", (test_username, 0, 0, 0, test_disp_name))
-        # These few lines make sure the user is not an admin and doesn't already have ConversationSettings and MessageSettings for this Conversation and Message
+        # These few lines make sure the user is not an admin and doesn't already have ConversationSettings for this Conversation
         self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username=?;", (test_username,))
         self.cur.execute("DELETE from ConversationSettings WHERE username = ? AND conversationId = ?;", (test_username, new_conv_id))
-        self.cur.execute("DELETE from MessageSettings WHERE username = ? AND messageId = ?;", (test_username, new_message_id))
         # Now give the signed-in user's objects to the test user
         self.cur.execute("UPDATE ConversationSettings SET username = ? WHERE conversationId = ? AND username = ?;", (test_username, new_conv_id, SIGNED_IN_USERNAME))
         self.cur.execute("UPDATE Messages SET sender = ? WHERE id = ?;", (test_username, new_message_id))
-        self.cur.execute("UPDATE MessageSettings SET username = ? WHERE messageId = ? AND username = ?;", (test_username, new_message_id, SIGNED_IN_USERNAME))
         self.conn.commit()
         
         # Give admin privilege 
         confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
         self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 1 WHERE username = ?;", (SIGNED_IN_USERNAME,))
         self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed) VALUES (?, ?, ?, ?);", (new_conv_id, SIGNED_IN_USERNAME, 0, 1))
-        self.cur.execute("INSERT INTO MessageSettings (messageId, username, isRead) VALUES (?, ?, ?);", (new_message_id, SIGNED_IN_USERNAME, 0))
         self.conn.commit()
 
         # Test with admin privilege
@@ -112,12 +111,22 @@ class TestAdminRoutes(unittest.TestCase):
 
         # Make authorized request to add admin
         req = requests.post(f"{BASE_API_URL}/admins/create", verify=False, json={"newAdmin": test_username}, headers=POST_HEADERS)
-        self.assertEqual(201, req.status_code)
+        self.assertEqual(202, req.status_code)
+        self.job_ids_for_cleanup.append(int(req.headers["Location"].rsplit("/", 1)[1]))
         self.cur.execute("SELECT isAdmin FROM Users WHERE username = ?;", (test_username,))
         is_admin = self.cur.fetchone()[0]
         self.cur.nextset()
         self.assertTrue(is_admin)
 
+        # Check that the job for updating the new admin's conversation access was queued, and that its status can be retrieved
+        job_id = req.json()["jobId"]
+        self.assertEqual(f"/api/jobs/{job_id}", req.headers["Location"].replace(f"https://localhost:{PORT}", ""))
+        job_req = requests.get(f"{BASE_API_URL}/jobs/{job_id}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, job_req.status_code)
+        self.assertEqual("sync_conversation_access", job_req.json()["type"])
+        self.assertEqual({"username": test_username}, job_req.json()["payload"])
+        self.assertIn(job_req.json()["status"], ["queued", "running", "succeeded"])
+
         # Make request to add admin again; make sure their already-admin status is indicated in the response status code
         req = requests.post(f"{BASE_API_URL}/admins/create", verify=False, json={"newAdmin": test_username}, headers=POST_HEADERS)
         self.assertEqual(200, req.status_code)
@@ -210,7 +219,8 @@ class TestAdminRoutes(unittest.TestCase):
 
         # Make authorized request to add CCSGA
         req = requests.post(f"{BASE_API_URL}/ccsga_reps/create", verify=False, json={"newCCSGA": test_username}, headers=POST_HEADERS)
-        self.assertEqual(201, req.status_code)
+        self.assertEqual(202, req.status_code)
+        self.job_ids_for_cleanup.append(int(req.headers["Location"].rsplit("/", 1)[1]))
         self.cur.execute("SELECT isCCSGA FROM Users WHERE username = ?;", (test_username,))
         is_ccsga = self.cur.fetchone()[0]
         self.cur.nextset()
@@ -498,17 +508,118 @@ class TestAdminRoutes(unittest.TestCase):
         self.assertIn(banned_username, [user["username"] for user in req.json().get("bannedUsers")])
         self.assertNotIn(non_banned_username, [user["username"] for user in req.json().get("bannedUsers")])
 
+    def test_role_lists_conditional_get(self):
+
+        # Make the signed-in user an admin
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 1 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        for route in ["admins", "ccsga_reps", "banned_users"]:
+
+            # Get the list, then get it again with its ETag; nothing changed, so the second response should be a 304
+            req = requests.get(f"{BASE_API_URL}/{route}", verify=False, headers=GET_HEADERS)
+            self.assertEqual(200, req.status_code)
+            etag = req.headers["ETag"]
+            req = requests.get(f"{BASE_API_URL}/{route}", verify=False, headers={**GET_HEADERS, "If-None-Match": etag})
+            self.assertEqual(304, req.status_code)
+
+            # Take away the signed-in user's admin role directly in the database, which leaves the roles version (and so the ETag) unchanged;
+            # the same ETag should now get a 403 rather than a 304, since access is checked before the ETag
+            self.cur.execute("UPDATE Users SET isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+            self.conn.commit()
+            req = requests.get(f"{BASE_API_URL}/{route}", verify=False, headers={**GET_HEADERS, "If-None-Match": etag})
+            self.assertEqual(403, req.status_code)
+            self.cur.execute("UPDATE Users SET isAdmin = 1 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+            self.conn.commit()
+
+    def test_sync_conversation_access(self):
+
+        # Create a conversation as the signed-in user, and give a test rep a (non-initiator) ConversationSettings entry for it
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, json={"revealIdentity": False, "messageBody": "Test message", "labels": []}, headers=POST_HEADERS)
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 1, isAdmin = 0 WHERE username = ?;", (test_username,))
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 1, 0, 1);", (new_conv_id, test_username))
+
+        # Also give the test user a conversation of their own
+        self.cur.execute("INSERT INTO Conversations (status) VALUES ('Delivered');")
+        own_conv_id = self.cur.lastrowid
+        self.conv_ids_for_cleanup.append(own_conv_id)
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 0, 1, 1);", (own_conv_id, test_username))
+
+        # Make the signed-in user an admin, so that they can change the test user's roles
+        self.cur.execute("UPDATE Users SET isAdmin = 1 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        def is_accessible(conv_id=new_conv_id):
+            self.conn.commit() # Start a new transaction, so that the changes made since are visible
+            self.cur.execute("SELECT isAccessible FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (test_username, conv_id))
+            return self.cur.fetchone()[0]
+
+        # Removing the rep should revoke their access right away, without waiting for the job
+        req = requests.delete(f"{BASE_API_URL}/ccsga_reps/{test_username}", verify=False, headers=DELETE_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual(0, is_accessible())
+
+        # Making them a rep again should only restore their access once the job runs (one row at a time here)
+        req = requests.post(f"{BASE_API_URL}/ccsga_reps/create", verify=False, json={"newCCSGA": test_username}, headers=POST_HEADERS)
+        self.assertEqual(202, req.status_code)
+        self.job_ids_for_cleanup.append(int(req.headers["Location"].rsplit("/", 1)[1]))
+        progress = []
+        sync_conversation_access(self.conn, self.cur, {"username": test_username}, 1, progress.append)
+        self.assertEqual(1, is_accessible())
+        self.assertGreaterEqual(sum(progress), 1)
+
+        # Running the job again should change nothing
+        progress.clear()
+        sync_conversation_access(self.conn, self.cur, {"username": test_username}, 1, progress.append)
+        self.assertEqual(0, sum(progress))
+
+        # Banning them should revoke their access right away, and the job should never restore it
+        req = requests.post(f"{BASE_API_URL}/banned_users/create", verify=False, json={"userToBan": test_username}, headers=POST_HEADERS)
+        self.assertEqual(201, req.status_code)
+        self.assertEqual(0, is_accessible())
+        self.assertEqual(0, is_accessible(own_conv_id))
+        sync_conversation_access(self.conn, self.cur, {"username": test_username}, 1, progress.append)
+        self.assertEqual(0, is_accessible())
+        self.assertEqual(0, is_accessible(own_conv_id))
+
+        # Unbanning them should restore their access to their own conversation right away (without any job),
+        # but they're now a student who didn't initiate the other conversation, so nothing should restore their access to that one
+        req = requests.delete(f"{BASE_API_URL}/banned_users/{test_username}", verify=False, headers=DELETE_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn("jobId", req.json())
+        self.assertEqual(1, is_accessible(own_conv_id))
+        self.assertEqual(0, is_accessible())
+        sync_conversation_access(self.conn, self.cur, {"username": test_username}, 1, progress.append)
+        self.assertEqual(0, is_accessible())
+
+        # Reset the test user's roles
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0, updatedBy = NULL WHERE username = ?;", (test_username,))
+        self.conn.commit()
+
     def tearDown(self):
 
         # Delete any messages, conversations, etc. created
         for message_id in self.message_ids_for_cleanup:
-            self.cur.execute("DELETE FROM MessageSettings WHERE messageId = ?;", (message_id,))
             self.cur.execute("DELETE FROM Messages WHERE id = ?;", (message_id,))
         for conv_id in self.conv_ids_for_cleanup:
             self.cur.execute("DELETE FROM AppliedLabels WHERE conversationId = ?;", (conv_id,))
             self.cur.execute("DELETE FROM ConversationSettings WHERE conversationId = ?;", (conv_id,))
             self.cur.execute("DELETE FROM Conversations WHERE id = ?;", (conv_id,))
         
+        # Delete the jobs queued by this test's requests (and only those, since a worker may be running other jobs)
+        for job_id in self.job_ids_for_cleanup:
+            self.cur.execute("DELETE FROM Jobs WHERE id = ?;", (job_id,))
+
         # Reset the permissions of the signed-in user to normal student
         self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
         
@@ -516,6 +627,7 @@ class TestAdminRoutes(unittest.TestCase):
         self.conn.commit()
         self.message_ids_for_cleanup.clear()
         self.conv_ids_for_cleanup.clear()
+        self.job_ids_for_cleanup.clear()
         self.conn.close()
 
 
@@ -0,0 +1,341 @@
+# NOTE: In order to run these tests, make sure you've provided the necessary values in backend/.env
+
+import re
+import sys
+import os
+sys.path.append('..')
+sys.path.append('../benchmarks')
+import unittest
+import requests
+from dotenv import load_dotenv
+try:
+    import mariadb
+    from database_handler import get_conn_and_cursor, confirm_user_in_db, forget_known_user, open_db_connection, ConnectionPool
+    from migrations import MIGRATIONS, migrate, get_procedure_changes
+    from index_advisor import split_statements, extract_queries
+except ModuleNotFoundError:
+    print("Make sure you're actually in the test directory when you run this program.")
+    exit(1)
+
+load_dotenv()
+
+PORT = os.getenv("TESTING_PORT")
+COOKIE = os.getenv("TESTING_COOKIE")
+SIGNED_IN_USERNAME = os.getenv("TESTING_USERNAME")
+BASE_API_URL = f"https://localhost:{PORT}/api"
+GET_HEADERS = {"Cookie": COOKIE}
+POST_HEADERS = {"Cookie": COOKIE, "Content-Type": "application/json"}
+TEST_USERNAME = 'test_user_1'
+TEST_DISPLAY_NAME = 'Test User 1'
+OTHER_TEST_USERNAME = 'test_user_2'
+OTHER_TEST_DISPLAY_NAME = 'Test User 2'
+
+class TestDatabaseHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.conn, self.cur = get_conn_and_cursor()
+        self.conv_ids_for_cleanup = []
+        self.message_ids_for_cleanup = []
+        self.label_bodies_for_cleanup = []
+
+    def test_connection_pool(self):
+
+        # A pool of one connection that may open one more under load, and gives up quickly
+        pool = ConnectionPool(open_db_connection, size=1, max_overflow=1, timeout=0.5)
+
+        # Check out both connections; a third checkout should time out
+        first = pool.get_connection()
+        second = pool.get_connection()
+        stats = pool.stats()
+        self.assertEqual(2, stats["open"])
+        self.assertEqual(2, stats["inUse"])
+        self.assertEqual(2, stats["peakInUse"])
+        with self.assertRaises(mariadb.PoolError):
+            pool.get_connection()
+        self.assertEqual(1, pool.stats()["timeouts"])
+
+        # Returning a connection should roll back whatever it left uncommitted
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        first_cur = first.cursor()
+        first_cur.execute("UPDATE Users SET displayName = 'Uncommitted Name' WHERE username = ?;", (TEST_USERNAME,))
+        first.close()
+        self.conn.commit() # Start a new transaction, so that any committed change would be visible
+        self.cur.execute("SELECT displayName FROM Users WHERE username = ?;", (TEST_USERNAME,))
+        self.assertEqual(TEST_DISPLAY_NAME, self.cur.fetchone()[0])
+
+        # Only one idle connection is kept; the overflow connection should be closed when it's returned
+        second.close()
+        stats = pool.stats()
+        self.assertEqual(1, stats["open"])
+        self.assertEqual(1, stats["idle"])
+        self.assertEqual(0, stats["inUse"])
+        self.assertEqual(1, stats["discarded"])
+
+        # The next checkout should reuse the idle connection rather than opening a new one
+        third = pool.get_connection()
+        self.assertEqual(1, pool.stats()["open"])
+        self.assertEqual(3, pool.stats()["checkouts"])
+        third.close()
+
+        # Closing a connection twice shouldn't return it to the pool twice
+        third.close()
+        self.assertEqual(1, pool.stats()["idle"])
+        self.assertEqual(0, pool.stats()["inUse"])
+
+    def test_db_pool_stats(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Make request with NO authentication, then as a non-admin
+        req = requests.get(f"{BASE_API_URL}/db_pool_stats", verify=False)
+        self.assertEqual(401, req.status_code)
+        req = requests.get(f"{BASE_API_URL}/db_pool_stats", verify=False, headers=GET_HEADERS)
+        self.assertEqual(403, req.status_code)
+
+        # As an admin, the stats should describe a pool that has handed out at least the connections for this request
+        self.cur.execute("UPDATE Users SET isAdmin = 1 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+        req = requests.get(f"{BASE_API_URL}/db_pool_stats", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        stats = req.json()
+        for key in ["size", "maxOverflow", "open", "idle", "inUse", "waiting", "peakInUse", "checkouts", "timeouts", "discarded", "avgCheckoutLatencyMs", "maxCheckoutLatencyMs", "pid"]:
+            self.assertIn(key, stats)
+        self.assertGreaterEqual(stats["checkouts"], 1)
+        self.assertLessEqual(stats["open"], stats["size"] + stats["maxOverflow"])
+        self.assertLessEqual(stats["peakInUse"], stats["size"] + stats["maxOverflow"])
+
+    def test_confirm_user_in_db_skips_known_users(self):
+
+        def get_display_name():
+            self.conn.commit() # Start a new transaction, so that the latest changes are visible
+            self.cur.execute("SELECT displayName FROM Users WHERE username = ?;", (TEST_USERNAME,))
+            return self.cur.fetchone()[0]
+
+        def get_roles_version():
+            self.conn.commit()
+            self.cur.execute("SELECT version FROM ResourceVersions WHERE name = 'roles';")
+            return self.cur.fetchone()[0]
+
+        # Confirming a user who isn't remembered should go to the database
+        forget_known_user(TEST_USERNAME)
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        self.assertEqual(TEST_DISPLAY_NAME, get_display_name())
+
+        # Now that the user is remembered, confirming them again with the same display name shouldn't touch the database at all
+        self.cur.execute("UPDATE Users SET displayName = 'Changed Behind The Cache' WHERE username = ?;", (TEST_USERNAME,))
+        self.conn.commit()
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        self.assertEqual('Changed Behind The Cache', get_display_name())
+
+        # Once forgotten, the user is looked up again, and their display name corrected
+        forget_known_user(TEST_USERNAME)
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        self.assertEqual(TEST_DISPLAY_NAME, get_display_name())
+
+        # A new display name isn't in the cache, so it should be written (and the role lists, which include display names, should get a new version)
+        orig_roles_version = get_roles_version()
+        confirm_user_in_db(TEST_USERNAME, "Test User 1 Renamed")
+        self.assertEqual("Test User 1 Renamed", get_display_name())
+        self.assertGreater(get_roles_version(), orig_roles_version)
+
+        # Switching back shouldn't be skipped because of the entry for the old display name, which the rename replaced
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        self.assertEqual(TEST_DISPLAY_NAME, get_display_name())
+
+        # A user who is already in the database with the same display name shouldn't cause any write (so the roles version stays the same)
+        forget_known_user(TEST_USERNAME)
+        orig_roles_version = get_roles_version()
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        self.assertEqual(orig_roles_version, get_roles_version())
+
+    def test_schema_indexes(self):
+
+        # Every index that the migrations create should exist (on an up-to-date database)
+        indexes = []
+        for _, _, steps in MIGRATIONS:
+            for step in steps:
+                match = re.match(r"CREATE (?:FULLTEXT )?INDEX IF NOT EXISTS (\w+) ON (\w+)", str(step))
+                if match != None:
+                    indexes.append((match.group(2), match.group(1)))
+        self.assertIn(("Messages", "messagesConvIdAndId"), indexes)
+        for table, index in indexes:
+            self.cur.execute("SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = ? AND INDEX_NAME = ?;", (table, index))
+            self.assertGreater(self.cur.fetchone()[0], 0, f"Index {index} on {table} is missing")
+
+    def test_index_advisor_statements(self):
+
+        # Statements are split at semicolons, except those in strings, and comments are dropped (even ones with apostrophes)
+        body = """BEGIN
+            # The requester's own settings; this comment isn't a statement
+            IF EXISTS (SELECT id FROM Labels WHERE body = 'a;b') THEN
+                -- Another comment, with a semicolon; and an apostrophe's
+                SELECT id FROM Labels /* a third; kind */ WHERE body = "it's";
+            END IF;
+        END"""
+        self.assertEqual([
+            "BEGIN IF EXISTS (SELECT id FROM Labels WHERE body = 'a;b') THEN SELECT id FROM Labels WHERE body = \"it's\"",
+            "END IF",
+            "END"
+        ], split_statements(body))
+
+        # Control flow keywords are stripped, and conditions become queries of their own
+        self.assertEqual([
+            "SELECT EXISTS (SELECT id FROM Labels WHERE body = 'a;b')",
+            "SELECT id FROM Labels WHERE body = \"it's\""
+        ], extract_queries(split_statements(body)[0]))
+        self.assertEqual([], extract_queries("END IF"))
+
+    def test_migrations(self):
+
+        def get_schema_versions():
+            self.conn.commit() # Start a new transaction, so that the latest changes are visible
+            self.cur.execute("SELECT version FROM SchemaVersion ORDER BY version;")
+            return [row[0] for row in self.cur.fetchall()]
+
+        def get_deployed_procedures():
+            self.conn.commit()
+            self.cur.execute("SELECT name, checksum, deployedAt FROM SchemaProcedures;")
+            return {row[0]: (row[1], row[2]) for row in self.cur.fetchall()}
+
+        # Bring the database up to date; afterward, every migration should be recorded exactly once
+        self.assertTrue(migrate())
+        orig_versions = get_schema_versions()
+        self.assertEqual([migration[0] for migration in MIGRATIONS], orig_versions)
+        orig_procedures = get_deployed_procedures()
+        self.assertIn("get_conversation", orig_procedures)
+        changed, removed = get_procedure_changes(self.cur)
+        self.assertEqual([], changed)
+        self.assertEqual([], removed)
+
+        # Make one procedure look out of date
+        self.cur.execute("UPDATE SchemaProcedures SET checksum = ? WHERE name = 'get_conversation';", ("0" * 64,))
+        self.conn.commit()
+
+        # A dry run should find the procedure to deploy, but not deploy it
+        self.assertTrue(migrate(dry_run=True))
+        self.assertEqual(orig_versions, get_schema_versions())
+        procedures = get_deployed_procedures()
+        self.assertEqual("0" * 64, procedures["get_conversation"][0])
+        changed, _ = get_procedure_changes(self.cur)
+        self.assertEqual(["get_conversation"], [name for name, _, _ in changed])
+
+        # A real run should redeploy that procedure (and only that one), restoring its checksum
+        self.assertTrue(migrate())
+        self.assertEqual(orig_versions, get_schema_versions())
+        procedures = get_deployed_procedures()
+        self.assertEqual(orig_procedures["get_conversation"][0], procedures["get_conversation"][0])
+        self.assertGreater(procedures["get_conversation"][1], orig_procedures["get_conversation"][1])
+        for name, (checksum, deployed_at) in orig_procedures.items():
+            if name != "get_conversation":
+                self.assertEqual((checksum, deployed_at), procedures[name])
+
+        # Running it again should change nothing at all
+        self.assertTrue(migrate())
+        self.assertEqual(orig_versions, get_schema_versions())
+        self.assertEqual(procedures, get_deployed_procedures())
+
+    def test_get_conversation_procedure(self):
+
+        def call_get_conversation(requester, after_message_id=None, limit=None):
+            self.cur.callproc("get_conversation", (conv_id, requester, 0, after_message_id, limit))
+            result_sets = [self.cur.fetchall()]
+            while self.cur.nextset():
+                result_sets.append(self.cur.fetchall())
+            return result_sets
+
+        # Make a conversation between an anonymous student and a student who revealed their identity, neither of them staff
+        for username, display_name in [(TEST_USERNAME, TEST_DISPLAY_NAME), (OTHER_TEST_USERNAME, OTHER_TEST_DISPLAY_NAME)]:
+            confirm_user_in_db(username, display_name)
+            self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (username,))
+        self.cur.execute("INSERT INTO Conversations (status) VALUES ('Delivered');")
+        conv_id = self.cur.lastrowid
+        self.conv_ids_for_cleanup.append(conv_id)
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 0, 1, 1);", (conv_id, TEST_USERNAME))
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 1, 1, 0, 1);", (conv_id, OTHER_TEST_USERNAME))
+        message_ids = []
+        for sender in [TEST_USERNAME, OTHER_TEST_USERNAME, TEST_USERNAME, TEST_USERNAME]:
+            self.cur.execute("INSERT INTO Messages (conversationId, sender, body, dateandtime) VALUES (?, ?, ?, UTC_TIMESTAMP());", (conv_id, sender, f"Message {len(message_ids)}"))
+            message_ids.append(self.cur.lastrowid)
+        self.message_ids_for_cleanup.extend(message_ids)
+        label = "database test label"
+        self.label_bodies_for_cleanup.append(label)
+        self.cur.execute("INSERT IGNORE INTO Labels (body) VALUES (?);", (label,))
+        self.cur.execute("INSERT INTO AppliedLabels (conversationId, labelId) SELECT ?, id FROM Labels WHERE body = ?;", (conv_id, label))
+
+        # The revealed student has read up to the second message
+        self.cur.execute("UPDATE ConversationSettings SET lastReadMessageId = ?, unreadCount = 2 WHERE conversationId = ? AND username = ?;", (message_ids[1], conv_id, OTHER_TEST_USERNAME))
+        self.conn.commit()
+
+        # The procedure should return the messages, then a single row of flags, then the labels
+        result_sets = call_get_conversation(OTHER_TEST_USERNAME)
+        messages, flags, labels = result_sets[:3]
+
+        # Each message should appear exactly once, in order, with the anonymous student's messages masked and the read state following the watermark
+        self.assertEqual(message_ids, [message[0] for message in messages])
+        for message, sender, message_id in zip(messages, [TEST_USERNAME, OTHER_TEST_USERNAME, TEST_USERNAME, TEST_USERNAME], message_ids):
+            if sender == TEST_USERNAME:
+                self.assertEqual(("anonymous", "Anonymous"), (message[1], message[2]))
+            else:
+                self.assertEqual((OTHER_TEST_USERNAME, OTHER_TEST_DISPLAY_NAME), (message[1], message[2]))
+            self.assertEqual(message_id <= message_ids[1], bool(message[5]))
+
+        # Flags: status, archived (for the requester), all identities revealed, own identity revealed, all messages read
+        self.assertEqual(1, len(flags))
+        status, is_archived, all_identities_revealed, own_identity_revealed, all_messages_read = flags[0]
+        self.assertEqual("Delivered", status)
+        self.assertTrue(is_archived)
+        self.assertFalse(all_identities_revealed)
+        self.assertTrue(own_identity_revealed)
+        self.assertFalse(all_messages_read)
+        self.assertEqual([(label,)], labels)
+
+        # The sender always sees their own identity, and once they've read everything, so should the flags say
+        self.cur.execute("UPDATE ConversationSettings SET lastReadMessageId = ?, unreadCount = 0 WHERE conversationId = ? AND username = ?;", (message_ids[-1], conv_id, TEST_USERNAME))
+        self.conn.commit()
+        messages, flags = call_get_conversation(TEST_USERNAME)[:2]
+        self.assertEqual([(TEST_USERNAME, TEST_DISPLAY_NAME), (OTHER_TEST_USERNAME, OTHER_TEST_DISPLAY_NAME), (TEST_USERNAME, TEST_DISPLAY_NAME), (TEST_USERNAME, TEST_DISPLAY_NAME)], [(message[1], message[2]) for message in messages])
+        self.assertTrue(all(message[5] for message in messages))
+        self.assertFalse(flags[0][1])
+        self.assertFalse(flags[0][3])
+        self.assertTrue(flags[0][4])
+
+        # With a limit, a page has one extra message (so the caller can tell there are more), starting after the given message
+        messages = call_get_conversation(OTHER_TEST_USERNAME, after_message_id=message_ids[0], limit=2)[0]
+        self.assertEqual(message_ids[1:4], [message[0] for message in messages])
+        messages = call_get_conversation(OTHER_TEST_USERNAME, after_message_id=message_ids[2], limit=2)[0]
+        self.assertEqual(message_ids[3:], [message[0] for message in messages])
+
+        # Someone with no access gets only the error code
+        self.cur.execute("UPDATE ConversationSettings SET isAccessible = 0 WHERE conversationId = ? AND username = ?;", (conv_id, OTHER_TEST_USERNAME))
+        self.conn.commit()
+        self.assertEqual([(-403,)], call_get_conversation(OTHER_TEST_USERNAME)[0])
+
+    def tearDown(self):
+
+        # Delete any messages, conversations, etc. created
+        for message_id in self.message_ids_for_cleanup:
+            self.cur.execute("DELETE FROM Messages WHERE id = ?;", (message_id,))
+        for conv_id in self.conv_ids_for_cleanup:
+            self.cur.execute("DELETE FROM AppliedLabels WHERE conversationId = ?;", (conv_id,))
+            self.cur.execute("DELETE FROM ConversationSettings WHERE conversationId = ?;", (conv_id,))
+            self.cur.execute("DELETE FROM Conversations WHERE id = ?;", (conv_id,))
+        for label_body in self.label_bodies_for_cleanup:
+            self.cur.execute("DELETE FROM AppliedLabels WHERE labelId IN (SELECT id FROM Labels WHERE body = ?);", (label_body,))
+            self.cur.execute("DELETE FROM Labels WHERE body = ?;", (label_body,))
+
+        # Reset the permissions of the signed-in user to normal student
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+
+        # Commit, clear lists of IDs to delete, and close connection
+        self.conn.commit()
+        self.message_ids_for_cleanup.clear()
+        self.conv_ids_for_cleanup.clear()
+        self.label_bodies_for_cleanup.clear()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,14 @@
 # NOTE: In order to run these tests, make sure you've provided the necessary values in backend/.env
 
+import base64
 import sys
 import os
+import json
+import time
 sys.path.append('..')
 import unittest
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 try:
     from database_handler import get_conn_and_cursor, confirm_user_in_db
@@ -30,6 +34,7 @@ class TestMessagesRoutes(unittest.TestCase):
         self.conn, self.cur = get_conn_and_cursor()
         self.conv_ids_for_cleanup = []
         self.message_ids_for_cleanup = []
+        self.label_bodies_for_cleanup = []
         
         # Create fake admin for changing roles (for safety because of the way it's removed at the end, don't let the fake admin send any messages)
         self.cur.execute("INSERT IGNORE INTO Users (username, displayName, isBanned, isCCSGA, isAdmin) VALUES (?, ?, 0, 0, 1);", (FAKE_ADMIN_USERNAME, FAKE_ADMIN_DISPLAY_NAME))
@@ -53,15 +58,9 @@ class TestMessagesRoutes(unittest.TestCase):
         self.cur.execute("SELECT COUNT(*) FROM ConversationSettings;")
         orig_num_conv_settings = self.cur.fetchone()[0]
         self.cur.nextset()
-        self.cur.execute("SELECT COUNT(*) FROM MessageSettings;")
-        orig_num_message_settings = self.cur.fetchone()[0]
-        self.cur.nextset()
         self.cur.execute("SELECT COUNT(*) FROM AppliedLabels;")
         orig_num_applied_labels = self.cur.fetchone()[0]
         self.cur.nextset()
-        self.cur.execute("SELECT COUNT(*) FROM Users WHERE isCCSGA OR isAdmin;")
-        orig_num_ccsga_or_admin = self.cur.fetchone()[0]
-        self.cur.nextset()
 
         # Make request to create conversation but with NO authentication
         labels = ["Outreach", "Internal Affairs"]
@@ -117,31 +116,21 @@ class TestMessagesRoutes(unittest.TestCase):
         self.cur.execute("SELECT COUNT(*) FROM ConversationSettings;")
         num_conv_settings = self.cur.fetchone()[0]
         self.cur.nextset()
-        self.assertEqual(orig_num_conv_settings + orig_num_ccsga_or_admin + 1, num_conv_settings)
+        self.assertEqual(orig_num_conv_settings + 1, num_conv_settings) # Reps and admins get their ConversationSettings only when they first need them
         self.cur.execute("SELECT isArchived, identityRevealed, isInitiator, isAccessible FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
         query_result = self.cur.fetchall()
         self.cur.nextset()
         self.assertEqual([(0, 0, 1, 1)], query_result)
-        self.cur.execute("SELECT isArchived, identityRevealed, isInitiator, isAccessible FROM ConversationSettings WHERE username <> ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
-        query_result = self.cur.fetchall()
+        self.cur.execute("SELECT COUNT(*) FROM ConversationSettings WHERE username <> ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        num_other_conv_settings = self.cur.fetchone()[0]
         self.cur.nextset()
-        for row in query_result:
-            self.assertEqual((0, 1, 0, 1), row)
+        self.assertEqual(0, num_other_conv_settings)
 
-        # Check that message settings were added correctly
-        self.cur.execute("SELECT COUNT(*) FROM MessageSettings;")
-        num_message_settings = self.cur.fetchone()[0]
-        self.cur.nextset()
-        self.assertEqual(orig_num_message_settings + orig_num_ccsga_or_admin + 1, num_message_settings)
-        self.cur.execute("SELECT isRead FROM MessageSettings WHERE username = ? AND messageId = ?;", (SIGNED_IN_USERNAME, new_message_id))
-        query_result = self.cur.fetchall()
-        self.cur.nextset()
-        self.assertEqual([(1,)], query_result)
-        self.cur.execute("SELECT isRead FROM MessageSettings WHERE username <> ? AND messageId = ?;", (SIGNED_IN_USERNAME, new_message_id))
+        # Check that the sender's read watermark was set correctly (the sender has read their own message)
+        self.cur.execute("SELECT lastReadMessageId FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
         query_result = self.cur.fetchall()
         self.cur.nextset()
-        for row in query_result:
-            self.assertEqual((0,), row)
+        self.assertEqual([(new_message_id,)], query_result)
 
         # Check that labels were applied correctly
         self.cur.execute("SELECT COUNT(*) FROM AppliedLabels;")
@@ -176,23 +165,767 @@ class TestMessagesRoutes(unittest.TestCase):
 
 
 
+    def test_get_conversation_summaries(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Make request for summaries but with NO authentication
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False)
+        self.assertEqual(401, req.status_code)
+
+        # Create a conversation to summarize
+        labels = ["Outreach", "Internal Affairs"]
+        messageBody = "Test message for summary"
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": messageBody, "labels": labels})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        new_message_id = req.json()["messageId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(new_message_id)
+
+        # Check that the conversation is summarized correctly
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        summaries = {summary["id"]: summary for summary in req.json()["conversations"]}
+        self.assertIn(new_conv_id, summaries)
+        summary = summaries[new_conv_id]
+        self.assertEqual("Delivered", summary["status"])
+        self.assertEqual(sorted(labels), sorted(summary["labels"]))
+        self.assertFalse(summary["isArchived"])
+        self.assertTrue(summary["isRead"])
+        self.assertEqual(0, summary["unreadCount"])
+        self.assertEqual(new_message_id, summary["lastMessage"]["id"])
+        self.assertEqual(messageBody, summary["lastMessage"]["preview"])
+        self.assertEqual(SIGNED_IN_USERNAME, summary["lastMessage"]["sender"]["username"])
+        self.assertNotIn("messages", summary)
+
+        # Check that the filters are applied on the server
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False, headers=GET_HEADERS, params={"label": labels[0], "status": "Delivered", "archived": "false"})
+        self.assertEqual(200, req.status_code)
+        self.assertIn(new_conv_id, [summary["id"] for summary in req.json()["conversations"]])
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False, headers=GET_HEADERS, params={"archived": "true"})
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn(new_conv_id, [summary["id"] for summary in req.json()["conversations"]])
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False, headers=GET_HEADERS, params={"label": "Label that was not applied"})
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn(new_conv_id, [summary["id"] for summary in req.json()["conversations"]])
+
+    def test_paginate_conversation(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation with three messages
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message 1", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        message_ids = [req.json()["messageId"]]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(message_ids[0])
+        for i in [2, 3]:
+            req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": f"Test message {i}"})
+            self.assertEqual(201, req.status_code)
+            message_ids.append(req.json()["messageId"])
+            self.message_ids_for_cleanup.append(message_ids[-1])
+
+        # Make requests with invalid pagination parameters
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS, params={"limit": "0"})
+        self.assertEqual(400, req.status_code)
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS, params={"after": "abc"})
+        self.assertEqual(400, req.status_code)
+
+        # Page through the messages two at a time
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS, params={"limit": "2"})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([str(message_id) for message_id in message_ids[:2]], sorted(req.json()["messages"], key=int))
+        self.assertEqual(message_ids[1], req.json()["nextCursor"])
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS, params={"limit": "2", "after": str(req.json()["nextCursor"])})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([str(message_ids[2])], list(req.json()["messages"]))
+        self.assertIsNone(req.json()["nextCursor"])
+
+        # Page through the list of conversations, making sure the new conversation shows up on the page after its predecessor
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params={"after": str(new_conv_id - 1), "limit": "1"})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([str(new_conv_id)], list(req.json()["conversations"]))
+
+    def test_delta_sync(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Make request with an invalid sync token
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params={"since": "not a token"})
+        self.assertEqual(400, req.status_code)
+
+        # Create a conversation, then do an initial sync (with an empty token)
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message 1", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        first_message_id = req.json()["messageId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(first_message_id)
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params={"since": ""})
+        self.assertEqual(200, req.status_code)
+        self.assertIn(str(new_conv_id), req.json()["conversations"])
+        sync_token = req.json()["syncToken"]
+
+        # Reply, then check that a delta sync includes the reply
+        req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test message 2"})
+        self.assertEqual(201, req.status_code)
+        second_message_id = req.json()["messageId"]
+        self.message_ids_for_cleanup.append(second_message_id)
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params={"since": sync_token})
+        self.assertEqual(200, req.status_code)
+        self.assertIn(str(second_message_id), req.json()["conversations"][str(new_conv_id)]["messages"])
+        self.assertNotEqual(sync_token, req.json()["syncToken"])
+
+        # Check that only the messages after sinceMessageId are included for a specific conversation
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS, params={"sinceMessageId": str(first_message_id)})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([str(second_message_id)], list(req.json()["messages"]))
+
+    def test_stream(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message 1", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+
+        # Open the stream, then reply to the conversation
+        stream = requests.get(f"{BASE_API_URL}/conversations/stream", verify=False, headers=GET_HEADERS, stream=True, timeout=30)
+        self.assertEqual(200, stream.status_code)
+        self.assertTrue(stream.headers["Content-Type"].startswith("text/event-stream"))
+        req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test message 2"})
+        self.assertEqual(201, req.status_code)
+        new_message_id = req.json()["messageId"]
+        self.message_ids_for_cleanup.append(new_message_id)
+
+        # Check that the stream reports the reply, with an event ID that can be used to resume
+        event = {}
+        for line in stream.iter_lines(decode_unicode=True):
+            if line.startswith("id:"):
+                event["id"] = line[len("id:"):].strip()
+            elif line.startswith("event:"):
+                event["type"] = line[len("event:"):].strip()
+            elif line.startswith("data:") and event.get("type") == "message_created":
+                event["data"] = json.loads(line[len("data:"):])
+                break
+        stream.close()
+        self.assertEqual({"conversationId": new_conv_id, "messageId": new_message_id}, event["data"])
+        self.assertIn("id", event)
+
+    def test_stream_new_conversation(self):
+
+        # Both a student (as the initiator) and an admin (as staff, who is also the initiator here) should hear about a new conversation exactly once
+        for is_admin in [0, 1]:
+            self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = ? WHERE username = ?;", (is_admin, SIGNED_IN_USERNAME))
+            self.conn.commit()
+
+            # Open the stream, then create a conversation and reply to it (the reply marks the end of the events to check)
+            stream = requests.get(f"{BASE_API_URL}/conversations/stream", verify=False, headers=GET_HEADERS, stream=True, timeout=30)
+            self.assertEqual(200, stream.status_code)
+            req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message 1", "labels": []})
+            self.assertEqual(201, req.status_code)
+            new_conv_id = req.json()["conversationId"]
+            self.conv_ids_for_cleanup.append(new_conv_id)
+            self.message_ids_for_cleanup.append(req.json()["messageId"])
+            req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test message 2"})
+            self.assertEqual(201, req.status_code)
+            self.message_ids_for_cleanup.append(req.json()["messageId"])
+
+            # Collect the events up to the reply
+            event_types = []
+            for line in stream.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event_types.append(line[len("event:"):].strip())
+                    if event_types[-1] == "message_created":
+                        break
+            stream.close()
+            self.assertEqual(1, event_types.count("conversation_created"))
+
+    def test_wait_for_messages(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message 1", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        first_message_id = req.json()["messageId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(first_message_id)
+
+        # Make request without the message ID to wait after
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}/wait", verify=False, headers=GET_HEADERS)
+        self.assertEqual(400, req.status_code)
+
+        # Check that a long poll for messages that already exist returns right away, and that one for nothing new times out empty
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}/wait", verify=False, headers=GET_HEADERS, params={"afterMessageId": "0", "timeout": "5"})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([str(first_message_id)], list(req.json()["messages"]))
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}/wait", verify=False, headers=GET_HEADERS, params={"afterMessageId": str(first_message_id), "timeout": "1"})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual({}, req.json()["messages"])
+
+        # Start a long poll, reply while it waits, and check that the poll returns the reply
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            poll = executor.submit(requests.get, f"{BASE_API_URL}/conversations/{new_conv_id}/wait", verify=False, headers=GET_HEADERS, params={"afterMessageId": str(first_message_id), "timeout": "20"})
+            time.sleep(1)
+            req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test message 2"})
+            self.assertEqual(201, req.status_code)
+            second_message_id = req.json()["messageId"]
+            self.message_ids_for_cleanup.append(second_message_id)
+            req = poll.result()
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([str(second_message_id)], list(req.json()["messages"]))
+
+    def test_staff_access_without_settings(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation, then give it to a test student so that the signed-in user has no ConversationSettings for it
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        new_message_id = req.json()["messageId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(new_message_id)
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("UPDATE ConversationSettings SET username = ? WHERE conversationId = ? AND username = ?;", (test_username, new_conv_id, SIGNED_IN_USERNAME))
+        self.cur.execute("UPDATE Messages SET sender = ? WHERE id = ?;", (test_username, new_message_id))
+        self.conn.commit()
+
+        # As a student, the signed-in user can't see the conversation
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(403, req.status_code)
+
+        # Make the signed-in user a rep; they should be able to see the conversation (with the message unread) without getting ConversationSettings for it
+        self.cur.execute("UPDATE Users SET isCCSGA = 1, rolesLastUpdated = '2000-01-01 00:00:00' WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertFalse(req.json()["messages"][str(new_message_id)]["isRead"])
+        self.assertFalse(req.json()["isArchived"])
+        self.assertIn(str(new_conv_id), requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS).json())
+        self.cur.execute("SELECT COUNT(*) FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        self.assertEqual(0, self.cur.fetchone()[0])
+        self.cur.nextset()
+
+        # Archiving the conversation should create the rep's ConversationSettings
+        req = requests.patch(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=POST_HEADERS, json={"setArchived": True})
+        self.assertEqual(200, req.status_code)
+        self.conn.commit() # Start a new transaction, so that the route's changes are visible
+        self.cur.execute("SELECT isArchived, identityRevealed, isInitiator, isAccessible, lastReadMessageId FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        query_result = self.cur.fetchall()
+        self.cur.nextset()
+        self.assertEqual([(1, 1, 0, 1, 0)], query_result)
+
+    def test_staff_read_state_without_roles_timestamp(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation, then give it to a test student so that the signed-in user has no ConversationSettings for it
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        new_message_id = req.json()["messageId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(new_message_id)
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("UPDATE ConversationSettings SET username = ? WHERE conversationId = ? AND username = ?;", (test_username, new_conv_id, SIGNED_IN_USERNAME))
+        self.cur.execute("UPDATE Messages SET sender = ? WHERE id = ?;", (test_username, new_message_id))
+
+        # Make the signed-in user a rep whose roles were never timestamped; every message should count as unread, consistently across the routes
+        self.cur.execute("UPDATE Users SET isCCSGA = 1, rolesLastUpdated = NULL WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertFalse(req.json()["messages"][str(new_message_id)]["isRead"])
+        self.assertFalse(req.json()["isRead"])
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertFalse(req.json()[str(new_conv_id)]["isRead"])
+        self.assertEqual(1, req.json()[str(new_conv_id)]["unreadCount"])
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        summaries = {summary["id"]: summary for summary in req.json()["conversations"]}
+        self.assertEqual(1, summaries[new_conv_id]["unreadCount"])
+
+        # Archiving the conversation should create the rep's ConversationSettings with the same read state
+        req = requests.patch(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=POST_HEADERS, json={"setArchived": True})
+        self.assertEqual(200, req.status_code)
+        self.conn.commit() # Start a new transaction, so that the route's changes are visible
+        self.cur.execute("SELECT lastReadMessageId, unreadCount FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        self.assertEqual([(0, 1)], self.cur.fetchall())
+
+    def test_get_conversation_conditional_get(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+
+        # Get the conversation and the list of conversations, then get them again with their ETags; nothing changed, so the second responses should be 304s
+        etags = dict()
+        for url in [f"{BASE_API_URL}/conversations/{new_conv_id}", f"{BASE_API_URL}/conversations"]:
+            req = requests.get(url, verify=False, headers=GET_HEADERS)
+            self.assertEqual(200, req.status_code)
+            etags[url] = req.headers["ETag"]
+            req = requests.get(url, verify=False, headers={**GET_HEADERS, "If-None-Match": etags[url]})
+            self.assertEqual(304, req.status_code)
+
+        # A reply changes the conversation, so the old ETag should get the new version
+        req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test message 2"})
+        self.assertEqual(201, req.status_code)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        url = f"{BASE_API_URL}/conversations/{new_conv_id}"
+        req = requests.get(url, verify=False, headers={**GET_HEADERS, "If-None-Match": etags[url]})
+        self.assertEqual(200, req.status_code)
+        etags[url] = req.headers["ETag"]
+
+        # Ban the signed-in user directly in the database, which leaves the versions (and so the ETags) unchanged;
+        # the same ETags should now get 403s rather than 304s, since access is checked before the ETag
+        self.cur.execute("UPDATE Users SET isBanned = 1 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+        for url, etag in etags.items():
+            req = requests.get(url, verify=False, headers={**GET_HEADERS, "If-None-Match": etag})
+            self.assertEqual(403, req.status_code)
+
+    def test_unread_counts(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation, and let a test user reply to it twice
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 1, 0, 1);", (new_conv_id, test_username))
+        for i in range(2):
+            self.cur.callproc("create_message", (new_conv_id, test_username, f"Test reply {i}", 0))
+            self.message_ids_for_cleanup.append(self.cur.fetchall()[0][0])
+            self.cur.nextset()
+        self.conn.commit()
+
+        # The replies should be counted as unread in the list and summary responses
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual(2, req.json()[str(new_conv_id)]["unreadCount"])
+        self.assertFalse(req.json()[str(new_conv_id)]["isRead"])
+        req = requests.get(f"{BASE_API_URL}/conversations/summary", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual(2, {summary["id"]: summary for summary in req.json()["conversations"]}[new_conv_id]["unreadCount"])
+
+        # Replying should reset the signed-in user's count, and add to the test user's
+        req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_id}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test reply from the signed-in user"})
+        self.assertEqual(201, req.status_code)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(0, req.json()[str(new_conv_id)]["unreadCount"])
+        self.assertTrue(req.json()[str(new_conv_id)]["isRead"])
+        self.conn.commit() # Start a new transaction, so that the route's changes are visible
+        self.cur.execute("SELECT unreadCount FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (test_username, new_conv_id))
+        self.assertEqual(1, self.cur.fetchone()[0])
+        self.cur.nextset()
+
+    def test_unread_counts_without_access(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a conversation that a test user can also access
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 1, 0, 1);", (new_conv_id, test_username))
+
+        # Take away the signed-in user's access (as banning them would), and let the test user reply twice in the meantime
+        self.cur.execute("UPDATE ConversationSettings SET isAccessible = 0 WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        reply_ids = []
+        for i in range(2):
+            self.cur.callproc("create_message", (new_conv_id, test_username, f"Test reply {i}", 0))
+            reply_ids.append(self.cur.fetchall()[0][0])
+            self.cur.nextset()
+        self.message_ids_for_cleanup.extend(reply_ids)
+        self.conn.commit()
+
+        # The conversation shouldn't be listed while the signed-in user has no access, but the replies should still be counted
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn(str(new_conv_id), req.json())
+        self.cur.execute("SELECT unreadCount FROM ConversationSettings WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        self.assertEqual(2, self.cur.fetchone()[0])
+
+        # Once access is restored, the count should match the replies that are marked as unread in the conversation itself
+        self.cur.execute("UPDATE ConversationSettings SET isAccessible = 1 WHERE username = ? AND conversationId = ?;", (SIGNED_IN_USERNAME, new_conv_id))
+        self.conn.commit()
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual(2, req.json()[str(new_conv_id)]["unreadCount"])
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        unread_message_ids = sorted(int(message_id) for message_id, message in req.json()["messages"].items() if not message["isRead"])
+        self.assertEqual(sorted(reply_ids), unread_message_ids)
+
+        # Marking them as read should bring the count back to zero
+        req = requests.post(f"{BASE_API_URL}/conversations/read", verify=False, headers=POST_HEADERS, json={"conversations": [{"conversationId": new_conv_id, "upToMessageId": max(reply_ids)}]})
+        self.assertEqual(200, req.status_code)
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(0, req.json()[str(new_conv_id)]["unreadCount"])
+
+    def test_mark_conversations_read(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Make request with NO authentication, then with a malformed body
+        req = requests.post(f"{BASE_API_URL}/conversations/read", verify=False, json={"conversations": []})
+        self.assertEqual(401, req.status_code)
+        req = requests.post(f"{BASE_API_URL}/conversations/read", verify=False, headers=POST_HEADERS, json={"conversations": [{"conversationId": "1"}]})
+        self.assertEqual(400, req.status_code)
+
+        # Create a conversation, and let a test user reply to it twice
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 1, 0, 1);", (new_conv_id, test_username))
+        reply_ids = []
+        for i in range(2):
+            self.cur.callproc("create_message", (new_conv_id, test_username, f"Test reply {i}", 0))
+            reply_ids.append(self.cur.fetchall()[0][0])
+            self.cur.nextset()
+        self.message_ids_for_cleanup += reply_ids
+        self.conn.commit()
+
+        # Mark the first reply as read (along with a conversation that doesn't exist)
+        nonexistent_conv_id = new_conv_id + 1000000
+        req = requests.post(f"{BASE_API_URL}/conversations/read", verify=False, headers=POST_HEADERS, json={"conversations": [{"conversationId": new_conv_id, "upToMessageId": reply_ids[0]}, {"conversationId": nonexistent_conv_id, "upToMessageId": 1}]})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual({"lastReadMessageId": reply_ids[0], "unreadCount": 1}, req.json()["conversations"][str(new_conv_id)])
+        self.assertEqual([nonexistent_conv_id], req.json()["notUpdated"])
+
+        # Marking an earlier message as read shouldn't move the watermark back
+        req = requests.post(f"{BASE_API_URL}/conversations/read", verify=False, headers=POST_HEADERS, json={"conversations": [{"conversationId": new_conv_id, "upToMessageId": 1}]})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual({"lastReadMessageId": reply_ids[0], "unreadCount": 1}, req.json()["conversations"][str(new_conv_id)])
+
+        # A watermark past the end of the conversation should stop at its last message
+        req = requests.post(f"{BASE_API_URL}/conversations/read", verify=False, headers=POST_HEADERS, json={"conversations": [{"conversationId": new_conv_id, "upToMessageId": reply_ids[1] + 1000000}]})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual({"lastReadMessageId": reply_ids[1], "unreadCount": 0}, req.json()["conversations"][str(new_conv_id)])
+        req = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS)
+        self.assertTrue(req.json()["isRead"])
+        self.assertTrue(all(message["isRead"] for message in req.json()["messages"].values()))
+
+    def test_get_conversation_facets(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Make request with NO authentication
+        req = requests.get(f"{BASE_API_URL}/conversations/facets", verify=False)
+        self.assertEqual(401, req.status_code)
+
+        # Get the counts before creating anything
+        req = requests.get(f"{BASE_API_URL}/conversations/facets", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        orig_facets = req.json()
+
+        # Create a labeled conversation
+        label = "Test facet label"
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": [label]})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        status = requests.get(f"{BASE_API_URL}/conversations/{new_conv_id}", verify=False, headers=GET_HEADERS).json()["status"]
+
+        # The new conversation should be counted (not served from the cache)
+        req = requests.get(f"{BASE_API_URL}/conversations/facets", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        facets = req.json()
+        self.assertEqual(orig_facets["total"] + 1, facets["total"])
+        self.assertEqual(orig_facets["unarchived"] + 1, facets["unarchived"])
+        self.assertEqual(orig_facets["archived"], facets["archived"])
+        self.assertEqual(orig_facets["statuses"].get(status, 0) + 1, facets["statuses"][status])
+        self.assertEqual(orig_facets["labels"].get(label, 0) + 1, facets["labels"][label])
+        self.assertEqual(orig_facets["unread"], facets["unread"])
+
+        # The same request with the ETag should get a 304
+        req = requests.get(f"{BASE_API_URL}/conversations/facets", verify=False, headers={**GET_HEADERS, "If-None-Match": req.headers["ETag"]})
+        self.assertEqual(304, req.status_code)
+
+        # A reply from someone else should make the conversation unread
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 1, 0, 1);", (new_conv_id, test_username))
+        self.cur.callproc("create_message", (new_conv_id, test_username, "Test reply", 0))
+        self.message_ids_for_cleanup.append(self.cur.fetchall()[0][0])
+        self.cur.nextset()
+        self.conn.commit()
+        req = requests.get(f"{BASE_API_URL}/conversations/facets", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual(orig_facets["unread"] + 1, req.json()["unread"])
+        self.assertEqual(orig_facets["unreadMessages"] + 1, req.json()["unreadMessages"])
+
+    def test_search_conversations(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Make request with NO authentication, then with no query
+        req = requests.get(f"{BASE_API_URL}/conversations/search?q=test", verify=False)
+        self.assertEqual(401, req.status_code)
+        req = requests.get(f"{BASE_API_URL}/conversations/search", verify=False, headers=GET_HEADERS)
+        self.assertEqual(400, req.status_code)
+
+        # Create two conversations containing a word that appears nowhere else (the second one twice, so that it ranks higher), and let an anonymous test user reply to the first
+        search_word = f"searchtest{int(time.time() * 1000)}"
+        new_conv_ids = []
+        for body in [f"Test message about {search_word}", f"Test message about {search_word} and {search_word} again"]:
+            req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": body, "labels": []})
+            self.assertEqual(201, req.status_code)
+            new_conv_ids.append(req.json()["conversationId"])
+            self.conv_ids_for_cleanup.append(req.json()["conversationId"])
+            self.message_ids_for_cleanup.append(req.json()["messageId"])
+        test_username = 'test_user_1'
+        confirm_user_in_db(test_username, 'Test User 1')
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 0, 0, 1);", (new_conv_ids[0], test_username))
+        self.cur.callproc("create_message", (new_conv_ids[0], test_username, f"Test reply mentioning {search_word} three times: {search_word} {search_word}", 0))
+        self.message_ids_for_cleanup.append(self.cur.fetchall()[0][0])
+        self.cur.nextset()
+
+        # Create a conversation containing the word that the signed-in user can't access
+        self.cur.execute("INSERT INTO Conversations (status) VALUES ('Delivered');")
+        other_conv_id = self.cur.lastrowid
+        self.conv_ids_for_cleanup.append(other_conv_id)
+        self.cur.execute("INSERT INTO ConversationSettings (conversationId, username, isArchived, identityRevealed, isInitiator, isAccessible) VALUES (?, ?, 0, 1, 1, 1);", (other_conv_id, test_username))
+        self.cur.callproc("create_message", (other_conv_id, test_username, f"Private message about {search_word}", 0))
+        self.message_ids_for_cleanup.append(self.cur.fetchall()[0][0])
+        self.cur.nextset()
+        self.conn.commit()
+
+        # Only the accessible conversations should be found, best match first, with the anonymous sender's identity hidden
+        req = requests.get(f"{BASE_API_URL}/conversations/search?q={search_word}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        results = req.json()["conversations"]
+        self.assertEqual(new_conv_ids, [result["id"] for result in results])
+        self.assertGreater(results[0]["score"], results[1]["score"])
+        self.assertEqual("anonymous", results[0]["bestMessage"]["sender"]["username"])
+        self.assertIsNone(req.json()["nextCursor"])
+
+        # Page through the results one at a time
+        req = requests.get(f"{BASE_API_URL}/conversations/search?q={search_word}&limit=1", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([new_conv_ids[0]], [result["id"] for result in req.json()["conversations"]])
+        req = requests.get(f"{BASE_API_URL}/conversations/search?q={search_word}&limit=1&cursor={req.json()['nextCursor']}", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual([new_conv_ids[1]], [result["id"] for result in req.json()["conversations"]])
+        self.assertIsNone(req.json()["nextCursor"])
+
+        # Cursors whose score isn't a finite number should be rejected
+        for score in ["nan", "inf", "-inf"]:
+            cursor = base64.urlsafe_b64encode(f"{score}:{new_conv_ids[0]}".encode()).decode()
+            req = requests.get(f"{BASE_API_URL}/conversations/search?q={search_word}&cursor={cursor}", verify=False, headers=GET_HEADERS)
+            self.assertEqual(400, req.status_code)
+
+    def test_search_conversations_labeled_pages(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create three labeled conversations containing a word that appears nowhere else
+        search_word = f"searchtest{int(time.time() * 1000)}"
+        label = f"Test label {time.time()}"
+        self.label_bodies_for_cleanup.append(label)
+        new_conv_ids = []
+        for _ in range(3):
+            req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": f"Test message about {search_word}", "labels": [label]})
+            self.assertEqual(201, req.status_code)
+            new_conv_ids.append(req.json()["conversationId"])
+            self.conv_ids_for_cleanup.append(req.json()["conversationId"])
+            self.message_ids_for_cleanup.append(req.json()["messageId"])
+
+        # Page through the results with pages smaller than the number of results, so that a labeled conversation is always just past the page boundary
+        for limit in [1, 2]:
+            found_conv_ids = []
+            cursor = None
+            while True:
+                params = {"q": search_word, "limit": limit}
+                if cursor != None:
+                    params["cursor"] = cursor
+                req = requests.get(f"{BASE_API_URL}/conversations/search", verify=False, headers=GET_HEADERS, params=params)
+                self.assertEqual(200, req.status_code)
+                results = req.json()["conversations"]
+                self.assertLessEqual(len(results), limit)
+                for result in results:
+                    self.assertEqual([label], result["labels"])
+                found_conv_ids.extend(result["id"] for result in results)
+                cursor = req.json()["nextCursor"]
+                if cursor == None:
+                    break
+            self.assertEqual(sorted(new_conv_ids), sorted(found_conv_ids))
+
+    def test_stream_conversations(self):
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+        # Create a labeled conversation with two messages, and one with no labels
+        new_conv_ids = []
+        for labels in [["Test label 1", "Test label 2"], []]:
+            req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": labels})
+            self.assertEqual(201, req.status_code)
+            new_conv_ids.append(req.json()["conversationId"])
+            self.conv_ids_for_cleanup.append(req.json()["conversationId"])
+            self.message_ids_for_cleanup.append(req.json()["messageId"])
+        req = requests.post(f"{BASE_API_URL}/conversations/{new_conv_ids[0]}/messages/create", verify=False, headers=POST_HEADERS, json={"messageBody": "Test reply"})
+        self.assertEqual(201, req.status_code)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+
+        # The streamed list of conversations should be the same as the regular one
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS)
+        self.assertEqual(200, req.status_code)
+        streamed_req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params={"stream": "true"})
+        self.assertEqual(200, streamed_req.status_code)
+        self.assertEqual(req.json(), streamed_req.json())
+        self.assertEqual(["Test label 1", "Test label 2"], sorted(streamed_req.json()[str(new_conv_ids[0])]["labels"]))
+        self.assertEqual(2, len(streamed_req.json()[str(new_conv_ids[0])]["messages"]))
+
+        # The same goes for a page of the list
+        params = {"after": str(new_conv_ids[0] - 1), "limit": "1"}
+        req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params=params)
+        self.assertEqual(200, req.status_code)
+        streamed_req = requests.get(f"{BASE_API_URL}/conversations", verify=False, headers=GET_HEADERS, params={**params, "stream": "true"})
+        self.assertEqual(200, streamed_req.status_code)
+        self.assertEqual(req.json(), streamed_req.json())
+        self.assertEqual(new_conv_ids[0], streamed_req.json()["nextCursor"])
+
+    def test_create_conversation_labels(self):
+
+        def create_labeled_conversation(labels):
+            req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message", "labels": labels})
+            if req.status_code == 201:
+                self.conv_ids_for_cleanup.append(req.json()["conversationId"])
+                self.message_ids_for_cleanup.append(req.json()["messageId"])
+            return req
+
+        def get_applied_label_ids(conv_id):
+            self.cur.execute("SELECT labelId FROM AppliedLabels WHERE conversationId = ?;", (conv_id,))
+            return sorted(row[0] for row in self.cur.fetchall())
+
+        # Labels that are too long, or that aren't strings, should be rejected without creating anything
+        self.assertEqual(400, create_labeled_conversation(["x" * 41]).status_code)
+        self.assertEqual(400, create_labeled_conversation("Not a list").status_code)
+        self.assertEqual(400, create_labeled_conversation([5]).status_code)
+
+        # A label that doesn't exist yet (so isn't cached) should be created and applied
+        label = f"Test label {time.time()}"
+        self.label_bodies_for_cleanup.append(label)
+        req = create_labeled_conversation([label])
+        self.assertEqual(201, req.status_code)
+        self.cur.execute("SELECT id FROM Labels WHERE body = ?;", (label,))
+        label_id = self.cur.fetchone()[0]
+        self.assertEqual([label_id], get_applied_label_ids(req.json()["conversationId"]))
+
+        # Applying it again (now from the cache) should reuse the same label
+        req = create_labeled_conversation([label])
+        self.assertEqual(201, req.status_code)
+        self.assertEqual([label_id], get_applied_label_ids(req.json()["conversationId"]))
+
+        # Bodies that differ only in case or trailing spaces are the same label to the database, so they should be applied as that label instead of failing
+        req = create_labeled_conversation([label.upper(), label.lower() + "  "])
+        self.assertEqual(201, req.status_code)
+        self.assertEqual([label_id, label_id], get_applied_label_ids(req.json()["conversationId"]))
+        self.cur.execute("SELECT COUNT(*) FROM Labels WHERE body = ?;", (label,))
+        self.assertEqual(1, self.cur.fetchone()[0])
+
+        # If the label is deleted behind the app's back, its cached ID should be replaced by the recreated label's ID, and the label applied exactly once
+        self.cur.execute("DELETE FROM AppliedLabels WHERE labelId = ?;", (label_id,))
+        self.cur.execute("DELETE FROM Labels WHERE id = ?;", (label_id,))
+        self.conn.commit()
+        req = create_labeled_conversation([label, "Outreach"])
+        self.assertEqual(201, req.status_code)
+        self.cur.execute("SELECT id FROM Labels WHERE body IN (?, ?);", (label, "Outreach"))
+        self.assertEqual(sorted(row[0] for row in self.cur.fetchall()), get_applied_label_ids(req.json()["conversationId"]))
+
     def tearDown(self):
 
         # Delete any messages, conversations, etc. created
         for message_id in self.message_ids_for_cleanup:
-            self.cur.execute("DELETE FROM MessageSettings WHERE messageId = ?;", (message_id,))
             self.cur.execute("DELETE FROM Messages WHERE id = ?;", (message_id,))
         for conv_id in self.conv_ids_for_cleanup:
             self.cur.execute("DELETE FROM AppliedLabels WHERE conversationId = ?;", (conv_id,))
             self.cur.execute("DELETE FROM ConversationSettings WHERE conversationId = ?;", (conv_id,))
             self.cur.execute("DELETE FROM Conversations WHERE id = ?;", (conv_id,))
+        for label_body in self.label_bodies_for_cleanup:
+            self.cur.execute("DELETE FROM AppliedLabels WHERE labelId IN (SELECT id FROM Labels WHERE body = ?);", (label_body,))
+            self.cur.execute("DELETE FROM Labels WHERE body = ?;", (label_body,))
         
         # Reset the permissions and updated metadata (for the sake of fake admin removal) of the signed-in user to normal student
         self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0, rolesLastUpdated = UTC_TIMESTAMP(), updatedBy = NULL WHERE username = ?;", (SIGNED_IN_USERNAME,))
         
         # Delete the fake admin who was used for role assignment (these commands are only safe under the assumption that THE fake admin didn't send any messages)
         self.cur.execute("DELETE FROM ConversationSettings WHERE username = ?;", (FAKE_ADMIN_USERNAME,))
-        self.cur.execute("DELETE FROM MessageSettings WHERE username = ?;", (FAKE_ADMIN_USERNAME,))
         self.cur.execute("DELETE FROM Users WHERE username = ?;", (FAKE_ADMIN_USERNAME,))
         
         # Commit, clear lists of IDs to delete, and close connection
@@ -0,0 +1,73 @@
+# NOTE: In order to run these tests, make sure you've provided the necessary values in backend/.env (and that backend/config.py exists)
+# Unlike the API tests, these run the app's code in this process (inside Flask test request contexts) rather than sending requests to a running server.
+
+import sys
+import os
+sys.path.append('..')
+sys.path.append('../..')
+import unittest
+import flask
+from dotenv import load_dotenv
+try:
+    from database_handler import get_conn_and_cursor, confirm_user_in_db
+    from backend import app
+    from backend.route_wrappers import get_user_context, user_has_role
+except ModuleNotFoundError:
+    print("Make sure you're actually in the test directory when you run this program.")
+    exit(1)
+
+load_dotenv()
+
+TEST_USERNAME = 'test_user_1'
+TEST_DISPLAY_NAME = 'Test User 1'
+
+class TestRouteWrappers(unittest.TestCase):
+
+    def setUp(self):
+        self.conn, self.cur = get_conn_and_cursor()
+
+        # Make sure the test user is a normal student
+        confirm_user_in_db(TEST_USERNAME, TEST_DISPLAY_NAME)
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (TEST_USERNAME,))
+        self.conn.commit()
+
+    def test_user_context_per_request(self):
+
+        # Nobody is signed in, so there are no roles
+        with app.test_request_context():
+            self.assertIsNone(get_user_context())
+            self.assertFalse(user_has_role('isStudent', 'isCCSGA', 'isAdmin'))
+
+        with app.test_request_context():
+            flask.session['CAS_USERNAME'] = TEST_USERNAME
+            user_context = get_user_context()
+            self.assertEqual(TEST_USERNAME, user_context["username"])
+            self.assertTrue(user_context["isStudent"])
+            self.assertFalse(user_context["isAdmin"])
+
+            # Within the same request, the roles are loaded only once, so a change made in the meantime isn't seen (by any of the role checks)
+            self.cur.execute("UPDATE Users SET isAdmin = 1 WHERE username = ?;", (TEST_USERNAME,))
+            self.conn.commit()
+            self.assertIs(user_context, get_user_context())
+            self.assertFalse(user_has_role('isAdmin'))
+            self.assertTrue(user_has_role('isStudent'))
+
+        # The next request loads the roles again, so it sees the change
+        with app.test_request_context():
+            flask.session['CAS_USERNAME'] = TEST_USERNAME
+            self.assertTrue(user_has_role('isAdmin'))
+            self.assertFalse(user_has_role('isStudent'))
+            self.assertTrue(user_has_role('isStudent', 'isAdmin'))
+
+    def tearDown(self):
+
+        # Reset the permissions of the test user to normal student
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (TEST_USERNAME,))
+
+        # Commit and close connection
+        self.conn.commit()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
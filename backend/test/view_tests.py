@@ -0,0 +1,217 @@
+# NOTE: In order to run these tests, make sure you've provided the necessary values in backend/.env
+# The tests of static files also need a Flutter build (flutter build web, in the frontend directory), and are skipped without one.
+
+import sys
+import os
+import json
+import tempfile
+sys.path.append('..')
+import unittest
+import requests
+from dotenv import load_dotenv
+try:
+    from database_handler import get_conn_and_cursor, confirm_user_in_db
+    from prepare_static import compress_file, fingerprint_files, ASSET_MANIFEST_FILENAME
+except ModuleNotFoundError:
+    print("Make sure you're actually in the test directory when you run this program.")
+    exit(1)
+
+load_dotenv()
+
+PORT = os.getenv("TESTING_PORT")
+COOKIE = os.getenv("TESTING_COOKIE")
+SIGNED_IN_USERNAME = os.getenv("TESTING_USERNAME")
+BASE_URL = f"https://localhost:{PORT}"
+BASE_API_URL = f"{BASE_URL}/api"
+GET_HEADERS = {"Cookie": COOKIE}
+POST_HEADERS = {"Cookie": COOKIE, "Content-Type": "application/json"}
+BUILD_DIRECTORY = '../../frontend/build/web'
+TEST_STATIC_FILENAME = 'view_test_file.js'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class TestViewRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.conn, self.cur = get_conn_and_cursor()
+        self.conv_ids_for_cleanup = []
+        self.message_ids_for_cleanup = []
+        self.static_paths_for_cleanup = []
+
+        # Make sure signed-in user is a normal student
+        confirm_user_in_db(SIGNED_IN_USERNAME, "User Who Signed In For Testing")
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+        self.conn.commit()
+
+    def test_compressed_responses(self):
+
+        # Create a conversation with a message long enough that getting it is worth compressing
+        req = requests.post(f"{BASE_API_URL}/conversations/create", verify=False, headers=POST_HEADERS, json={"revealIdentity": False, "messageBody": "Test message " * 200, "labels": []})
+        self.assertEqual(201, req.status_code)
+        new_conv_id = req.json()["conversationId"]
+        self.conv_ids_for_cleanup.append(new_conv_id)
+        self.message_ids_for_cleanup.append(req.json()["messageId"])
+        url = f"{BASE_API_URL}/conversations/{new_conv_id}"
+
+        # Without compression, the response should still say that it depends on Accept-Encoding
+        req = requests.get(url, verify=False, headers={**GET_HEADERS, "Accept-Encoding": "identity"})
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn("Content-Encoding", req.headers)
+        self.assertIn("Accept-Encoding", req.headers["Vary"])
+        uncompressed_etag = req.headers["ETag"]
+        uncompressed_body = req.json()
+
+        # With gzip, the same response should come compressed (requests decompresses it), with its ETag weakened
+        req = requests.get(url, verify=False, headers={**GET_HEADERS, "Accept-Encoding": "gzip"})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual("gzip", req.headers["Content-Encoding"])
+        self.assertIn("Accept-Encoding", req.headers["Vary"])
+        self.assertEqual(uncompressed_body, req.json())
+        compressed_etag = req.headers["ETag"]
+        self.assertTrue(compressed_etag.startswith("W/"))
+        self.assertEqual(uncompressed_etag, compressed_etag[2:])
+
+        # Either ETag should get a 304
+        for etag in [uncompressed_etag, compressed_etag]:
+            req = requests.get(url, verify=False, headers={**GET_HEADERS, "Accept-Encoding": "gzip", "If-None-Match": etag})
+            self.assertEqual(304, req.status_code)
+
+        # Small responses aren't compressed, even when the client accepts gzip
+        req = requests.get(f"{BASE_API_URL}/authenticate", verify=False, headers={**GET_HEADERS, "Accept-Encoding": "gzip"})
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn("Content-Encoding", req.headers)
+
+    @unittest.skipUnless(os.path.isdir(BUILD_DIRECTORY), "there is no Flutter build")
+    def test_precompressed_static_files(self):
+
+        # Add a static file to the build, with a precompressed copy
+        path = os.path.join(BUILD_DIRECTORY, TEST_STATIC_FILENAME)
+        self.static_paths_for_cleanup.extend([path, path + '.gz', path + '.br'])
+        contents = "console.log('view test');\n" * 200
+        with open(path, 'w') as f:
+            f.write(contents)
+        self.assertIn('.gz', compress_file(path))
+
+        # A client that accepts gzip should get the precompressed copy
+        req = requests.get(f"{BASE_URL}/{TEST_STATIC_FILENAME}", verify=False, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(200, req.status_code)
+        self.assertEqual("gzip", req.headers["Content-Encoding"])
+        self.assertIn("Accept-Encoding", req.headers["Vary"])
+        self.assertIn("javascript", req.headers["Content-Type"])
+        self.assertEqual(contents, req.text)
+
+        # A client that doesn't should get the original
+        req = requests.get(f"{BASE_URL}/{TEST_STATIC_FILENAME}", verify=False, headers={"Accept-Encoding": "identity"})
+        self.assertEqual(200, req.status_code)
+        self.assertNotIn("Content-Encoding", req.headers)
+        self.assertIn("Accept-Encoding", req.headers["Vary"])
+        self.assertEqual(contents, req.text)
+
+    def test_fingerprint_files(self):
+
+        with tempfile.TemporaryDirectory() as build_directory:
+
+            def write_file(name, contents):
+                with open(os.path.join(build_directory, name), 'w') as f:
+                    f.write(contents)
+
+            # A build whose index.html references two local files (one of them twice), a missing file, and an external one
+            write_file('index.html', '<link href="styles.css"><script src="main.dart.js"></script><script src="main.dart.js"></script><script src="missing.js"></script><script src="https://example.com/lib.js"></script>')
+            write_file('main.dart.js', "console.log('version 1');")
+            write_file('styles.css', "body {}")
+
+            # Each referenced file that exists should get a fingerprinted copy with the same contents, listed in the manifest
+            manifest = fingerprint_files(build_directory)
+            self.assertEqual({'main.dart.js', 'styles.css'}, set(manifest))
+            self.assertRegex(manifest['main.dart.js'], r'^main\.dart\.[0-9a-f]{12}\.js$')
+            self.assertRegex(manifest['styles.css'], r'^styles\.[0-9a-f]{12}\.css$')
+            with open(os.path.join(build_directory, manifest['main.dart.js'])) as f:
+                self.assertEqual("console.log('version 1');", f.read())
+            with open(os.path.join(build_directory, ASSET_MANIFEST_FILENAME)) as f:
+                self.assertEqual(manifest, json.load(f))
+
+            # Fingerprinting the same build again should give the same names
+            self.assertEqual(manifest, fingerprint_files(build_directory))
+
+            # A changed file should get a new name, and its old copy should be removed; an unchanged file should keep its copy
+            write_file('main.dart.js', "console.log('version 2');")
+            new_manifest = fingerprint_files(build_directory)
+            self.assertNotEqual(manifest['main.dart.js'], new_manifest['main.dart.js'])
+            self.assertFalse(os.path.exists(os.path.join(build_directory, manifest['main.dart.js'])))
+            self.assertTrue(os.path.exists(os.path.join(build_directory, new_manifest['main.dart.js'])))
+            self.assertEqual(manifest['styles.css'], new_manifest['styles.css'])
+            self.assertTrue(os.path.exists(os.path.join(build_directory, new_manifest['styles.css'])))
+
+    @unittest.skipUnless(os.path.isfile(os.path.join(BUILD_DIRECTORY, ASSET_MANIFEST_FILENAME)), "the Flutter build hasn't been fingerprinted (python3 prepare_static.py)")
+    def test_fingerprinted_static_files(self):
+
+        with open(os.path.join(BUILD_DIRECTORY, ASSET_MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+
+        # Fingerprinted files can be cached forever, but the files they're copied from keep their names across builds, so they can't
+        for name, fingerprinted_name in manifest.items():
+            req = requests.get(f"{BASE_URL}/{fingerprinted_name}", verify=False)
+            self.assertEqual(200, req.status_code)
+            self.assertEqual(IMMUTABLE_CACHE_CONTROL, req.headers["Cache-Control"])
+            req = requests.get(f"{BASE_URL}/{name}", verify=False)
+            self.assertEqual(200, req.status_code)
+            self.assertNotIn("immutable", req.headers.get("Cache-Control", ""))
+
+        # index.html itself, fetched as a static file, should never be cached
+        req = requests.get(f"{BASE_URL}/index.html", verify=False)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual("no-store", req.headers["Cache-Control"])
+
+    @unittest.skipUnless(os.path.isfile(os.path.join(BUILD_DIRECTORY, 'index.html')), "there is no Flutter build")
+    def test_shell_conditional_get(self):
+
+        # Pages of the app are index.html, which browsers must revalidate every time (but needn't download again if it hasn't changed)
+        req = requests.get(f"{BASE_URL}/", verify=False, headers=GET_HEADERS, allow_redirects=False)
+        self.assertEqual(200, req.status_code)
+        self.assertIn("text/html", req.headers["Content-Type"])
+        self.assertEqual("private, no-cache", req.headers["Cache-Control"])
+        etag = req.headers["ETag"]
+        self.assertGreater(len(req.content), 0)
+
+        # Every page of the app is the same index.html, so it should have the same ETag
+        req = requests.get(f"{BASE_URL}/new_message", verify=False, headers=GET_HEADERS, allow_redirects=False)
+        self.assertEqual(200, req.status_code)
+        self.assertEqual(etag, req.headers["ETag"])
+
+        # With the ETag, the response should be an empty 304 that still has the caching headers
+        req = requests.get(f"{BASE_URL}/", verify=False, headers={**GET_HEADERS, "If-None-Match": etag}, allow_redirects=False)
+        self.assertEqual(304, req.status_code)
+        self.assertEqual(b"", req.content)
+        self.assertEqual(etag, req.headers["ETag"])
+        self.assertEqual("private, no-cache", req.headers["Cache-Control"])
+
+        # An outdated ETag should get the whole page
+        req = requests.get(f"{BASE_URL}/", verify=False, headers={**GET_HEADERS, "If-None-Match": '"outdated"'}, allow_redirects=False)
+        self.assertEqual(200, req.status_code)
+        self.assertGreater(len(req.content), 0)
+
+    def tearDown(self):
+
+        # Delete any messages, conversations, and static files created
+        for message_id in self.message_ids_for_cleanup:
+            self.cur.execute("DELETE FROM Messages WHERE id = ?;", (message_id,))
+        for conv_id in self.conv_ids_for_cleanup:
+            self.cur.execute("DELETE FROM AppliedLabels WHERE conversationId = ?;", (conv_id,))
+            self.cur.execute("DELETE FROM ConversationSettings WHERE conversationId = ?;", (conv_id,))
+            self.cur.execute("DELETE FROM Conversations WHERE id = ?;", (conv_id,))
+        for path in self.static_paths_for_cleanup:
+            if os.path.exists(path):
+                os.remove(path)
+
+        # Reset the permissions of the signed-in user to normal student
+        self.cur.execute("UPDATE Users SET isBanned = 0, isCCSGA = 0, isAdmin = 0 WHERE username = ?;", (SIGNED_IN_USERNAME,))
+
+        # Commit, clear lists of IDs to delete, and close connection
+        self.conn.commit()
+        self.message_ids_for_cleanup.clear()
+        self.conv_ids_for_cleanup.clear()
+        self.static_paths_for_cleanup.clear()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,114 @@
 from backend import app
 import flask
-from flask import make_response, render_template, send_from_directory
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from flask import make_response, send_from_directory, request, safe_join
 from backend.route_wrappers import login_required_with_db_confirm, student_or_admin_required, admin_required
 
+# The Flutter web build, relative to the backend directory
+BUILD_DIRECTORY = '../frontend/build/web'
+
+# Precompressed copies of static files (made by prepare_static.py) sit next to the originals, with these extensions added
+PRECOMPRESSED_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+# Maps the names of the files that index.html references to the names of their fingerprinted copies (made by prepare_static.py)
+ASSET_MANIFEST_FILENAME = 'asset-manifest.json'
+
+# References to local files in index.html (the same pattern as in prepare_static.py)
+FILE_REFERENCE = re.compile(r'\b(src|href)="([^":?#]+)"')
+
+# Fingerprinted files never change (a changed file gets a new name), so browsers may keep them for a year without checking back
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# The most recently loaded asset manifest, and the modification time of the file it was loaded from
+asset_manifest = {"mtime": None, "files": dict()}
+
+def get_asset_manifest():
+    '''Return the mapping of original file names to fingerprinted file names, reloading it whenever prepare_static.py rewrites it.
+    Return an empty mapping if the build hasn't been fingerprinted, in which case the original names are used.'''
+
+    manifest_path = os.path.join(app.root_path, BUILD_DIRECTORY, ASSET_MANIFEST_FILENAME)
+    try:
+        mtime = os.path.getmtime(manifest_path)
+        if mtime != asset_manifest["mtime"]:
+            with open(manifest_path) as f:
+                asset_manifest["files"] = json.load(f)
+            asset_manifest["mtime"] = mtime
+    except (OSError, ValueError):
+        asset_manifest["mtime"], asset_manifest["files"] = None, dict()
+    return asset_manifest["files"]
+
+# The rendered index.html, as (modification times of index.html and the asset manifest, body as bytes, ETag), replaced as a whole whenever either file changes
+shell = {"rendered": (None, None, None)}
+
+def get_shell():
+    '''Return the rendered index.html from the Flutter build (referencing the fingerprinted copies of the files it loads) as a tuple of (body as bytes, ETag).
+    It is rendered only when index.html or the asset manifest has changed since it was last rendered (e.g., after a new build is deployed), and served from memory otherwise.'''
+
+    index_path = os.path.join(app.root_path, BUILD_DIRECTORY, 'index.html')
+    manifest = get_asset_manifest()
+    mtimes = (os.path.getmtime(index_path), asset_manifest["mtime"])
+    rendered_mtimes, body, etag = shell["rendered"]
+    if mtimes != rendered_mtimes:
+        # Read the file directly rather than with render_template, since Jinja only notices that a template changed in debug mode
+        with open(index_path) as f:
+            html = flask.render_template_string(f.read())
+        body = FILE_REFERENCE.sub(lambda match: f'{match.group(1)}="{manifest.get(match.group(2), match.group(2))}"', html).encode()
+        etag = hashlib.sha256(body).hexdigest()
+        shell["rendered"] = (mtimes, body, etag)
+    return body, etag
+
+def warm_shell_cache():
+    '''Render index.html ahead of the first page request (called once at startup). Does nothing if there is no Flutter build yet.'''
+
+    try:
+        with app.app_context():
+            get_shell()
+    except OSError as e:
+        print(f"Error when rendering index.html: {e}")
+
+def render_shell():
+    '''Return the response for a page of the Flutter app: the rendered index.html from memory, or a 304 if the browser already has the current version.
+    Browsers must check back every time (no-cache), so that a new build (and the new fingerprinted names that come with it) is picked up on the next page load.'''
+
+    body, etag = get_shell()
+    resp = make_response("", 304) if request.if_none_match.contains_weak(etag) else make_response(body)
+    resp.mimetype = 'text/html'
+    resp.set_etag(etag)
+    resp.headers.set('Cache-Control', 'private, no-cache')
+    return resp
+
 @app.route('/<path:path>', methods=['GET'])
 def static_proxy(path):
-    '''This function/route is required to load all the static files (besides index.html) from the frontend build. Found on an online help forum.'''
+    '''This function/route is required to load all the static files (besides index.html) from the frontend build. Found on an online help forum.
+    If the client accepts an encoding for which prepare_static.py made a precompressed copy of the file, that copy is sent instead.'''
+
+    # Find the precompressed copies of this file, and pick the one the client prefers (if any)
+    available_encodings = []
+    for encoding, extension in PRECOMPRESSED_EXTENSIONS.items():
+        compressed_path = safe_join(os.path.join(app.root_path, BUILD_DIRECTORY), path + extension)
+        if compressed_path != None and os.path.isfile(compressed_path):
+            available_encodings.append(encoding)
+    encoding = request.accept_encodings.best_match(available_encodings) if available_encodings else None
+
+    if encoding != None:
+        resp = make_response(send_from_directory(BUILD_DIRECTORY, path + PRECOMPRESSED_EXTENSIONS[encoding], mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream'))
+        resp.headers.set('Content-Encoding', encoding)
+    else:
+        resp = make_response(send_from_directory(BUILD_DIRECTORY, path))
+    if available_encodings:
+        resp.vary.add('Accept-Encoding')
 
-    resp = make_response(send_from_directory('../frontend/build/web', path))
-    if ('assets' not in path and 'favicon' not in path): # Don't prevent our images or favicon from caching, but prevent other files (namely JS files) from caching
+    # Fingerprinted files can be cached forever; other files may be cached too, but must be revalidated (cheaply, with their ETags) before each use, since they keep their names across builds
+    if path in get_asset_manifest().values():
+        resp.headers.set('Cache-Control', IMMUTABLE_CACHE_CONTROL)
+    elif path == 'index.html':
         resp.headers.set('Cache-Control', 'no-store')
+    elif ('assets' not in path and 'favicon' not in path): # Don't interfere with the caching of our images or favicon
+        resp.headers.set('Cache-Control', 'no-cache')
     return resp
 
 @app.route("/")
@@ -17,42 +116,32 @@ def static_proxy(path):
 def homepage():
     '''Return the index.html page from the Flutter build, since there was a request for the website homepage.'''
 
-    resp = make_response(render_template('index.html'))
-    resp.headers.set('Cache-Control', 'no-store') # Avoid caching to make sure our build changes are reflected immediately
-    return resp
+    return render_shell()
 
 @app.route("/conversation_list")
 @login_required_with_db_confirm
 def all_conversations_page():
     '''Return the index.html page from the Flutter build, since there was a request for the page with the list of all the conversations to which this user has access.'''
     
-    resp = make_response(render_template('index.html'))
-    resp.headers.set('Cache-Control', 'no-store') # Avoid caching to make sure our build changes are reflected immediately
-    return resp
+    return render_shell()
 
 @app.route("/conversation/<conversation_id>")
 @login_required_with_db_confirm
 def indiv_conversation_page(conversation_id):
     '''Return the index.html page from the Flutter build, since there was a request for the page for a given, existing conversation to which this user has access.'''
     
-    resp = make_response(render_template('index.html'))
-    resp.headers.set('Cache-Control', 'no-store') # Avoid caching to make sure our build changes are reflected immediately
-    return resp
+    return render_shell()
 
 @app.route("/new_message")
 @login_required_with_db_confirm
 def new_message_page():
     '''Return the index.html page from the Flutter build, since there was a request for the page for initiating a new conversation.'''
 
-    resp = make_response(render_template('index.html'))
-    resp.headers.set('Cache-Control', 'no-store') # Avoid caching to make sure our build changes are reflected immediately
-    return resp
+    return render_shell()
 
 @app.route("/admin_controls")
 @admin_required
 def admin_page():
     '''Return the index.html page from the Flutter build, since there was a request for the admin controls page.'''
 
-    resp = make_response(render_template('index.html'))
-    resp.headers.set('Cache-Control', 'no-store') # Avoid caching to make sure our build changes are reflected immediately
-    return resp
+    return render_shell()
@@ -12,12 +12,14 @@ class ConversationListCard extends StatelessWidget {
   final String joinedLabels;
   final String mostRecentMessageBody;
   final String mostRecentMessageDateTime;
+  final int unreadCount;
 
   ConversationListCard(
       {this.convId,
       this.joinedLabels,
       this.mostRecentMessageBody,
       this.mostRecentMessageDateTime,
+      this.unreadCount,
       this.conversationCallback});
 
   @override
@@ -43,6 +45,17 @@ class ConversationListCard extends StatelessWidget {
               leading: Icon(Icons.message_outlined),
               title: Text("CCSGA " + joinedLabels),
               subtitle: Text(mostRecentMessageBody),
+              // Badge with the number of unread messages, maintained by the server
+              trailing: (unreadCount ?? 0) > 0
+                  ? CircleAvatar(
+                      radius: 12,
+                      backgroundColor: Theme.of(context).primaryColor,
+                      child: Text(
+                        unreadCount > 99 ? "99+" : unreadCount.toString(),
+                        style: TextStyle(fontSize: 11, color: Colors.white),
+                      ),
+                    )
+                  : null,
               isThreeLine: true,
             ),
             Padding(
@@ -132,6 +132,7 @@ class _ConversationListPageState extends BaseState<ConversationListPage>
         joinedLabels: joinedLabels,
         mostRecentMessageBody: mostRecentMessage.body,
         mostRecentMessageDateTime: mostRecentMessage.dateTime,
+        unreadCount: conv.unreadCount,
         conversationCallback: beamToConversation,
       ));
     }
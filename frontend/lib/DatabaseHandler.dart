@@ -23,7 +23,7 @@ class DatabaseHandler {
   // get all my conversations from the database
   Future<Tuple2<ChewedResponse, List<Conversation>>>
       getConversationList() async {
-    final url = '/api/conversations';
+    final url = '/api/conversations?stream=true';
     var response =
         await http.get(url, headers: {"Content-Type": "application/json"});
     ChewedResponse chewedResponse =
@@ -21,7 +21,7 @@ class ChewedResponse {
    * Sets this.isSuccessful and this.message based on the @param statusCode
    */
   void chewStatusCode(int statusCode) {
-    if (statusCode == 200 || statusCode == 201) {
+    if (statusCode == 200 || statusCode == 201 || statusCode == 202) {
       this.isSuccessful = true;
     } else if (statusCode == 401) {
       this.isSuccessful = false;
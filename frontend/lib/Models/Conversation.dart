@@ -21,6 +21,7 @@ class Conversation {
     this.allIdentitiesRevealed,
     this.ownIdentityRevealed,
     this.isRead,
+    this.unreadCount,
   });
 
   int id;
@@ -31,6 +32,7 @@ class Conversation {
   bool allIdentitiesRevealed;
   bool ownIdentityRevealed;
   bool isRead;
+  int unreadCount;
 
   factory Conversation.fromJson(Map<String, dynamic> json) => Conversation(
         messages: json["messages"] == null
@@ -49,6 +51,7 @@ class Conversation {
             ? null
             : json["ownIdentityRevealed"],
         isRead: json["isRead"] == null ? null : json["isRead"],
+        unreadCount: json["unreadCount"] == null ? null : json["unreadCount"],
       );
 
   Map<String, dynamic> toJson() => {
@@ -65,5 +68,6 @@ class Conversation {
         "ownIdentityRevealed":
             ownIdentityRevealed == null ? null : ownIdentityRevealed,
         "isRead": isRead == null ? null : isRead,
+        "unreadCount": unreadCount == null ? null : unreadCount,
       };
 }